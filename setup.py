@@ -11,7 +11,6 @@ requires = (
     'colander',
     'deform',
     'voteit.core',
-    'python-vote-core==20120423.0',
     )
 
 setup(name='voteit.schulze',
@@ -37,5 +36,8 @@ setup(name='voteit.schulze',
       entry_points = """\
       [fanstatic.libraries]
       voteit_schulze = voteit.schulze.fanstatic_lib:library
+      [console_scripts]
+      voteit_schulze_compact_results = voteit.schulze.results:main
+      voteit_schulze_audit = voteit.schulze.audit:main
       """,
       )
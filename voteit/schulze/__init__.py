@@ -7,7 +7,10 @@ _ = TranslationStringFactory("voteit.schulze")
 
 def includeme(config):
     config.add_translation_dirs("voteit.schulze:locale/")
+    config.include(".metrics")
     config.include(".models")
+    config.include(".tally")
+    config.include(".views")
     config.include(".fanstatic_lib")
     # Include widget search path (for deform)
     configure_zpt_renderer(["voteit.schulze:templates/widgets"])
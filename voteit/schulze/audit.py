@@ -0,0 +1,175 @@
+""" Recalculate the results of closed Schulze polls and compare them with
+    the stored ones, for instance after the calculation engine has changed.
+
+    bin/voteit_schulze_audit etc/production.ini --processes 4
+
+    Closed polls are found in the catalog and read one at a time, without
+    loading anything else in the database. Only a snapshot of their ballots and
+    settings is handed to the worker processes. Nothing is written to the
+    database. One JSON object per poll is written as soon as it's done:
+
+    path, plugin, status, seconds, and the keys that differ, if any.
+
+    status is 'same', 'tie' if the only differences may come from a randomly
+    broken tie, 'different', or 'error'. Results with a 'tie_seed' were broken
+    reproducibly, so they're compared exactly when the seed and rule are the
+    same. The exit code is 1 if any poll
+    is different or failed.
+"""
+from collections import deque
+from multiprocessing import Pool
+import argparse
+import json
+import logging
+import sys
+import time
+
+from pyramid.paster import bootstrap
+from pyramid.traversal import resource_path
+import transaction
+
+from voteit.schulze.models import SchulzePollPlugin
+from voteit.schulze.models import SchulzePRPollPlugin
+from voteit.schulze.models import SchulzeSTVPollPlugin
+from voteit.schulze.models import SortedSchulzePollPlugin
+from voteit.schulze.results import closed_polls
+
+
+logger = logging.getLogger(__name__)
+
+PLUGINS = dict(
+    (x.name, x)
+    for x in (
+        SchulzePollPlugin,
+        SortedSchulzePollPlugin,
+        SchulzeSTVPollPlugin,
+        SchulzePRPollPlugin,
+    )
+)
+SAME = "same"
+TIE = "tie"
+DIFFERENT = "different"
+ERROR = "error"
+
+
+class PollSnapshot(object):
+    """ What a poll plugin needs to calculate the result, without the database. """
+
+    def __init__(self, poll):
+        self.uid = poll.uid
+        self.path = resource_path(poll)
+        self.poll_plugin = poll.poll_plugin
+        self.ballots = tuple(poll.ballots)
+        self.proposals = tuple(poll.proposals)
+        self.poll_settings = dict(poll.poll_settings)
+        self.poll_result = dict(poll.poll_result)
+
+
+def iter_snapshots(root, plugins=tuple(PLUGINS)):
+    """ Snapshots of closed_polls. Each poll is released once it's read. """
+    for poll in closed_polls(root, plugins):
+        snapshot = PollSnapshot(poll)
+        if getattr(poll, "_p_jar", None) is not None:
+            poll._p_deactivate()
+        yield snapshot
+
+
+def _has_tie(result):
+    if "tied_winners" in result or "tie_breaker" in result:
+        return True
+    return any(_has_tie(x) for x in result.get("rounds", ()))
+
+
+def _reproducible(stored, result):
+    return "tie_seed" in stored and all(
+        stored.get(k) == result.get(k) for k in ("tie_seed", "tie_rule")
+    )
+
+
+def compare(stored, result):
+    """ Status and the keys of stored that differ from result. """
+    stored = dict(stored)
+    result = dict(result)
+    exact = _reproducible(stored, result)
+    # Keys added to results since the poll was closed don't count
+    keys = sorted(
+        k
+        for k in stored
+        if (exact or k != "tie_breaker") and stored.get(k) != result.get(k)
+    )
+    if not keys:
+        return SAME, keys
+    if not exact and (_has_tie(stored) or _has_tie(result)):
+        return TIE, keys
+    return DIFFERENT, keys
+
+
+def recalculate(snapshot):
+    """ Calculate the result of snapshot again, and compare it with the stored
+        one. Runs in the worker processes.
+    """
+    entry = {"path": snapshot.path, "plugin": snapshot.poll_plugin}
+    start = time.time()
+    try:
+        plugin = PLUGINS[snapshot.poll_plugin](snapshot)
+        calculate = plugin.calculation(plugin.get_ballots())
+        result = calculate()
+    except Exception as exc:
+        logger.exception("Couldn't recalculate %s", snapshot.path)
+        entry["status"] = ERROR
+        entry["error"] = "%s: %s" % (exc.__class__.__name__, exc)
+    else:
+        entry["status"], entry["keys"] = compare(snapshot.poll_result, result)
+    entry["seconds"] = round(time.time() - start, 4)
+    return entry
+
+
+def audit(root, plugins=tuple(PLUGINS), processes=0):
+    """ Recalculate every closed poll using plugins and yield the entries.
+        With processes, that many polls are calculated at a time,
+        and only a couple per process are read ahead.
+    """
+    snapshots = iter_snapshots(root, plugins)
+    if not processes:
+        for snapshot in snapshots:
+            yield recalculate(snapshot)
+        return
+    pending = deque()
+    pool = Pool(processes)
+    try:
+        for snapshot in snapshots:
+            pending.append(pool.apply_async(recalculate, (snapshot,)))
+            while len(pending) > processes * 2:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
+
+def _csv(value):
+    return [x for x in value.split(",") if x]
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("config_uri")
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--plugins", type=_csv, default=list(PLUGINS))
+    parser.add_argument("--output", type=argparse.FileType("w"), default=sys.stdout)
+    options = parser.parse_args(argv[1:])
+    env = bootstrap(options.config_uri)
+    counts = {}
+    try:
+        for entry in audit(env["root"], options.plugins, options.processes):
+            counts[entry["status"]] = counts.get(entry["status"], 0) + 1
+            options.output.write(json.dumps(entry, sort_keys=True) + "\n")
+            options.output.flush()
+    finally:
+        transaction.abort()
+        env["closer"]()
+    sys.stderr.write(
+        " ".join("%s: %s" % item for item in sorted(counts.items())) + "\n"
+    )
+    if counts.get(DIFFERENT) or counts.get(ERROR):
+        sys.exit(1)
@@ -0,0 +1,328 @@
+""" Benchmarks of closing and rendering polls with each poll plugin.
+
+    Synthetic ballots are generated with a fixed seed, so runs can be compared
+    across versions. Every case runs in a forked process, with a poll set up
+    the same way as in the tests, and writes one JSON object per line:
+    the case, the seconds taken by handle_close and render_result, and peak
+    memory in kB of the process before and after each step.
+
+    Ballot structures:
+
+    uniform
+        Every voter gives every proposal a random number of stars.
+    clustered
+        Voters belong to one of a few groups and rank close to their
+        group's ranking, with some noise.
+    cycle
+        Three equal groups rank the proposals in rotated orders,
+        so there are Condorcet cycles at every level.
+
+    Usage:
+
+    python -m voteit.schulze.benchmark > before.jsonl
+    python -m voteit.schulze.benchmark --plugins schulze --voters 100,10000
+    python -m voteit.schulze.benchmark --plugins schulze_pr --seats 12
+
+    No network or database is needed. The result caches are turned off.
+
+    Schulze PR rankings of a board election sized like INTERACTIVE_CASE
+    should finish within INTERACTIVE_SECONDS on one core, with uniform as
+    well as clustered ballots, so they can be calculated while the moderator
+    waits. The tests check that with time_ranking. 12 seats from 20 proposals
+    take longer than that with uniform ballots, see the CALIBRATION of
+    voteit.schulze.cost.
+"""
+from multiprocessing import Process
+from multiprocessing import Queue
+from Queue import Empty
+import argparse
+import json
+import pkg_resources
+import platform
+import random
+import resource
+import sys
+import time
+
+
+STRUCTURES = ("uniform", "clustered", "cycle")
+PLUGINS = (
+    "schulze",
+    "sorted_schulze",
+    "schulze_stv",
+    "schulze_pr",
+)
+# Number of groups of voters in clustered ballots
+CLUSTERS = 3
+# Seconds a Schulze PR ranking of INTERACTIVE_CASE may take
+INTERACTIVE_SECONDS = 10
+# (proposals, voters, seats) of a board election
+INTERACTIVE_CASE = (20, 200, 8)
+# Ballot structures INTERACTIVE_CASE is checked with
+INTERACTIVE_STRUCTURES = ("uniform", "clustered")
+# Seconds between checks that the process running a case is still alive
+POLL_INTERVAL = 1
+
+
+def ranking_ballot(order, stars):
+    """ Ballot dict from candidates in order of preference, using stars levels.
+        1 is the best, like in the vote schema.
+    """
+    size = len(order)
+    return dict((c, 1 + i * stars // size) for (i, c) in enumerate(order))
+
+
+def generate_ballots(candidates, voters, stars=5, structure="uniform", rnd=None):
+    """ A list with one ballot dict per voter. """
+    if rnd is None:
+        rnd = random.Random(0)
+    candidates = list(candidates)
+    ballots = []
+    if structure == "uniform":
+        for i in range(voters):
+            ballots.append(dict((c, rnd.randint(1, stars)) for c in candidates))
+    elif structure == "clustered":
+        centres = []
+        for i in range(CLUSTERS):
+            order = list(candidates)
+            rnd.shuffle(order)
+            centres.append(order)
+        for i in range(voters):
+            order = list(rnd.choice(centres))
+            for j in range(len(order) // 3):
+                a = rnd.randrange(len(order) - 1)
+                order[a], order[a + 1] = order[a + 1], order[a]
+            ballots.append(ranking_ballot(order, stars))
+    elif structure == "cycle":
+        size = len(candidates)
+        for i in range(voters):
+            shift = (i % 3) * size // 3
+            order = candidates[shift:] + candidates[:shift]
+            ballots.append(ranking_ballot(order, stars))
+    else:
+        raise ValueError("Unknown ballot structure: %r" % structure)
+    return ballots
+
+
+def count_ballots(ballots):
+    """ (ballot, count) tuples, like Poll.ballots. """
+    counts = {}
+    order = []
+    for ballot in ballots:
+        key = tuple(sorted(ballot.items()))
+        if key not in counts:
+            counts[key] = 0
+            order.append((key, ballot))
+        counts[key] += 1
+    return tuple((ballot, counts[key]) for (key, ballot) in order)
+
+
+def time_ranking(proposals, voters, seats, structure="clustered", seed=0):
+    """ Seconds a Schulze PR ranking of seats from generated ballots takes,
+        without a poll or any caches.
+    """
+    from voteit.schulze.calculation import CompactBallots
+    from voteit.schulze.pr import schulze_pr
+
+    candidates = ["p%suid" % i for i in range(proposals)]
+    ballots = generate_ballots(
+        candidates, voters, structure=structure, rnd=random.Random(seed)
+    )
+    ballots = CompactBallots.from_ballots(count_ballots(ballots))
+    start = time.time()
+    schulze_pr(ballots, seats)
+    return time.time() - start
+
+
+def peak_memory():
+    """ Peak resident memory of this process in kB. """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def setup_poll(config, plugin_name, proposals, ballots, winners=None):
+    """ A poll in the same kind of fixture as the tests, with a vote for
+        each ballot and the ballots counted. Closing it is left to the caller.
+    """
+    from voteit.core.models.agenda_item import AgendaItem
+    from voteit.core.models.meeting import Meeting
+    from voteit.core.models.poll import Poll
+    from voteit.core.models.proposal import Proposal
+    from voteit.core.security import unrestricted_wf_transition_to
+    from voteit.core.testing_helpers import bootstrap_and_fixture
+
+    config.testing_securitypolicy("admin", permissive=True)
+    config.include("pyramid_chameleon")
+    config.include("voteit.schulze")
+    config.include("voteit.core.helpers")
+    config.include("voteit.core.testing_helpers.register_catalog")
+    root = bootstrap_and_fixture(config)
+    root["m"] = Meeting()
+    unrestricted_wf_transition_to(root["m"], "ongoing")
+    root["m"]["ai"] = ai = AgendaItem()
+    unrestricted_wf_transition_to(ai, "upcoming")
+    unrestricted_wf_transition_to(ai, "ongoing")
+    ai["poll"] = poll = Poll()
+    for (i, uid) in enumerate(proposals):
+        proposal = Proposal(creators=["dummy"], text="Proposal %s" % i)
+        proposal.uid = uid
+        ai["p%s" % i] = proposal
+    poll.proposal_uids = tuple(proposals)
+    poll.poll_plugin = plugin_name
+    if winners:
+        poll.poll_settings["winners"] = winners
+    unrestricted_wf_transition_to(poll, "upcoming")
+    vote_class = poll.get_poll_plugin().get_vote_class()
+    for (i, ballot) in enumerate(ballots):
+        vote = vote_class(creators=["voter%s" % i])
+        vote.set_vote_data(ballot, notify=False)
+        poll["v%s" % i] = vote
+    poll.ballots = count_ballots(ballots)
+    return poll
+
+
+def run_case(case):
+    """ Close and render one poll, and return the measurements as a dict. """
+    from arche.views.base import BaseView
+    from pyramid import testing
+    from pyramid.request import apply_request_extensions
+    from pyramid.traversal import find_root
+
+    settings = {
+        "voteit.schulze.result_cache_size": "0",
+        "voteit.schulze.html_cache_size": "0",
+    }
+    if case.get("budget"):
+        settings["voteit.schulze.time_budget"] = str(case["budget"])
+    request = testing.DummyRequest()
+    config = testing.setUp(request=request, settings=settings)
+    try:
+        rnd = random.Random(case["seed"])
+        proposals = ["p%suid" % i for i in range(case["proposals"])]
+        ballots = generate_ballots(
+            proposals, case["voters"], case["stars"], case["structure"], rnd
+        )
+        poll = setup_poll(
+            config, case["plugin"], proposals, ballots, winners=case.get("winners")
+        )
+        plugin = poll.get_poll_plugin()
+        result = dict(case)
+        result["ballots"] = len(poll.ballots)
+        result["baseline_kb"] = peak_memory()
+        start = time.time()
+        plugin.handle_close()
+        result["close_seconds"] = time.time() - start
+        result["close_peak_kb"] = peak_memory()
+        request = testing.DummyRequest()
+        request.root = find_root(poll)
+        request.meeting = request.root["m"]
+        apply_request_extensions(request)
+        view = BaseView(poll, request)
+        start = time.time()
+        plugin.render_result(view)
+        result["render_seconds"] = time.time() - start
+        result["render_peak_kb"] = peak_memory()
+        return result
+    finally:
+        testing.tearDown()
+
+
+def _run_in_child(case, queue):
+    try:
+        queue.put(run_case(case))
+    except Exception as exc:
+        result = dict(case)
+        result["error"] = "%s: %s" % (exc.__class__.__name__, exc)
+        queue.put(result)
+
+
+def run_isolated(case):
+    """ Run case in a forked process, so memory peaks don't carry over.
+
+        A process that dies without reporting, killed for running out of
+        memory for instance, is reported as failed with its exit code.
+    """
+    queue = Queue()
+    child = Process(target=_run_in_child, args=(case, queue))
+    child.start()
+    try:
+        while child.is_alive():
+            try:
+                return queue.get(timeout=POLL_INTERVAL)
+            except Empty:
+                pass
+        try:
+            # The result may have been put just before the process exited
+            return queue.get(timeout=POLL_INTERVAL)
+        except Empty:
+            result = dict(case)
+            result["error"] = "exited with code %s without a result" % child.exitcode
+            return result
+    finally:
+        if child.is_alive():
+            child.terminate()
+        child.join()
+
+
+def iter_cases(options):
+    for plugin in options.plugins:
+        for structure in options.structures:
+            for proposals in options.proposals:
+                for voters in options.voters:
+                    case = {
+                        "plugin": plugin,
+                        "structure": structure,
+                        "proposals": proposals,
+                        "voters": voters,
+                        "stars": options.stars,
+                        "seed": options.seed,
+                        "budget": options.budget,
+                    }
+                    if plugin == "schulze_stv":
+                        case["winners"] = min(options.winners, proposals - 1)
+                    elif plugin == "schulze_pr":
+                        case["winners"] = min(options.seats, proposals)
+                    yield case
+
+
+def _version():
+    try:
+        return pkg_resources.get_distribution("voteit.schulze").version
+    except pkg_resources.DistributionNotFound:
+        return None
+
+
+def _csv(convert):
+    return lambda value: [convert(x) for x in value.split(",") if x]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--plugins", type=_csv(str), default=list(PLUGINS))
+    parser.add_argument("--structures", type=_csv(str), default=list(STRUCTURES))
+    parser.add_argument("--proposals", type=_csv(int), default=[5, 10])
+    parser.add_argument("--voters", type=_csv(int), default=[100, 1000])
+    parser.add_argument("--stars", type=int, default=5)
+    parser.add_argument("--winners", type=int, default=3)
+    parser.add_argument(
+        "--seats", type=int, default=0, help="seats of Schulze PR, 0 ranks all"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--budget", type=int, default=0, help="time budget in seconds per case"
+    )
+    parser.add_argument("--output", type=argparse.FileType("w"), default=sys.stdout)
+    options = parser.parse_args(argv)
+    environment = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "version": _version(),
+    }
+    for case in iter_cases(options):
+        result = run_isolated(case)
+        result.update(environment)
+        options.output.write(json.dumps(result, sort_keys=True) + "\n")
+        options.output.flush()
+
+
+if __name__ == "__main__":
+    main()
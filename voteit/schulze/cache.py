@@ -0,0 +1,291 @@
+""" Cache of poll results, keyed by what the result depends on.
+
+    Closing a poll again with the same ballots, or another poll with
+    identical ballots, candidates and settings, reuses the earlier result
+    instead of calculating it again. Results with ties keep the tie breaker
+    they got the first time.
+
+    Settings:
+
+    voteit.schulze.result_cache_size = 100
+
+    Number of results kept in memory. 0 turns the cache off.
+
+    voteit.schulze.result_cache_dir = %(here)s/var/schulze_results
+
+    Optional directory where results are also stored, so they survive restarts
+    and can be shared between processes.
+
+    voteit.schulze.html_cache_size = 200
+
+    Number of rendered results kept in memory, one per poll and language.
+    0 turns it off.
+
+    voteit.schulze.schema_cache_size = 200
+
+    Number of polls whose vote schema choices, validator and widget are kept
+    in memory. 0 turns it off.
+
+    voteit.schulze.ranking_memo_size = 20
+
+    Number of ballot sets whose Schulze PR positions are kept in memory,
+    see voteit.schulze.pr. 0 turns it off.
+"""
+from collections import OrderedDict
+from hashlib import sha1
+from tempfile import NamedTemporaryFile
+import cPickle
+import logging
+import os
+import threading
+
+from voteit.schulze.settings import get_int
+from voteit.schulze.settings import get_setting
+
+
+logger = logging.getLogger(__name__)
+
+# Part of every key. Bump it whenever what's calculated from the same ballots
+# changes shape or value, so results stored on disk by earlier versions are
+# never used.
+CACHE_VERSION = 5
+
+
+def result_key(ballots, plugin_name, proposals=(), winners=None, ties=None):
+    """ Fingerprint of a calculation from CompactBallots. Ballots are canonical
+        and merged already, so their order is the only thing to normalise.
+        ties is the seed and rule of the tie breaker.
+    """
+    data = (
+        CACHE_VERSION,
+        tuple(ballots.candidates),
+        tuple(sorted(ballots)),
+        tuple(sorted(proposals)),
+        plugin_name,
+        winners,
+        ties,
+    )
+    return sha1(repr(data)).hexdigest()
+
+
+def matrix_key(candidates, d, plugin_name, ties=None, ballots=None):
+    """ Fingerprint of a calculation that only depends on the pairwise matrix.
+        ballots is a ballot_digest, for tie breakers that depend on the
+        ballots as well.
+    """
+    data = (CACHE_VERSION, tuple(candidates), d, plugin_name, ties, ballots)
+    return sha1(repr(data)).hexdigest()
+
+
+# Ballot digests are sums of rank vector hashes modulo this
+DIGEST_MODULUS = 1 << 160
+
+
+def rank_hash(ranks):
+    """ Hash of a canonical rank vector, as an integer. """
+    return int(sha1(repr(tuple(ranks))).hexdigest(), 16)
+
+
+def format_digest(total):
+    return "%x" % (total % DIGEST_MODULUS)
+
+
+def ballot_digest(ballots):
+    """ Fingerprint of CompactBallots or StreamedBallots, read in one pass.
+        Each rank vector adds its hash times its count, so neither the order
+        of the ballots nor how they're merged changes it.
+    """
+    total = 0
+    for (ranks, count) in ballots:
+        total += rank_hash(ranks) * count
+    return format_digest(total)
+
+
+class ResultCache(object):
+    """ Bounded LRU of pickled results, with an optional directory behind it.
+        Results are stored pickled, so every hit is a fresh copy.
+    """
+
+    def __init__(self, size=100, directory=None):
+        self.size = size
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            data = self._data.pop(key, None)
+            if data is not None:
+                self._data[key] = data
+        if data is None:
+            data = self._read(key)
+            if data is not None:
+                self._remember(key, data)
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return cPickle.loads(data)
+
+    def set(self, key, result):
+        data = cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL)
+        self._remember(key, data)
+        self._write(key, data)
+
+    def _remember(self, key, data):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = data
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".pickle")
+
+    def _read(self, key):
+        if not self.directory:
+            return None
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def _write(self, key, data):
+        if not self.directory:
+            return
+        try:
+            with NamedTemporaryFile(dir=self.directory, delete=False) as f:
+                f.write(data)
+            os.rename(f.name, self._path(key))
+        except (IOError, OSError):
+            logger.exception("Couldn't store result %s in %s", key, self.directory)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_result_cache(registry=None):
+    """ The result cache of this process, or None if it's turned off. """
+    global _cache
+    size = get_int("result_cache_size", default=100, registry=registry)
+    if size <= 0:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            directory = get_setting("result_cache_dir", registry=registry)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            _cache = ResultCache(size=size, directory=directory)
+    return _cache
+
+
+def cached_calculation(calculate, key, cache, stats=None):
+    """ Wrap a calculation so it uses cache. Takes and returns the same kind
+        of function as a poll plugin's calculation method.
+        If stats is a dict, 'cache_hit' is set in it on each call.
+    """
+    if cache is None:
+        return calculate
+
+    def cached(budget=None, progress=None):
+        result = cache.get(key)
+        if stats is not None:
+            stats["cache_hit"] = result is not None
+        if result is None:
+            result = calculate(budget=budget, progress=progress)
+            # A fallback result isn't what the key stands for
+            if "fallback" not in result:
+                cache.set(key, result)
+        else:
+            logger.debug("Using cached result %s", key)
+        return result
+
+    return cached
+
+
+def html_key(objects, locale_name):
+    """ Key of a fragment rendered from persistent objects. It changes when
+        any of them is committed again. Objects that aren't stored yet, or have
+        uncommitted changes, can't be cached and give None.
+    """
+    serials = []
+    for obj in objects:
+        if getattr(obj, "_p_jar", None) is None or obj._p_changed:
+            return None
+        serials.append((obj._p_oid, obj._p_serial))
+    return sha1(repr((serials, locale_name))).hexdigest()
+
+
+class MemoryLRU(object):
+    """ Bounded, thread safe LRU of objects kept as they are. The size is
+        given on each set, so it follows the settings.
+    """
+
+    def __init__(self):
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.pop(key, None)
+            if value is not None:
+                self._data[key] = value
+        return value
+
+    def set(self, key, value, size):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > size:
+                self._data.popitem(last=False)
+
+
+_html = MemoryLRU()
+
+
+def cached_html(key, render, *args, **kw):
+    """ Return render(*args, **kw), rendered once per key. """
+    size = get_int("html_cache_size", default=200)
+    if key is None or size <= 0:
+        return render(*args, **kw)
+    html = _html.get(key)
+    if html is None:
+        html = render(*args, **kw)
+        _html.set(key, html, size)
+    return html
+
+
+_schema_parts = MemoryLRU()
+
+
+def get_schema_parts(key):
+    """ Vote schema parts stored with set_schema_parts, or None. """
+    if get_int("schema_cache_size", default=200) <= 0:
+        return None
+    return _schema_parts.get(key)
+
+
+def set_schema_parts(key, parts):
+    size = get_int("schema_cache_size", default=200)
+    if size > 0:
+        _schema_parts.set(key, parts, size)
+
+
+_ranking_memos = MemoryLRU()
+
+
+def get_ranking_memo(key):
+    """ RankingMemo stored with set_ranking_memo, or None. """
+    if get_int("ranking_memo_size", default=20) <= 0:
+        return None
+    return _ranking_memos.get(key)
+
+
+def set_ranking_memo(key, memo):
+    size = get_int("ranking_memo_size", default=20)
+    if size > 0:
+        _ranking_memos.set(key, memo, size)
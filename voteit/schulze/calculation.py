@@ -0,0 +1,523 @@
+""" Calculation engine for Schulze polls.
+
+    Candidates (proposal UIDs) are mapped to integer indices and every ballot
+    is turned into a rank vector. All heavy lifting is then done on plain
+    integer matrices instead of dicts keyed by UID tuples.
+
+    The output of schulze_method is kept identical to what
+    pyvotecore.schulze_method.SchulzeMethod(...).as_dict() returns, since
+    poll results are stored and rendered in that format.
+"""
+from array import array
+from collections import deque
+from multiprocessing import Pool
+import random
+
+
+# Number of ballots in each partial pairwise matrix built by a worker
+SHARD_SIZE = 2000
+
+
+class CalculationTimeout(Exception):
+    """ Raised when a calculation runs out of its time budget. """
+
+
+class CalculationCancelled(Exception):
+    """ Raised within a calculation that has been cancelled. """
+
+
+def index_candidates(ballots):
+    """ Return a sorted tuple of all candidates present in the ballots.
+        Ballots are (ballot, count) tuples, as in Poll.ballots.
+    """
+    candidates = set()
+    for (ballot, count) in ballots:
+        candidates.update(ballot)
+    return tuple(sorted(candidates))
+
+
+def rank_vector(ballot, candidates):
+    """ Turn a ballot dict into a tuple of ranks ordered as candidates.
+        Lower is better. Candidates missing on the ballot get the worst
+        rank + 1, which is what pyvotecore does with the ranking notation.
+    """
+    ranks = [ballot.get(x) for x in candidates]
+    present = [float(x) for x in ranks if x is not None]
+    missing = max(present) + 1 if present else 1.0
+    return tuple(missing if x is None else float(x) for x in ranks)
+
+
+def canonical_ranks(ranks):
+    """ Dense ranking of a rank vector, starting at 1.
+        Only the order matters to every Schulze method, so (1, 3, 3) and
+        (2, 5, 5) are the same ballot: (1, 2, 2).
+    """
+    levels = dict((x, i) for (i, x) in enumerate(sorted(set(ranks)), 1))
+    return tuple(levels[x] for x in ranks)
+
+
+class CompactBallots(object):
+    """ Read-only ballots in a compact form. Each rank vector is canonical and
+        unique, identical ballots are merged by summing their counts.
+        All rank vectors are stored after each other in one array, with a
+        parallel array of counts. Nothing in the calculation layer modifies
+        them, so they never need to be copied.
+
+        Iterating yields (rank vector, count) for each unique ballot.
+    """
+
+    def __init__(self, candidates, ranked_ballots):
+        self.candidates = tuple(candidates)
+        self.source_count = 0
+        grouped = {}
+        order = []
+        for (ranks, count) in ranked_ballots:
+            self.source_count += 1
+            ranks = canonical_ranks(ranks)
+            if ranks in grouped:
+                grouped[ranks] += count
+            else:
+                grouped[ranks] = count
+                order.append(ranks)
+        self._ranks = array("H")
+        self._counts = array("l")
+        for ranks in order:
+            self._ranks.extend(ranks)
+            self._counts.append(grouped[ranks])
+
+    @classmethod
+    def from_ballots(cls, ballots):
+        """ Build from (ballot, count) tuples, as in Poll.ballots. """
+        candidates = index_candidates(ballots)
+        return cls(
+            candidates,
+            ((rank_vector(ballot, candidates), count) for (ballot, count) in ballots),
+        )
+
+    def __len__(self):
+        return len(self._counts)
+
+    def __iter__(self):
+        size = len(self.candidates)
+        ranks = self._ranks
+        for (i, count) in enumerate(self._counts):
+            yield tuple(ranks[i * size : (i + 1) * size]), count
+
+    @property
+    def total(self):
+        """ Total number of voters. """
+        return sum(self._counts)
+
+    @property
+    def compression_ratio(self):
+        """ Unique ballots as a fraction of the number of voters. """
+        total = self.total
+        return total and float(len(self)) / total
+
+    def pairwise(self, processes=0, threshold=0):
+        """ The pairwise matrix, built by processes workers if there are
+            at least threshold unique ballots.
+        """
+        size = len(self.candidates)
+        if processes and len(self) >= threshold:
+            return parallel_pairwise_matrix(self, size, processes)
+        return pairwise_matrix(self, size)
+
+    def as_dicts(self):
+        """ New ballots in the format pyvotecore expects. Since pyvotecore
+            modifies its input, they're created again on each call.
+        """
+        return [
+            {"count": count, "ballot": dict(zip(self.candidates, ranks))}
+            for (ranks, count) in self
+        ]
+
+
+class StreamedBallots(object):
+    """ Ballots that are read one chunk at a time, for calculations that only
+        need the pairwise matrix. Nothing but the current chunk is kept, so
+        building the matrix takes memory for the matrix and one chunk,
+        however many voters there are.
+
+        source is a re-iterable of (ballot, count) tuples, as in Poll.ballots.
+        It's read once for the candidates and voters, and once more for
+        every iteration. Iterating yields (rank vector, count), with identical
+        ballots merged within each chunk.
+    """
+
+    def __init__(self, source, chunk_size=1000):
+        self.source = source
+        self.chunk_size = chunk_size
+        candidates = set()
+        self.total = 0
+        self.source_count = 0
+        for (ballot, count) in source:
+            candidates.update(ballot)
+            self.total += count
+            self.source_count += 1
+        self.candidates = tuple(sorted(candidates))
+
+    def __iter__(self):
+        candidates = self.candidates
+        for chunk in chunks(self.source, self.chunk_size):
+            grouped = {}
+            for (ballot, count) in chunk:
+                ranks = canonical_ranks(rank_vector(ballot, candidates))
+                grouped[ranks] = grouped.get(ranks, 0) + count
+            for item in grouped.items():
+                yield item
+
+    def pairwise(self, processes=0, threshold=0):
+        """ The pairwise matrix, built by processes workers if there are
+            at least threshold ballots.
+        """
+        size = len(self.candidates)
+        if processes and self.source_count >= threshold:
+            return parallel_pairwise_matrix(self, size, processes)
+        return pairwise_matrix(self, size)
+
+
+def chunks(iterable, size):
+    """ Yield lists of at most size items from iterable. """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def pairwise_matrix(ranked_ballots, size):
+    """ Build the pairwise preference matrix.
+        d[i][j] is the number of voters that strictly prefer candidate i over j.
+
+        ranked_ballots is an iterable of (rank vector, count).
+    """
+    d = [[0] * size for i in range(size)]
+    for (ranks, count) in ranked_ballots:
+        fold_ballot(d, ranks, count)
+    return d
+
+
+def parallel_pairwise_matrix(ranked_ballots, size, processes, shard_size=SHARD_SIZE):
+    """ Same as pairwise_matrix, but the ballots are split into shards that
+        are turned into partial matrices by a pool of processes and summed.
+        The counts are integers, so the sum is exactly the serial result.
+        Only a couple of shards per process are read ahead, so streamed
+        ballots stay streamed.
+    """
+    d = [[0] * size for i in range(size)]
+    pending = deque()
+    pool = Pool(processes)
+    try:
+        for shard in chunks(ranked_ballots, shard_size):
+            pending.append(pool.apply_async(pairwise_matrix, (shard, size)))
+            if len(pending) > processes * 2:
+                add_matrix(d, pending.popleft().get())
+        while pending:
+            add_matrix(d, pending.popleft().get())
+    finally:
+        pool.terminate()
+    return d
+
+
+def add_matrix(d, other):
+    """ Add the counts of the matrix other to d. """
+    for (row, other_row) in zip(d, other):
+        for (j, count) in enumerate(other_row):
+            row[j] += count
+
+
+def fold_ballot(d, ranks, count):
+    """ Add count voters with this rank vector to the pairwise matrix d.
+        Use a negative count to remove them again.
+    """
+    indices = range(len(ranks))
+    for i in indices:
+        row = d[i]
+        ri = ranks[i]
+        for j in indices:
+            if ri < ranks[j]:
+                row[j] += count
+
+
+def widest_paths(d):
+    """ Floyd-Warshall variant that calculates the strength of the strongest
+        path between every pair of candidates. Only links where d[i][j] > d[j][i]
+        are part of the graph, and their strength is d[i][j] (winning votes).
+    """
+    size = len(d)
+    indices = range(size)
+    p = [[d[i][j] if d[i][j] > d[j][i] else 0 for j in indices] for i in indices]
+    for k in indices:
+        pk = p[k]
+        for i in indices:
+            if i == k:
+                continue
+            pi = p[i]
+            pik = pi[k]
+            if not pik:
+                continue
+            for j in indices:
+                if j == i or j == k:
+                    continue
+                pkj = pk[j]
+                v = pik if pik < pkj else pkj
+                if v > pi[j]:
+                    pi[j] = v
+    return p
+
+
+def schulze_winners(p, among=None):
+    """ Return the indices of all candidates that aren't beaten by any other
+        candidate according to the strongest path matrix p.
+    """
+    if among is None:
+        among = range(len(p))
+    return [i for i in among if all(p[i][j] >= p[j][i] for j in among)]
+
+
+def smith_set(d):
+    """ Indices of the Smith set of the pairwise matrix d: the smallest group
+        of candidates that each beat every candidate outside it. Its members
+        win more pairs than anyone outside, so it's found among the
+        candidates with the most wins, in O(N^2).
+    """
+    indices = range(len(d))
+    wins = [sum(1 for j in indices if d[i][j] > d[j][i]) for i in indices]
+    order = sorted(indices, key=lambda i: -wins[i])
+    size = min(len(order), 1)
+    i = 0
+    while i < size:
+        x = order[i]
+        for k in range(len(order) - 1, size - 1, -1):
+            y = order[k]
+            if d[x][y] <= d[y][x]:
+                size = k + 1
+                break
+        i += 1
+    return sorted(order[:size])
+
+
+def schulze_ranking(candidates, p, among=None):
+    """ Candidates in Schulze order from the strongest path matrix p: the
+        winners, then the winners among the rest, and so on. The relation is
+        transitive, so that's a complete ranking. Returns a list of lists,
+        each with the candidates that rank equal.
+    """
+    if among is None:
+        among = range(len(candidates))
+    remaining = list(among)
+    ranking = []
+    while remaining:
+        top = set(schulze_winners(p, remaining))
+        ranking.append([candidates[i] for i in remaining if i in top])
+        remaining = [i for i in remaining if i not in top]
+    return ranking
+
+
+def rank_order(ranking, winner, ties=None):
+    """ The ranking as one list, with winner first. Equal candidates are
+        ordered by the TieBreaker ties, if there is one.
+    """
+    ordering = None
+    if ties is not None and any(len(x) > 1 for x in ranking):
+        ordering = dict((c, i) for (i, c) in enumerate(ties.ordering()))
+    order = []
+    for group in ranking:
+        if ordering is not None:
+            group = sorted(group, key=lambda x: ordering.get(x, len(ordering)))
+        order.extend(group)
+    if winner in order:
+        order.remove(winner)
+        order.insert(0, winner)
+    return order
+
+
+def schwartz_actions(d, nodes):
+    """ Replay the Schwartz set heuristic of pyvotecore on the strong pairs
+        within nodes. Returns the actions as index sets and the remaining nodes.
+        This is only used when there's no unbeaten candidate, and only
+        to keep the 'actions' log that pyvotecore stores in the result.
+    """
+    nodes = set(nodes)
+    edges = set(
+        (i, j) for i in nodes for j in nodes if i != j and d[i][j] > d[j][i]
+    )
+    actions = []
+    while edges:
+        succ = dict((x, set()) for x in nodes)
+        for (i, j) in edges:
+            succ[i].add(j)
+        access = {}
+        for x in nodes:
+            seen = set([x])
+            stack = [x]
+            while stack:
+                for y in succ[stack.pop()]:
+                    if y not in seen:
+                        seen.add(y)
+                        stack.append(y)
+            access[x] = seen
+        to_remove = set()
+        for x in nodes:
+            to_remove.update(y for y in access[x] if x not in access[y])
+        if to_remove:
+            actions.append({"nodes": to_remove})
+            nodes -= to_remove
+            edges = set(e for e in edges if e[0] in nodes and e[1] in nodes)
+        else:
+            weakest = min(d[i][j] for (i, j) in edges)
+            removed = set(e for e in edges if d[e[0]][e[1]] == weakest)
+            actions.append({"edges": removed})
+            edges -= removed
+    return actions, nodes
+
+
+def break_ties(tied, candidates, ties=None):
+    """ Pick a winner among tied candidates the way pyvotecore's TieBreaker does.
+        Returns the winner and the ordering used, which is random unless
+        ties is a voteit.schulze.ties.TieBreaker.
+    """
+    if ties is None:
+        ordering = list(candidates)
+        random.shuffle(ordering)
+    else:
+        ordering = ties.ordering()
+    for candidate in ordering:
+        if candidate in tied:
+            return candidate, ordering
+
+
+def schulze_method(ballots):
+    """ Calculate a single winner Schulze result from (ballot, count) tuples.
+        The ballots are never modified.
+    """
+    compact = CompactBallots.from_ballots(ballots)
+    return schulze_result(compact.candidates, compact.pairwise())
+
+
+def schulze_result(candidates, d, paths=None, ties=None, ranking=False):
+    """ Build the result dict from the candidates and their pairwise matrix.
+        paths may be the already known strongest paths for d.
+        ties is the TieBreaker to use, if any.
+        With ranking, the result also has the complete Schulze 'ranking' as
+        groups of equal candidates, and 'order' with every candidate.
+
+        The 'smith_set' is always included, and 'condorcet_winner' if it has
+        one member. The winners are always in the Smith set, and no path
+        between its members goes outside it, so without known paths only the
+        Smith set's strongest paths are calculated.
+    """
+    size = len(candidates)
+    indices = range(size)
+    result = {
+        "candidates": set(candidates),
+        "pairs": dict(
+            ((candidates[i], candidates[j]), d[i][j])
+            for i in indices
+            for j in indices
+            if i != j
+        ),
+        "strong_pairs": dict(
+            ((candidates[i], candidates[j]), d[i][j])
+            for i in indices
+            for j in indices
+            if i != j and d[i][j] > d[j][i]
+        ),
+    }
+    if ranking and paths is None:
+        paths = widest_paths(d)
+    smith = smith_set(d)
+    result["smith_set"] = set(candidates[i] for i in smith)
+    if len(smith) == 1:
+        result["condorcet_winner"] = candidates[smith[0]]
+    # Candidates without any strong pair against them win right away
+    winners = [i for i in smith if not any(d[j][i] > d[i][j] for j in smith)]
+    if not winners:
+        if paths is None:
+            p = widest_paths(submatrix(d, smith))
+            winners = [smith[i] for i in schulze_winners(p)]
+        else:
+            winners = schulze_winners(paths, among=smith)
+        actions, remaining = schwartz_actions(d, indices)
+        result["actions"] = [
+            dict((k, set(_uids(v, candidates))) for (k, v) in action.items())
+            for action in actions
+        ]
+    if len(winners) == 1:
+        result["winner"] = candidates[winners[0]]
+    else:
+        tied = set(candidates[i] for i in winners)
+        result["tied_winners"] = tied
+        result["winner"], result["tie_breaker"] = break_ties(tied, candidates, ties)
+    if ranking:
+        result["ranking"] = schulze_ranking(candidates, paths)
+        result["order"] = rank_order(result["ranking"], result["winner"], ties)
+    return result
+
+
+def submatrix(m, indices):
+    return [[m[i][j] for j in indices] for i in indices]
+
+
+def drop_candidate_paths(p, k):
+    """ Strongest paths between the other candidates when k is removed.
+        That's only the same as p without row and column k when no strongest
+        path depends on k. Returns None when they need to be recalculated.
+    """
+    pk = p[k]
+    keep = [i for i in range(len(p)) if i != k]
+    for i in keep:
+        pi = p[i]
+        pik = pi[k]
+        if not pik:
+            continue
+        for j in keep:
+            if j != i and pi[j] and min(pik, pk[j]) >= pi[j]:
+                return None
+    return submatrix(p, keep)
+
+
+def repeated_schulze(candidates, d, rounds, ties=None):
+    """ Run Schulze rounds on a shrinking part of the pairwise matrix d,
+        removing the winner of each round. Since missing candidates are ranked
+        below everyone else, removing a candidate from the ballots doesn't change
+        how the others compare, so d is never rebuilt.
+
+        ties is the TieBreaker used for every round, if any.
+        Returns a list with the result of each round.
+    """
+    remaining = list(range(len(candidates)))
+    paths = None
+    round_data = []
+    for i in range(rounds):
+        if len(remaining) > 1:
+            sub = submatrix(d, remaining)
+            # Paths between all remaining candidates are only worth keeping
+            # for the next rounds when they're all in the Smith set.
+            # Otherwise schulze_result only needs the Smith set's.
+            if paths is None and len(smith_set(sub)) == len(remaining):
+                paths = widest_paths(sub)
+            res = schulze_result(
+                tuple(candidates[x] for x in remaining), sub, paths=paths, ties=ties
+            )
+            round_data.append(res)
+            k = remaining.index(candidates.index(res["winner"]))
+            if paths is not None:
+                paths = drop_candidate_paths(paths, k)
+            del remaining[k]
+        else:
+            # Only 1 candidate left
+            round_data.append({"winner": candidates[remaining[0]]})
+    return round_data
+
+
+def _uids(items, candidates):
+    for item in items:
+        if isinstance(item, tuple):
+            yield (candidates[item[0]], candidates[item[1]])
+        else:
+            yield candidates[item]
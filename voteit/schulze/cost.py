@@ -0,0 +1,142 @@
+""" Estimates of how long closing a poll will take.
+
+    Each method has a cost model in seconds for one core, based on the number
+    of proposals N, expected voters V, winners W and the number of stars the
+    voters can choose from. Voters are taken as unique ballots, which is the
+    worst case.
+
+    Schulze             a * V * N^2 + b * N^3
+    Repeated Schulze    a * V * N^2 + b * (N^3 + (N-1)^3 + ...) for each round
+    Schulze STV         c * C(N, W+1) * (W+1) * V * 2^W * (N / stars)^2
+    Schulze PR          d * V * N^6 * (N / stars), times the share of the
+                        positions up to S seats, where position k weighs
+                        (N - k)^2 * g^k
+
+    The fewer stars there are, the more ties, and ties are what makes STV and
+    PR expensive. The constants were fitted to the timings in CALIBRATION,
+    made with voteit.schulze.benchmark's uniform ballots on one core. Every
+    estimate is within a factor of 2.5 of those, so take them as the order of
+    magnitude.
+
+    Settings, in estimated seconds:
+
+    voteit.schulze.cost_warning = 60
+    voteit.schulze.cost_limit = 0
+
+    Polls estimated above the warning are started with a warning. Polls above
+    the limit can't be started, and the settings that would put them there
+    can't be saved. 0 turns either off.
+
+    Until voters are known, voteit.schulze.expected_voters is used
+    (default 100).
+"""
+from voteit.schulze.settings import get_int
+from voteit.schulze.stv import ncr
+
+
+SCHULZE_FOLD = 3.5e-7
+SCHULZE_PATHS = 1.2e-6
+STV_UNIT = 5e-7
+PR_UNIT = 8e-10
+# How much more a Schulze PR position costs than the one before it
+RANKING_GROWTH = 1.5
+
+# (method, proposals, voters, winners, stars, measured seconds)
+CALIBRATION = (
+    ("schulze", 10, 10000, 0, 5, 0.307),
+    ("schulze", 30, 2000, 0, 5, 0.696),
+    ("schulze", 60, 500, 0, 5, 0.818),
+    ("schulze", 100, 200, 0, 5, 1.768),
+    ("stv", 10, 200, 2, 5, 0.259),
+    ("stv", 10, 200, 3, 5, 1.193),
+    ("stv", 10, 200, 4, 5, 3.448),
+    ("stv", 14, 200, 3, 5, 16.944),
+    ("stv", 14, 200, 4, 5, 192.995),
+    ("pr", 10, 200, 0, 5, 0.373),
+    ("pr", 12, 200, 0, 5, 1.172),
+    ("pr", 14, 200, 0, 5, 2.714),
+    ("pr", 16, 200, 0, 5, 8.798),
+    ("pr", 18, 200, 0, 5, 17.523),
+    ("pr", 14, 200, 0, 2, 7.986),
+    ("pr", 14, 200, 0, 14, 1.11),
+    ("pr", 14, 200, 12, 5, 2.76),
+    ("pr", 16, 200, 12, 5, 5.18),
+    ("pr", 20, 200, 6, 5, 1.59),
+    ("pr", 20, 200, 12, 5, 13.9),
+)
+
+WARN = "warn"
+REFUSE = "refuse"
+
+
+def vote_stars(proposals, max_stars=5, min_stars=5):
+    """ Number of stars voters can choose from, as in the vote schema. """
+    stars = proposals
+    if max_stars < stars:
+        stars = max_stars
+    if min_stars > stars:
+        stars = min_stars
+    return max(stars, 1)
+
+
+def schulze_cost(proposals, voters):
+    return SCHULZE_FOLD * voters * proposals ** 2 + SCHULZE_PATHS * proposals ** 3
+
+
+def repeated_schulze_cost(proposals, voters, winners=0):
+    rounds = winners and min(winners, proposals) or proposals
+    paths = sum((proposals - i) ** 3 for i in range(rounds))
+    return SCHULZE_FOLD * voters * proposals ** 2 + SCHULZE_PATHS * paths
+
+
+def stv_cost(proposals, voters, winners, stars=5):
+    if winners >= proposals:
+        return 0.0
+    ties = max(float(proposals) / stars, 1.0)
+    sets = ncr(proposals, winners + 1)
+    return STV_UNIT * sets * (winners + 1) * voters * 2 ** winners * ties ** 2
+
+
+def pr_cost(proposals, voters, stars=5, seats=0):
+    ties = max(float(proposals) / stars, 1.0)
+    if not seats or seats > proposals:
+        seats = proposals
+    weights = [
+        (proposals - k) ** 2 * RANKING_GROWTH ** k for k in range(proposals)
+    ]
+    share = sum(weights[:seats]) / max(sum(weights), 1)
+    return PR_UNIT * voters * proposals ** 6 * ties * share
+
+
+def check_cost(seconds, registry=None):
+    """ REFUSE, WARN or None for an estimate in seconds. """
+    limit = get_int("cost_limit", registry=registry)
+    if limit and seconds > limit:
+        return REFUSE
+    warning = get_int("cost_warning", default=60, registry=registry)
+    if warning and seconds > warning:
+        return WARN
+
+
+def format_duration(seconds):
+    """ Rounded, readable duration. """
+    if seconds < 60:
+        return "%d s" % max(round(seconds), 1)
+    if seconds < 3600:
+        return "%d min" % round(seconds / 60)
+    if seconds < 86400 * 2:
+        return "%d h" % round(seconds / 3600)
+    return "%d days" % round(seconds / 86400)
+
+
+def estimate(method, proposals, voters, winners=0, stars=5):
+    """ Estimated seconds by the name used in CALIBRATION. """
+    if method == "schulze":
+        return schulze_cost(proposals, voters)
+    if method == "repeated":
+        return repeated_schulze_cost(proposals, voters, winners)
+    if method == "stv":
+        return stv_cost(proposals, voters, winners, stars)
+    if method == "pr":
+        return pr_cost(proposals, voters, stars, winners)
+    raise ValueError("Unknown method: %r" % method)
@@ -0,0 +1,333 @@
+""" Deferred closing of Schulze polls.
+
+    Calculating an STV or PR result may take longer than a request should.
+    When enabled, closing those polls only takes a snapshot of the ballots and
+    hands the calculation to a worker thread once the closing is committed.
+    The poll is closed right away and marked as calculating. When the
+    calculation is done, the worker stores the result and changes the proposal
+    states in a transaction of its own. Meanwhile the result view polls the
+    status view for the progress.
+
+    Enable it with:
+
+    voteit.schulze.deferred_close = true
+
+    Optional settings:
+
+    voteit.schulze.deferred_workers = 1
+    voteit.schulze.deferred_time_budget = 600
+
+    The time budget is in seconds and defaults to voteit.schulze.time_budget.
+
+    Running calculations live in the memory of the process that started them,
+    so this requires a single process server, like waitress. With more
+    processes, a status request served by another process can't find the
+    calculation, and marks it as failed. A calculation that can't be found
+    anymore, for instance after a restart, is marked as failed and can be
+    started again.
+"""
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+from uuid import uuid4
+import logging
+import threading
+
+from persistent import Persistent
+from pyramid.request import Request
+from pyramid.request import apply_request_extensions
+from pyramid.threadlocal import get_current_registry
+from pyramid.threadlocal import manager
+from pyramid.traversal import find_root
+from voteit.core.security import unrestricted_wf_transition_to
+import transaction
+
+from voteit.schulze import _
+from voteit.schulze.calculation import CalculationCancelled
+from voteit.schulze.calculation import CalculationTimeout
+from voteit.schulze.isolated import MEMORY
+from voteit.schulze.isolated import MEMORY_LIMIT_MSG
+from voteit.schulze.isolated import CalculationLimitExceeded
+from voteit.schulze.settings import get_bool
+from voteit.schulze.settings import get_int
+
+
+logger = logging.getLogger(__name__)
+
+CALCULATION_ATTR = "_schulze_calculation"
+
+CALCULATING = "calculating"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+TIMEOUT_MSG = _(
+    "deferred_timeout_error",
+    default="The result took too long to calculate. "
+    "Try again with fewer winners or proposals.",
+)
+FAILED_MSG = _(
+    "deferred_failed_error",
+    default="The result couldn't be calculated. You may try again.",
+)
+INTERRUPTED_MSG = _(
+    "deferred_interrupted_error",
+    default="The calculation was interrupted. You may try again.",
+)
+CANCELLED_MSG = _("deferred_cancelled", default="The calculation was cancelled.")
+# Times to try storing a result when the transaction conflicts
+STORE_ATTEMPTS = 3
+
+
+class CalculationStatus(Persistent):
+    """ Stored on a poll that is, or was, calculated in the background. """
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.state = CALCULATING
+        self.message = u""
+        self.started = datetime.utcnow()
+        self.finished = None
+
+    def finish(self, state, message=u""):
+        self.state = state
+        self.message = message
+        self.finished = datetime.utcnow()
+
+
+class CalculationJob(object):
+    """ A calculation running in a worker thread.
+
+        calculate is called with the keyword arguments budget and progress.
+        It must only work on the snapshot it was created with, never on the poll.
+        When the poll is stored in a database, the result is stored on it
+        through a connection of the worker's own.
+    """
+
+    def __init__(self, calculate, budget=None):
+        self.id = uuid4().hex
+        self.db = None
+        self.poll_oid = None
+        self.registry = None
+        self.calculate = calculate
+        self.budget = budget
+        self.done = 0
+        self.total = 0
+        self.result = None
+        self.state = CALCULATING
+        self.message = u""
+        self.cancelled = False
+        self.finished = threading.Event()
+
+    def progress(self, done, total):
+        if self.cancelled:
+            raise CalculationCancelled()
+        self.done = done
+        self.total = total
+
+    def run(self):
+        try:
+            if self.cancelled:
+                raise CalculationCancelled()
+            self.result = self.calculate(budget=self.budget, progress=self.progress)
+            self.state = DONE
+        except CalculationTimeout:
+            self.state, self.message = FAILED, TIMEOUT_MSG
+        except CalculationLimitExceeded as exc:
+            self.state = FAILED
+            self.message = exc.limit == MEMORY and MEMORY_LIMIT_MSG or TIMEOUT_MSG
+        except CalculationCancelled:
+            self.state, self.message = CANCELLED, CANCELLED_MSG
+        except Exception:
+            logger.exception("Calculation %s failed", self.id)
+            self.state, self.message = FAILED, FAILED_MSG
+        finally:
+            self.finished.set()
+
+    def cancel(self):
+        self.cancelled = True
+
+
+_jobs = {}
+_pool = None
+_lock = threading.Lock()
+
+
+def submit(job, workers=1):
+    """ Queue job in the worker pool, which is created on first use. """
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = ThreadPool(max(workers, 1))
+        _jobs[job.id] = job
+    _pool.apply_async(_work, (job,))
+    return job
+
+
+def _work(job):
+    job.run()
+    if job.db is not None:
+        store_result(job)
+
+
+def _submit_committed(committed, job, workers):
+    if committed:
+        submit(job, workers=workers)
+
+
+def store_result(job):
+    """ Store what job came to on its poll, in a transaction of its own,
+        and forget the job. Runs in the worker thread.
+    """
+    tm = transaction.TransactionManager()
+    conn = job.db.open(transaction_manager=tm)
+    request = Request.blank("/")
+    request.registry = job.registry
+    apply_request_extensions(request)
+    manager.push({"registry": job.registry, "request": request})
+    try:
+        for attempt in tm.attempts(STORE_ATTEMPTS):
+            with attempt:
+                poll = conn.get(job.poll_oid)
+                request.root = find_root(poll)
+                finish_calculation(poll, job)
+    except Exception:
+        logger.exception("Calculation %s: the result couldn't be stored", job.id)
+    finally:
+        manager.pop()
+        conn.close()
+        with _lock:
+            _jobs.pop(job.id, None)
+
+
+def get_job(job_id):
+    return _jobs.get(job_id)
+
+
+def deferred_enabled(registry=None):
+    return get_bool("deferred_close", registry=registry)
+
+
+def get_status(poll):
+    return getattr(poll, CALCULATION_ATTR, None)
+
+
+def is_calculating(poll):
+    status = get_status(poll)
+    return status is not None and status.state == CALCULATING
+
+
+def clear_calculation(poll):
+    """ Forget any earlier background calculation, when poll is closed again. """
+    if get_status(poll) is not None:
+        setattr(poll, CALCULATION_ATTR, None)
+
+
+def start_calculation(poll, calculate, registry=None):
+    """ Start calculating the result of poll in the background.
+        calculate is what the poll plugin's get_calculation method returned.
+    """
+    budget = get_int(
+        "deferred_time_budget",
+        default=get_int("time_budget", registry=registry),
+        registry=registry,
+    )
+    job = CalculationJob(calculate, budget=budget)
+    workers = get_int("deferred_workers", default=1, registry=registry)
+    jar = getattr(poll, "_p_jar", None)
+    if jar is None:
+        submit(job, workers=workers)
+    else:
+        # The worker stores the result through a connection of its own,
+        # so it may only start once the closed poll is committed.
+        job.db = jar.db()
+        job.poll_oid = poll._p_oid
+        job.registry = registry or get_current_registry()
+        jar.transaction_manager.get().addAfterCommitHook(
+            _submit_committed, args=(job, workers)
+        )
+    status = CalculationStatus(job.id)
+    setattr(poll, CALCULATION_ATTR, status)
+    logger.info("Poll %s: calculating result in the background", poll.uid)
+    return status
+
+
+def finish_calculation(poll, job, request=None):
+    """ Store the result of the finished job and change the proposal states,
+        the same way closing the poll would have. Nothing is changed if the
+        calculation of poll was cancelled or started again meanwhile.
+    """
+    status = get_status(poll)
+    if status is None or status.job_id != job.id or status.state != CALCULATING:
+        return status
+    status.finish(job.state, job.message)
+    if job.state == DONE:
+        poll.get_poll_plugin().set_result(job.result)
+        apply_proposal_states(poll, request)
+    return status
+
+
+def update_calculation(poll, request):
+    """ Check the calculation of poll, and finish it if the worker hasn't
+        stored it yet. Returns the status, or None if poll was never deferred.
+    """
+    status = get_status(poll)
+    if status is None or status.state != CALCULATING:
+        return status
+    job = get_job(status.job_id)
+    if job is None:
+        status.finish(FAILED, INTERRUPTED_MSG)
+    elif job.finished.is_set():
+        _jobs.pop(job.id, None)
+        finish_calculation(poll, job, request)
+    return status
+
+
+def cancel_calculation(poll):
+    """ Stop calculating. The poll stays closed without a result,
+        and the proposals are left as they are, until it's started again.
+    """
+    status = get_status(poll)
+    if status is None or status.state != CALCULATING:
+        return status
+    job = _jobs.pop(status.job_id, None)
+    if job is not None:
+        job.cancel()
+    status.finish(CANCELLED, CANCELLED_MSG)
+    return status
+
+
+def restart_calculation(poll, request):
+    """ Start over from the ballots stored when the poll was closed. """
+    status = get_status(poll)
+    if status is not None and status.state in (DONE, CALCULATING):
+        return status
+    plugin = poll.get_poll_plugin()
+    return start_calculation(poll, plugin.get_calculation(), registry=request.registry)
+
+
+def calculation_progress(poll):
+    """ Status as a dict, for the status view. """
+    status = get_status(poll)
+    if status is None:
+        return {}
+    data = {"state": status.state, "message": status.message, "done": 0, "total": 0}
+    job = get_job(status.job_id)
+    if job is not None:
+        data["done"] = job.done
+        data["total"] = job.total
+    return data
+
+
+def apply_proposal_states(poll, request=None):
+    """ Without a request, in the worker, the states are changed without
+        checking permissions. The moderator closing the poll had them.
+    """
+    proposals = dict((x.uid, x) for x in poll.get_proposal_objects())
+    for (uid, state) in poll.get_poll_plugin().change_states_of().items():
+        proposal = proposals[uid]
+        if proposal.get_workflow_state() == state:
+            continue
+        if request is None:
+            unrestricted_wf_transition_to(proposal, state)
+        else:
+            proposal.set_workflow_state(request, state)
@@ -0,0 +1,241 @@
+""" Calculations in a separate process with resource limits.
+
+    A Schulze STV or PR calculation that runs away can use all the memory of
+    the server, and take every meeting on it down with the web worker. When
+    enabled, those calculations run in a forked process instead, with limits
+    on its memory and CPU time, and a wall clock timeout. The web worker only
+    waits for the result and passes on the progress.
+
+    When a limit is hit, the poll stays open with an error, the same way as
+    when it runs out of its time budget. With fallback enabled, the result is
+    ordered by Repeated Schulze instead, which is cheap, and the result says
+    so in 'fallback'.
+
+    voteit.schulze.isolated_close = false
+
+    Optional settings:
+
+    voteit.schulze.memory_limit = 0
+        Memory in MB the calculation may use, on top of what the process had
+        when it was forked.
+    voteit.schulze.cpu_limit = 0
+        CPU seconds the calculation may use.
+    voteit.schulze.time_limit = 0
+        Seconds to wait for the calculation before it's stopped.
+    voteit.schulze.fallback = false
+
+    0 turns a limit off.
+
+    A process that exits without reporting counts as hitting the memory limit
+    if it was killed or failed with a MemoryError while one was set, and the
+    CPU limit if it was killed while that was set. Anything else raises
+    CalculationCrashed.
+
+    This requires fork, so it only works on Unix. It can't be combined with
+    deferred closing (voteit.schulze.deferred_close): the process would then
+    be forked from a worker thread, and may inherit locks other threads hold,
+    so it can hang.
+"""
+from multiprocessing import Pipe
+from multiprocessing import Process
+import os
+import resource
+import signal
+import time
+
+from voteit.schulze import _
+from voteit.schulze.calculation import CalculationTimeout
+from voteit.schulze.settings import get_bool
+from voteit.schulze.settings import get_int
+
+
+MEMORY = "memory"
+CPU = "cpu"
+TIME = "time"
+
+MEMORY_LIMIT_MSG = _(
+    "memory_limit_error",
+    default="The result needed more memory than allowed, so the poll is still "
+    "open. Try again with fewer winners or proposals.",
+)
+CRASHED_MSG = _(
+    "calculation_crashed_error",
+    default="The result calculation stopped unexpectedly, so the poll is still "
+    "open. Try again, or contact the administrator if it happens again.",
+)
+# Method used when a calculation hits a limit
+FALLBACK = "sorted_schulze"
+# Seconds between checks of the calculating process
+POLL_INTERVAL = 0.5
+# CPU seconds between SIGXCPU and SIGKILL
+CPU_GRACE = 5
+# Bytes set aside before the memory limit, and freed to report hitting it
+RESERVE = 1024 * 1024
+# Exit code of a calculating process that ran out of memory
+MEMORY_EXIT = 3
+
+
+class CalculationLimitExceeded(Exception):
+    """ Raised when a calculation hits one of its resource limits. limit is
+        MEMORY, CPU or TIME.
+    """
+
+    def __init__(self, limit):
+        Exception.__init__(self, limit)
+        self.limit = limit
+
+
+class CalculationCrashed(Exception):
+    """ Raised when a calculating process exits without reporting, for
+        another reason than a limit. exitcode is the process' exit code.
+    """
+
+    def __init__(self, exitcode):
+        Exception.__init__(self, exitcode)
+        self.exitcode = exitcode
+
+
+def isolation_enabled(registry=None):
+    return get_bool("isolated_close", registry=registry)
+
+
+def address_space():
+    """ Bytes of address space this process uses, or 0 if it's unknown. """
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[0])
+    except (IOError, ValueError, IndexError):
+        return 0
+    return pages * resource.getpagesize()
+
+
+def set_limits(memory=0, cpu=0):
+    """ Limit the current process to memory MB more than it uses now,
+        and cpu seconds of CPU time.
+    """
+    if memory:
+        _lower_limit(resource.RLIMIT_AS, address_space() + memory * 1024 * 1024)
+    if cpu:
+        used = resource.getrusage(resource.RUSAGE_SELF)
+        used = int(used.ru_utime + used.ru_stime)
+        _lower_limit(resource.RLIMIT_CPU, used + cpu, used + cpu + CPU_GRACE)
+
+
+def _lower_limit(which, soft, hard=None):
+    (current_soft, current_hard) = resource.getrlimit(which)
+    if hard is None:
+        hard = soft
+    if current_hard != resource.RLIM_INFINITY:
+        hard = min(hard, current_hard)
+        soft = min(soft, hard)
+    resource.setrlimit(which, (soft, hard))
+
+
+def _child(conn, calculate, budget, memory, cpu):
+    reserve = bytearray(RESERVE)
+    exitcode = 0
+    try:
+        set_limits(memory, cpu)
+
+        def progress(done, total):
+            conn.send(("progress", (done, total)))
+
+        result = calculate(budget=budget, progress=progress)
+        conn.send(("done", result))
+    except MemoryError:
+        del reserve
+        exitcode = MEMORY_EXIT
+        conn.send(("limit", MEMORY))
+    except CalculationTimeout as exc:
+        conn.send(("timeout", exc.args))
+    except Exception as exc:
+        conn.send(("error", "%s: %s" % (exc.__class__.__name__, exc)))
+    finally:
+        conn.close()
+        # Don't run anything the web worker registered to run at exit
+        os._exit(exitcode)
+
+
+def run_isolated(calculate, budget=None, progress=None, memory=0, cpu=0, timeout=0):
+    """ Return calculate(budget=budget, progress=...) calculated in a forked
+        process, with the limits memory in MB, cpu in seconds and timeout in
+        seconds. progress is called here with what the calculation reports.
+
+        Raises CalculationLimitExceeded when a limit is hit, and
+        CalculationCrashed when the process exits without reporting for
+        another reason. CalculationTimeout, and anything progress raises,
+        work as usual.
+    """
+    (parent_conn, child_conn) = Pipe(duplex=False)
+    child = Process(target=_child, args=(child_conn, calculate, budget, memory, cpu))
+    child.start()
+    child_conn.close()
+    deadline = timeout and time.time() + timeout or None
+    try:
+        while True:
+            if parent_conn.poll(POLL_INTERVAL):
+                try:
+                    (kind, data) = parent_conn.recv()
+                except EOFError:
+                    child.join()
+                    raise _exit_error(child.exitcode, memory, cpu)
+                if kind == "progress":
+                    if progress is not None:
+                        progress(*data)
+                elif kind == "done":
+                    return data
+                elif kind == "limit":
+                    raise CalculationLimitExceeded(data)
+                elif kind == "timeout":
+                    raise CalculationTimeout(*data)
+                else:
+                    raise RuntimeError(data)
+            elif not child.is_alive() and not parent_conn.poll():
+                raise _exit_error(child.exitcode, memory, cpu)
+            if deadline is not None and time.time() > deadline:
+                raise CalculationLimitExceeded(TIME)
+    finally:
+        parent_conn.close()
+        if child.is_alive():
+            child.terminate()
+        child.join()
+
+
+def _exit_error(exitcode, memory, cpu):
+    if cpu and exitcode in (-signal.SIGXCPU, -signal.SIGKILL):
+        return CalculationLimitExceeded(CPU)
+    if memory and exitcode in (MEMORY_EXIT, -signal.SIGKILL):
+        return CalculationLimitExceeded(MEMORY)
+    return CalculationCrashed(exitcode)
+
+
+def guarded_calculation(calculate, fallback=None, registry=None):
+    """ calculate, run in a separate process with the configured limits.
+        fallback is a calculation to use instead when a limit is hit,
+        if fallback is enabled. The limits are read here, since the
+        calculation may run in a thread without the settings.
+    """
+    memory = get_int("memory_limit", registry=registry)
+    cpu = get_int("cpu_limit", registry=registry)
+    timeout = get_int("time_limit", registry=registry)
+    if not get_bool("fallback", registry=registry):
+        fallback = None
+
+    def guarded(budget=None, progress=None):
+        try:
+            return run_isolated(
+                calculate,
+                budget=budget,
+                progress=progress,
+                memory=memory,
+                cpu=cpu,
+                timeout=timeout,
+            )
+        except CalculationLimitExceeded as exc:
+            if fallback is None:
+                raise
+            result = fallback(budget=budget, progress=progress)
+            result["fallback"] = {"method": FALLBACK, "limit": exc.limit}
+            return result
+
+    return guarded
@@ -0,0 +1,177 @@
+""" Timing of the phases of closing and rendering Schulze polls.
+
+    Each phase emits an event, a dict with at least 'phase', 'duration' in
+    seconds and whatever is known about it, like 'plugin', 'poll', 'voters',
+    'ballots', 'unique_ballots', 'candidates', 'winners' and 'cache_hit'.
+    Events go to the metrics sink registered in the Pyramid registry.
+    Without a sink, nothing is timed or collected.
+
+    To log every event:
+
+    voteit.schulze.metrics = logging
+
+    Or register any callable that takes an event:
+
+    config.set_schulze_metrics_sink(sink)
+"""
+import logging
+import threading
+import time
+
+from pyramid.threadlocal import get_current_registry
+from zope.interface import Interface
+
+from voteit.schulze.settings import get_setting
+
+
+logger = logging.getLogger(__name__)
+
+
+class IMetricsSink(Interface):
+    """ Callable that receives each event dict. """
+
+
+class LoggingSink(object):
+    """ Log every event on the info level. """
+
+    def __init__(self, logger=logger):
+        self.logger = logger
+
+    def __call__(self, event):
+        self.logger.info(
+            "%s %.4fs %s",
+            event["phase"],
+            event["duration"],
+            " ".join(
+                "%s=%s" % item
+                for item in sorted(event.items())
+                if item[0] not in ("phase", "duration")
+            ),
+        )
+
+
+class MemorySink(object):
+    """ Keep every event in a list, mostly for tests. """
+
+    def __init__(self):
+        self.events = []
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        with self._lock:
+            self.events.append(event)
+
+    def phases(self):
+        return [x["phase"] for x in self.events]
+
+
+SINKS = {"logging": LoggingSink, "memory": MemorySink}
+
+
+def get_sink(registry=None):
+    if registry is None:
+        registry = get_current_registry()
+    return registry.queryUtility(IMetricsSink)
+
+
+def set_metrics_sink(config, sink):
+    """ Config directive that registers sink, or removes the current one
+        when sink is None.
+    """
+    if sink is None:
+        config.registry.unregisterUtility(provided=IMetricsSink)
+    else:
+        config.registry.registerUtility(sink, IMetricsSink)
+
+
+class Phase(object):
+    """ Context manager that times a phase and emits its event on exit. """
+
+    def __init__(self, sink, name, data):
+        self.sink = sink
+        self.data = data
+        self.data["phase"] = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.data["duration"] = time.time() - self.start
+        if exc_type is not None:
+            self.data["error"] = exc_type.__name__
+        try:
+            self.sink(dict(self.data))
+        except Exception:
+            logger.exception("Metrics sink %r failed", self.sink)
+        return False
+
+    def update(self, **kw):
+        self.data.update(kw)
+
+    def wrap(self, calculate):
+        """ Time a calculation function, wherever it's called later. """
+
+        def timed(budget=None, progress=None):
+            with self:
+                result = calculate(budget=budget, progress=progress)
+                self.data["winners"] = count_winners(result)
+            return result
+
+        return timed
+
+
+class NullPhase(object):
+    """ What phase returns without a sink. It does nothing. """
+
+    data = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def update(self, **kw):
+        pass
+
+    def wrap(self, calculate):
+        return calculate
+
+
+NULL_PHASE = NullPhase()
+
+
+def phase(name, registry=None, **data):
+    """ A Phase for name with the event data, or NULL_PHASE without a sink. """
+    sink = get_sink(registry)
+    if sink is None:
+        return NULL_PHASE
+    return Phase(sink, name, data)
+
+
+def ballot_data(ballots):
+    """ Event data about CompactBallots or StreamedBallots. """
+    data = {
+        "voters": ballots.total,
+        "ballots": ballots.source_count,
+        "candidates": len(ballots.candidates),
+    }
+    if hasattr(ballots, "__len__"):
+        data["unique_ballots"] = len(ballots)
+    return data
+
+
+def count_winners(result):
+    if "winners" in result:
+        return len(result["winners"])
+    if "order" in result:
+        return len(result["order"])
+    return int(bool(result.get("winner")))
+
+
+def includeme(config):
+    config.add_directive("set_schulze_metrics_sink", set_metrics_sink)
+    name = get_setting("metrics", registry=config.registry)
+    if name:
+        config.set_schulze_metrics_sink(SINKS[name]())
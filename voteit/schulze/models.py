@@ -1,19 +1,100 @@
-from copy import deepcopy
 from decimal import Decimal
+import logging
 
+from pyramid.exceptions import ConfigurationError
 from pyramid.httpexceptions import HTTPForbidden
 from pyramid.renderers import render
 from pyramid.response import Response
-from pyvotecore.schulze_method import SchulzeMethod
-from pyvotecore.schulze_pr import SchulzePR
-from pyvotecore.schulze_stv import SchulzeSTV
+from pyramid.threadlocal import get_current_request
 from voteit.core.models import poll_plugin
+from voteit.core.models.interfaces import IVote
+from voteit.core.security import MODERATE_MEETING
+from voteit.core.security import ROLE_VOTER
+from voteit.core.security import find_role_userids
 import colander
-import deform
 
+from voteit.schulze.cache import ballot_digest
+from voteit.schulze.cache import cached_calculation
+from voteit.schulze.cache import cached_html
+from voteit.schulze.cache import get_ranking_memo
+from voteit.schulze.cache import get_result_cache
+from voteit.schulze.cache import get_schema_parts
+from voteit.schulze.cache import html_key
+from voteit.schulze.cache import matrix_key
+from voteit.schulze.cache import result_key
+from voteit.schulze.cache import set_ranking_memo
+from voteit.schulze.cache import set_schema_parts
+from voteit.schulze.calculation import CalculationTimeout
+from voteit.schulze.calculation import CompactBallots
+from voteit.schulze.calculation import StreamedBallots
+from voteit.schulze.calculation import repeated_schulze
+from voteit.schulze.calculation import schulze_result
+from voteit.schulze.calculation import widest_paths
+from voteit.schulze.cost import REFUSE
+from voteit.schulze.cost import WARN
+from voteit.schulze.cost import check_cost
+from voteit.schulze.cost import format_duration
+from voteit.schulze.cost import pr_cost
+from voteit.schulze.cost import repeated_schulze_cost
+from voteit.schulze.cost import schulze_cost
+from voteit.schulze.cost import stv_cost
+from voteit.schulze.cost import vote_stars
+from voteit.schulze.deferred import DONE
+from voteit.schulze.deferred import clear_calculation
+from voteit.schulze.deferred import deferred_enabled
+from voteit.schulze.deferred import is_calculating
+from voteit.schulze.deferred import start_calculation
+from voteit.schulze.deferred import update_calculation
+from voteit.schulze.isolated import CRASHED_MSG
+from voteit.schulze.isolated import MEMORY
+from voteit.schulze.isolated import MEMORY_LIMIT_MSG
+from voteit.schulze.isolated import CalculationCrashed
+from voteit.schulze.isolated import CalculationLimitExceeded
+from voteit.schulze.isolated import guarded_calculation
+from voteit.schulze.isolated import isolation_enabled
+from voteit.schulze.metrics import ballot_data
+from voteit.schulze.metrics import phase
+from voteit.schulze.pr import RankingMemo
+from voteit.schulze.pr import schulze_pr
+from voteit.schulze.results import DISPLAY_ATTR
+from voteit.schulze.results import DisplayModel
+from voteit.schulze.results import PairwiseResult
 from voteit.schulze.schemas import SettingsSchema
 from voteit.schulze import _
-from voteit.schulze.schemas import SchulzePollSchema
+from voteit.schulze.schemas import VoteSchemaParts
+from voteit.schulze.settings import get_int
+from voteit.schulze.stv import schulze_stv
+from voteit.schulze.tally import attach_tally
+from voteit.schulze.tally import get_pairwise
+from voteit.schulze.tally import tally_enabled
+from voteit.schulze.ties import RANDOM_BALLOT
+from voteit.schulze.ties import TieBreaker
+from voteit.schulze.ties import get_tie_rule
+from voteit.schulze.ties import poll_seed
+
+
+logger = logging.getLogger(__name__)
+
+CALCULATION_TIMEOUT_MSG = _(
+    "calculation_timeout_error",
+    default="The result took too long to calculate, so the poll is still open. "
+    "Try again with fewer winners or proposals.",
+)
+
+COST_LIMIT_MSG = _(
+    "cost_limit_error",
+    default="The result of this poll is estimated to take ${duration} "
+    "to calculate, which is more than allowed. Use fewer proposals or winners.",
+)
+PROPOSALS_LIMIT_MSG = _(
+    "proposals_limit_error",
+    default="This poll can only be calculated while you wait with at most "
+    "${count} proposals. Use fewer proposals.",
+)
+COST_WARNING_MSG = _(
+    "cost_warning",
+    default="The result of this poll is estimated to take ${duration} to calculate.",
+)
 
 
 def format_ranking(pairs):
@@ -33,6 +114,59 @@ def format_ranking(pairs):
     return results
 
 
+def pair_percentages(pairs, total_votes):
+    """ Integer percentages of the voters that prefer either proposal of each
+        pair, or consider them equal. pairs is the output of format_ranking.
+        Returns a nested dict like pairs, where each item is a dict with the keys
+        of both proposals and 'equal'.
+    """
+    result = {}
+    for (primary_uid, others) in pairs.items():
+        row = result[primary_uid] = {}
+        for vs_uid in others:
+            primary = Decimal(pairs[primary_uid][vs_uid])
+            vs = Decimal(pairs[vs_uid][primary_uid])
+            perc = {}
+            try:
+                perc[primary_uid] = int(round(primary / total_votes * 100))
+            except ZeroDivisionError:
+                perc[primary_uid] = 0
+            try:
+                perc[vs_uid] = int(round(vs / total_votes * 100))
+            except ZeroDivisionError:
+                perc[vs_uid] = 0
+            perc["equal"] = 100 - perc[primary_uid] - perc[vs_uid]
+            row[vs_uid] = perc
+    return result
+
+
+def display_model(poll_result, proposal_uids, total_votes):
+    """ Everything result_schulze.pt needs from a Schulze result,
+        so it only has to be worked out once. Losers are listed in rank order
+        when the result has one.
+    """
+    winner = poll_result.get("winner")
+    tied_winners = [x for x in proposal_uids if x in poll_result.get("tied_winners", ())]
+    if "order" in poll_result:
+        # Proposals in rank order
+        proposal_uids = poll_result["order"]
+    losers = [x for x in proposal_uids if x != winner and x in poll_result["candidates"]]
+    smith_set = [x for x in proposal_uids if x in poll_result.get("smith_set", ())]
+    pairs = format_ranking(poll_result["pairs"])
+    return {
+        "winner": winner,
+        "tied_winners": tied_winners,
+        "losers": losers,
+        "total_votes": total_votes,
+        "pairs": pairs,
+        "perc": pair_percentages(pairs, total_votes),
+        "tie_seed": poll_result.get("tie_seed"),
+        "tie_rule": poll_result.get("tie_rule"),
+        "condorcet_winner": poll_result.get("condorcet_winner"),
+        "smith_set": smith_set,
+    }
+
+
 class SchulzeBase(poll_plugin.PollPlugin):
     """ Common methods for Schulze ballots. This is ment to be a mixin
         for an adapter. It won't work by itself.
@@ -45,6 +179,17 @@ class SchulzeBase(poll_plugin.PollPlugin):
         "be compared to every other based on preference.",
     )
     proposals_min = 3
+    # Keep a running pairwise tally while the poll is open, if enabled
+    use_tally = False
+    # Calculate the result in the background when deferred closing is enabled
+    deferrable = False
+    # Moderators can see a provisional result while the poll is open
+    provisional = False
+    # Calculate the result in a separate process with resource limits, when enabled
+    isolated = False
+    # Most proposals the result is calculated for within seconds when closing,
+    # 0 for no limit. Polls with more can only be started with deferred closing.
+    interactive_proposals = 0
 
     def get_vote_schema(self):
         """ Get an instance of the schema that this poll uses.
@@ -56,64 +201,246 @@ class SchulzeBase(poll_plugin.PollPlugin):
             Note that higher is less preferred. Missing should be highest
             "normal" value +1 to avoid mixing it with an active stance on something.
             That makes it possible to just rate some of the proposals.
+
+            The choices, validator and widget are built once per poll, proposals
+            and star settings, see VoteSchemaParts. Only the nodes are new.
         """
-        proposals = self.context.get_proposal_objects()
-        # Schulze works with ranking, so we add as many numbers as there are alternatives
-        stars = len(proposals)
-        max_stars = self.context.poll_settings.get("max_stars", 5)
-        min_stars = self.context.poll_settings.get("min_stars", 5)
-        if max_stars < stars:
-            stars = max_stars
-        if min_stars > stars:
-            stars = min_stars
-        # SelectWidget expects a list where each item has a value and a readable title  (value, title)
-        # the title should be the value reversed so 5 stars doesn't say "1" although it really is that value.
-        schulze_choice = [(str(x), str(stars - x + 1)) for x in range(1, stars + 1)]
-        # Ie 5 stars = 1 point, 1 star 5 points
-        schulze_choice.reverse()
-        valid_entries = [
-            str(x) for x in range(1, stars + 2)
-        ]  # To include the missing value
-        # This schema creation method is due to legacy code.
-        schema = SchulzePollSchema()
-        for proposal in proposals:
-            title = "#%s" % proposal.aid
-            schema.add(
-                colander.SchemaNode(
-                    colander.String(),
-                    name=proposal.uid,
-                    # To make missing even less desired than the regular stars
-                    # Schulze can't handle null value or empty dicts.
-                    # This does however produce the same result
-                    missing=stars + 1,
-                    title=title,
-                    # FIXME: This is an ugly hack so we can render proposals properly within the widget
-                    # description-fields won't render html.
-                    proposal=proposal,
-                    # description = proposal.text,
-                    validator=colander.OneOf(valid_entries),
-                    widget=deform.widget.RadioChoiceWidget(
-                        values=schulze_choice,
-                        template="star_choice",
-                        readonly_template="readonly/star_choice",
-                    ),
-                )
-            )
+        parts, proposals = self.get_vote_schema_parts()
+        schema = parts.schema(proposals)
         schema.description = self.description
         return schema
 
+    def get_vote_schema_parts(self):
+        """ The VoteSchemaParts of this poll and its proposal objects. """
+        settings = self.context.poll_settings
+        key = (
+            self.context.uid,
+            tuple(self.context.proposal_uids),
+            settings.get("max_stars", 5),
+            settings.get("min_stars", 5),
+        )
+        parts = get_schema_parts(key)
+        proposals = None
+        if parts is not None:
+            proposals = parts.find_proposals(self.context.__parent__)
+        if proposals is None:
+            proposals = list(self.context.get_proposal_objects())
+            parts = VoteSchemaParts(proposals, key[2], key[3])
+            set_schema_parts(key, parts)
+        return parts, proposals
+
+    def get_ballots(self):
+        """ The poll's ballots as CompactBallots. They're built once
+            and never modified by the calculations, so there's no need to copy them.
+            Ballots that are identical after normalisation are merged, so all
+            calculations only run over the unique ones.
+        """
+        with self.phase("ballots") as phase:
+            ballots = CompactBallots.from_ballots(self.context.ballots)
+            phase.update(**ballot_data(ballots))
+        logger.debug(
+            "Poll %s: %s voters, %s ballots, %s unique after normalisation (%.3f)",
+            self.context.uid,
+            ballots.total,
+            ballots.source_count,
+            len(ballots),
+            ballots.compression_ratio,
+        )
+        return ballots
+
     def schulze_format_ballots(self, ballots):
         formatted = []
         for (ballot, count) in ballots:
             formatted.append({"count": count, "ballot": ballot})
         return formatted
 
+    def estimate_cost(self, voters, settings=None):
+        """ Estimated seconds to calculate the result with this many voters,
+            see voteit.schulze.cost. settings default to the poll's settings.
+        """
+        return schulze_cost(len(self.context.proposals), voters)
+
+    def vote_stars(self, settings=None):
+        if settings is None:
+            settings = self.context.poll_settings
+        return vote_stars(
+            len(self.context.proposals),
+            max_stars=settings.get("max_stars", 5),
+            min_stars=settings.get("min_stars", 5),
+        )
+
+    def expected_voters(self, request):
+        """ Voters in the meeting, or the expected_voters setting. """
+        meeting = getattr(request, "meeting", None)
+        if meeting is not None:
+            voters = len(find_role_userids(meeting, ROLE_VOTER))
+            if voters:
+                return voters
+        return get_int("expected_voters", default=100, registry=request.registry)
+
+    def cost_message(self, msg, seconds):
+        return _(msg, mapping={"duration": format_duration(seconds)})
+
+    def validate_cost(self, node, value):
+        """ Schema validator that refuses settings estimated above the limit. """
+        if len(self.context.proposals) < 2:
+            return
+        request = get_current_request()
+        seconds = self.estimate_cost(self.expected_voters(request), value)
+        if check_cost(seconds, request.registry) == REFUSE:
+            raise colander.Invalid(node, self.cost_message(COST_LIMIT_MSG, seconds))
+
+    def phase(self, name, **data):
+        """ Time a phase of this plugin's work, see voteit.schulze.metrics. """
+        return phase(name, plugin=self.name, poll=self.context.uid, **data)
+
+    def log_progress(self, done, total):
+        logger.debug(
+            "Poll %s: %s calculated %s of %s", self.context.uid, self.name, done, total
+        )
+
+    def tie_settings(self):
+        """ Seed and rule of this poll's tie breaker, see voteit.schulze.ties. """
+        return poll_seed(self.context.uid), get_tie_rule()
+
+    def tie_breaker(self, candidates, ballots, d=None):
+        seed, rule = self.tie_settings()
+        return TieBreaker(seed, rule, candidates, ballots, d=d)
+
+    def calculation(self, ballots):
+        """ Return a function that calculates the poll result from CompactBallots
+            and a snapshot of the poll. It's called with the keyword arguments
+            budget and progress, and may run in a worker thread,
+            so it must not use the poll.
+        """
+        raise NotImplementedError()
+
+    def fallback_calculation(self, ballots):
+        """ A cheaper calculation to use instead of this one when it hits
+            a resource limit, see voteit.schulze.isolated. None if there is none.
+        """
+        return None
+
+    def repeated_fallback(self, ballots, rounds, format_result):
+        """ A calculation that orders the candidates by Repeated Schulze,
+            for rounds rounds or all of them. The result is format_result
+            of the round data, with winner and tied_winners in each round.
+        """
+        candidates = ballots.candidates
+        if not rounds or rounds > len(candidates):
+            rounds = len(candidates)
+        ties = self.tie_breaker(candidates, ballots)
+
+        def calculate(budget=None, progress=None):
+            round_data = repeated_schulze(
+                candidates, ballots.pairwise(), rounds, ties=ties
+            )
+            round_data = [
+                dict((k, x[k]) for k in ("winner", "tied_winners") if k in x)
+                for x in round_data
+            ]
+            return ties.record(format_result(round_data))
+
+        return calculate
+
+    def get_calculation(self):
+        """ The calculation for the current ballots, using the result cache. """
+        ballots = self.get_ballots()
+        key = result_key(
+            ballots,
+            self.name,
+            proposals=self.context.proposals,
+            winners=self.context.poll_settings.get("winners"),
+            ties=self.tie_settings(),
+        )
+        timing = self.phase("calculate", **ballot_data(ballots))
+        calculate = self.calculation(ballots)
+        if self.isolated and isolation_enabled():
+            calculate = guarded_calculation(
+                calculate, fallback=self.fallback_calculation(ballots)
+            )
+        calculate = cached_calculation(
+            calculate, key, get_result_cache(), stats=timing.data
+        )
+        return timing.wrap(calculate)
+
+    def handle_close(self):
+        if not self.context.ballots:
+            raise HTTPForbidden(_("No votes, cancel the poll instead."))
+        calculate = self.get_calculation()
+        if self.deferrable and deferred_enabled():
+            start_calculation(self.context, calculate)
+            return
+        clear_calculation(self.context)
+        try:
+            result = calculate(budget=get_int("time_budget"), progress=self.log_progress)
+        except CalculationTimeout:
+            raise HTTPForbidden(CALCULATION_TIMEOUT_MSG)
+        except CalculationLimitExceeded as exc:
+            if exc.limit == MEMORY:
+                raise HTTPForbidden(MEMORY_LIMIT_MSG)
+            raise HTTPForbidden(CALCULATION_TIMEOUT_MSG)
+        except CalculationCrashed as exc:
+            logger.error(
+                "Poll %s: the calculation stopped with exit code %s",
+                self.context.uid,
+                exc.exitcode,
+            )
+            raise HTTPForbidden(CRASHED_MSG)
+        self.set_result(result)
+
+    def set_result(self, result):
+        """ Store the calculated result in the poll. """
+        self.context.poll_result = result
+
+    def render_calculating(self, view):
+        """ Render the progress of a result calculated in the background,
+            or None if there's a result to render.
+        """
+        status = update_calculation(self.context, view.request)
+        if status is None or status.state == DONE:
+            return None
+        response = {
+            "context": self.context,
+            "status": status,
+            "status_url": view.request.resource_url(self.context, "schulze_status.json"),
+            "can_moderate": view.request.has_permission(MODERATE_MEETING, self.context),
+        }
+        return render("templates/result_calculating.pt", response, request=view.request)
+
     def render_raw_data(self):
         return Response(unicode(self.context.ballots))
 
+    def needs_deferred(self):
+        """ True if the result can't be calculated within seconds when closing. """
+        return bool(
+            self.interactive_proposals
+            and len(self.context.proposals) > self.interactive_proposals
+        )
+
     def handle_start(self, request):
         if len(self.context.proposals) < 2:
             raise HTTPForbidden(_("Only one proposal selected, can't start poll."))
+        if self.needs_deferred() and not (
+            self.deferrable and deferred_enabled(request.registry)
+        ):
+            raise HTTPForbidden(
+                _(PROPOSALS_LIMIT_MSG, mapping={"count": self.interactive_proposals})
+            )
+        seconds = self.estimate_cost(self.expected_voters(request))
+        level = check_cost(seconds, request.registry)
+        if level == REFUSE:
+            raise HTTPForbidden(self.cost_message(COST_LIMIT_MSG, seconds))
+        if level == WARN:
+            logger.warning(
+                "Poll %s: closing is estimated to take %s",
+                self.context.uid,
+                format_duration(seconds),
+            )
+            request.session.flash(self.cost_message(COST_WARNING_MSG, seconds))
+        if self.use_tally and tally_enabled(request.registry):
+            votes = [x for x in self.context.values() if IVote.providedBy(x)]
+            attach_tally(self.context, votes)
 
 
 class SchulzePollPlugin(SchulzeBase):
@@ -129,6 +456,8 @@ class SchulzePollPlugin(SchulzeBase):
     )
     priority = 1
     multiple_winners = False
+    use_tally = True
+    provisional = True
     criteria = (
         poll_plugin.MajorityWinner(True),
         poll_plugin.MajorityLooser(True),
@@ -145,19 +474,61 @@ class SchulzePollPlugin(SchulzeBase):
         schema.title = _(u"Poll settings")
         schema.description = _(u"Settings for Schulze STV")
         del schema["winners"]
+        schema.validator = self.validate_cost
         return schema
 
-    def handle_close(self):
-        # IMPORTANT! Use deepcopy, we don't want the SchulzePollPlugin to modify our ballots,
-        # just calculate a result
-        ballots = deepcopy(self.context.ballots)
-        if ballots:
-            schulze_ballots = self.schulze_format_ballots(ballots)
-            self.context.poll_result = SchulzeMethod(
-                schulze_ballots, ballot_notation="ranking"
-            ).as_dict()
-        else:
-            raise HTTPForbidden(_("No votes, cancel the poll instead."))
+    def get_ballots(self):
+        """ Only the pairwise matrix is needed, so the ballots are streamed
+            into it chunk by chunk instead of being kept in memory.
+        """
+        with self.phase("ballots") as phase:
+            ballots = StreamedBallots(
+                self.context.ballots, chunk_size=get_int("chunk_size", default=1000)
+            )
+            phase.update(**ballot_data(ballots))
+        logger.debug(
+            "Poll %s: %s voters, %s ballots",
+            self.context.uid,
+            ballots.total,
+            ballots.source_count,
+        )
+        return ballots
+
+    def get_calculation(self):
+        """ The result only depends on the pairwise matrix,
+            so that's what it's cached by. Ties broken by random ballots
+            depend on the ballots too.
+        """
+        ballots = self.get_ballots()
+        candidates, pairs = get_pairwise(self.context, ballots)
+        ties = self.tie_settings()
+        digest = ties[1] == RANDOM_BALLOT and ballot_digest(ballots) or None
+        key = matrix_key(candidates, pairs, self.name, ties=ties, ballots=digest)
+        timing = self.phase("calculate", **ballot_data(ballots))
+        calculate = cached_calculation(
+            self.pairwise_calculation(candidates, pairs, ballots),
+            key,
+            get_result_cache(),
+            stats=timing.data,
+        )
+        return timing.wrap(calculate)
+
+    def calculation(self, ballots):
+        candidates, pairs = get_pairwise(self.context, ballots)
+        return self.pairwise_calculation(candidates, pairs, ballots)
+
+    def pairwise_calculation(self, candidates, pairs, ballots):
+        ties = self.tie_breaker(candidates, ballots, pairs)
+
+        def calculate(budget=None, progress=None):
+            paths = widest_paths(pairs)
+            result = schulze_result(
+                candidates, pairs, paths=paths, ties=ties, ranking=True
+            )
+            ties.record(result)
+            return PairwiseResult.from_matrix(result, candidates, pairs, paths=paths)
+
+        return calculate
 
     def change_states_of(self):
         """ This gets called when a poll has finished.
@@ -165,6 +536,8 @@ class SchulzePollPlugin(SchulzeBase):
             Like: {'<uid>':'approved', '<uid>', 'denied'}
         """
         result = {}
+        if is_calculating(self.context):
+            return result
         winner = self.context.poll_result.get("winner", "")
         losers = self.context.poll_result["candidates"] - set([winner])
         if winner:
@@ -173,44 +546,54 @@ class SchulzePollPlugin(SchulzeBase):
                 result[loser] = "denied"
         return result
 
+    def set_result(self, result):
+        super(SchulzePollPlugin, self).set_result(result)
+        model = display_model(result, self.context.proposals, len(self.context))
+        setattr(self.context, DISPLAY_ATTR, DisplayModel.from_model(model))
+
+    def get_display_model(self):
+        """ The display model stored on close. Polls closed before it
+            existed get one calculated, but not stored, on each call.
+        """
+        stored = getattr(self.context, DISPLAY_ATTR, None)
+        if isinstance(stored, DisplayModel):
+            return stored.model()
+        return display_model(
+            self.context.poll_result, self.context.proposals, len(self.context)
+        )
+
     def render_result(self, view):
-        winner_uid = self.context.poll_result.get("winner", set())
-        winner = view.resolve_uid(winner_uid)
-        tied_winners = []
-        for uid in self.context.poll_result.get("tied_winners", ()):
-            tied_winners.append(view.resolve_uid(uid))
-        looser_uids = set(self.context.poll_result["candidates"]) - set([winner_uid])
-        loosers = []
-        for uid in looser_uids:
-            loosers.append(view.resolve_uid(uid))
+        calculating = self.render_calculating(view)
+        if calculating is not None:
+            return calculating
+        with self.phase("render"):
+            proposals = list(self.context.get_proposal_objects())
+            key = html_key([self.context] + proposals, view.request.locale_name)
+            return cached_html(key, self._render_result, view, proposals)
+
+    def _render_result(self, view, proposals):
+        model = self.get_display_model()
+        proposals_dict = dict([(x.uid, x) for x in proposals])
+        winner = proposals_dict.get(model["winner"])
+        loosers = [proposals_dict[x] for x in model["losers"] if x in proposals_dict]
         response = {}
         response["context"] = self.context
-        response["pairs"] = pairs = format_ranking(self.context.poll_result["pairs"])
-        response["total_votes"] = total_votes = len(self.context)  # Should be ok...
-        response["proposals_dict"] = dict(
-            [(x.uid, x) for x in self.context.get_proposal_objects()]
-        )
+        response["pairs"] = model["pairs"]
+        response["total_votes"] = model["total_votes"]
+        response["proposals_dict"] = proposals_dict
         response["winners"] = [winner]
-        response["tied_winners"] = tied_winners
+        response["tied_winners"] = [
+            proposals_dict[x] for x in model["tied_winners"] if x in proposals_dict
+        ]
         response["loosers"] = loosers
         response["proposals"] = [winner] + loosers
-
-        def _perc(primary_uid, vs_uid):
-            primary = Decimal(pairs[primary_uid][vs_uid])
-            vs = Decimal(pairs[vs_uid][primary_uid])
-            result = {}
-            try:
-                result[primary_uid] = int(round(primary / total_votes * 100))
-            except ZeroDivisionError:
-                result[primary_uid] = 0
-            try:
-                result[vs_uid] = int(round(vs / total_votes * 100))
-            except ZeroDivisionError:
-                result[vs_uid] = 0
-            result["equal"] = 100 - result[primary_uid] - result[vs_uid]
-            return result
-
-        response["perc"] = _perc
+        response["perc"] = model["perc"]
+        response["tie_seed"] = model.get("tie_seed")
+        response["tie_rule"] = model.get("tie_rule")
+        response["condorcet_winner"] = proposals_dict.get(model.get("condorcet_winner"))
+        response["smith_set"] = [
+            proposals_dict[x] for x in model.get("smith_set", ()) if x in proposals_dict
+        ]
         return render("templates/result_schulze.pt", response, request=view.request)
 
 
@@ -232,6 +615,9 @@ class SortedSchulzePollPlugin(SchulzeBase):
     multiple_winners = True
     recommended_for = _("Board elections or sorting proposals according to preference.")
     priority = 3
+    use_tally = True
+    deferrable = True
+    provisional = True
     criteria = (
         poll_plugin.MajorityWinner(True, comment=_("In each round")),
         poll_plugin.MajorityLooser(True, comment=_("In each round")),
@@ -242,6 +628,12 @@ class SortedSchulzePollPlugin(SchulzeBase):
         poll_plugin.Proportional(False, comment=_("Incompatible with Condorcet.")),
     )
 
+    def estimate_cost(self, voters, settings=None):
+        if settings is None:
+            settings = self.context.poll_settings
+        winners = settings.get("winners", 0)
+        return repeated_schulze_cost(len(self.context.proposals), voters, winners)
+
     def get_settings_schema(self):
         """ Get an instance of the schema used to render a form for editing settings.
         """
@@ -259,67 +651,65 @@ class SortedSchulzePollPlugin(SchulzeBase):
                 missing=0,
             )
         )
+        schema.validator = self.validate_cost
         return schema
 
-    def handle_close(self):
+    def calculation(self, ballots):
         """
         Calculate results per round instead. Each round has exactly 1 winner.
-        (It could be a randomized tie though)
+        (It could be a tie, broken by the poll's tie breaker)
+        The pairwise matrix is built once, each round works with what's left of it.
         """
-        # IMPORTANT! Use deepcopy, we don't want the SortedSchulzePollPlugin to modify our ballots,
-        # just calculate a result
-        ballots = deepcopy(self.context.ballots)
         wcount = self.context.poll_settings.get("winners", 0)
-
-        if ballots:
-            candidates_left = set(self.context.proposals)
-            if wcount and len(self.context.proposals) > wcount:
-                rounds = wcount
-            else:
-                rounds = len(self.context.proposals)
-            schulze_ballots = self.schulze_format_ballots(ballots)
-            round_data = []
-            for i in range(rounds):
-                if len(candidates_left) > 1:
-                    # SchulzeMethod changed the ballots, so we need another copy here!
-                    res = SchulzeMethod(
-                        deepcopy(schulze_ballots), ballot_notation="ranking"
-                    ).as_dict()
-                    round_data.append(res)
-                    schulze_ballots = self.eliminate_candidate(
-                        res["winner"], schulze_ballots
-                    )
-                    candidates_left.remove(res["winner"])
-                else:
-                    # Only 1 candidate left
-                    round_data.append({"winner": list(candidates_left)[0]})
-            self.context.poll_result = {
+        if wcount and len(self.context.proposals) > wcount:
+            rounds = wcount
+        else:
+            rounds = len(self.context.proposals)
+        proposals = set(self.context.proposals)
+        candidates, pairs = get_pairwise(self.context, ballots)
+        ties = self.tie_breaker(candidates, ballots, pairs)
+
+        def calculate(budget=None, progress=None):
+            round_data = repeated_schulze(candidates, pairs, rounds, ties=ties)
+            result = {
                 "rounds": round_data,
-                "candidates": set(self.context.proposals),
+                "candidates": proposals,
                 "winners": [x["winner"] for x in round_data],
             }
-        else:
-            raise HTTPForbidden(_("No votes, cancel the poll instead."))
+            # The first round is the same as a regular Schulze poll
+            for key in ("smith_set", "condorcet_winner"):
+                if round_data and key in round_data[0]:
+                    result[key] = round_data[0][key]
+            return ties.record(result)
 
-    def eliminate_candidate(self, uid, ballots):
-        """ Eliminate a candidate from formatted ballots. """
-        for ballot in ballots:
-            ballot["ballot"].pop(uid, None)
-        return ballots
+        return calculate
 
     def render_result(self, view):
-        winners = self.context.poll_result.get("winners", ())
-        proposals_dict = dict([(x.uid, x) for x in self.context.get_proposal_objects()])
-        response = {
-            "context": self.context,
-            "total_votes": len(self.context),
-            "proposals_dict": proposals_dict,
-            "winners": winners,
-            "sorted_all": len(winners) == len(proposals_dict),
-        }
-        return render(
-            "templates/result_repeated_schulze.pt", response, request=view.request
-        )
+        calculating = self.render_calculating(view)
+        if calculating is not None:
+            return calculating
+        with self.phase("render"):
+            winners = self.context.poll_result.get("winners", ())
+            proposals_dict = dict(
+                [(x.uid, x) for x in self.context.get_proposal_objects()]
+            )
+            # Only the first round compares the whole field, later rounds'
+            # Condorcet winners beat the remaining proposals
+            rounds = self.context.poll_result.get("rounds", ())
+            response = {
+                "context": self.context,
+                "total_votes": len(self.context),
+                "proposals_dict": proposals_dict,
+                "winners": winners,
+                "sorted_all": len(winners) == len(proposals_dict),
+                "condorcet_winner": self.context.poll_result.get("condorcet_winner"),
+                "beats_remaining": set(
+                    x["condorcet_winner"] for x in rounds[1:] if "condorcet_winner" in x
+                ),
+            }
+            return render(
+                "templates/result_repeated_schulze.pt", response, request=view.request
+            )
 
 
 class SchulzeSTVPollPlugin(SchulzeBase):
@@ -337,6 +727,19 @@ class SchulzeSTVPollPlugin(SchulzeBase):
         "Computations may take a very long time with more than 6 winners!",
     )
     selectable = False  # Legacy plugin
+    deferrable = True
+    isolated = True
+
+    def estimate_cost(self, voters, settings=None):
+        if settings is None:
+            settings = self.context.poll_settings
+        seconds = stv_cost(
+            len(self.context.proposals),
+            voters,
+            settings.get("winners", 1),
+            self.vote_stars(settings),
+        )
+        return seconds / max(get_int("processes"), 1)
 
     def get_settings_schema(self):
         """ Get an instance of the schema used to render a form for editing settings.
@@ -344,19 +747,37 @@ class SchulzeSTVPollPlugin(SchulzeBase):
         schema = SettingsSchema()
         schema.title = _(u"Poll settings")
         schema.description = _(u"Settings for Schulze STV")
+        schema.validator = self.validate_cost
         return schema
 
-    def handle_close(self):
-        # IMPORTANT! Use deepcopy, we don't want the SchulzeSTV to modify our ballots, just calculate a result
-        ballots = deepcopy(self.context.ballots)
-        if ballots:
-            winners = self.context.poll_settings.get("winners", 1)
-            schulze_ballots = self.schulze_format_ballots(ballots)
-            self.context.poll_result = SchulzeSTV(
-                schulze_ballots, ballot_notation="ranking", required_winners=winners
-            ).as_dict()
-        else:
-            raise HTTPForbidden(_("No votes, cancel the poll instead."))
+    def calculation(self, ballots):
+        winners = self.context.poll_settings.get("winners", 1)
+        processes = get_int("processes")
+        ties = self.tie_breaker(ballots.candidates, ballots)
+
+        def calculate(budget=None, progress=None):
+            result = schulze_stv(
+                ballots,
+                winners,
+                processes=processes,
+                budget=budget,
+                progress=progress,
+                ties=ties,
+            )
+            return ties.record(result)
+
+        return calculate
+
+    def fallback_calculation(self, ballots):
+        winners = self.context.poll_settings.get("winners", 1)
+
+        def format_result(round_data):
+            return {
+                "candidates": set(ballots.candidates),
+                "winners": set(x["winner"] for x in round_data),
+            }
+
+        return self.repeated_fallback(ballots, winners, format_result)
 
     def change_states_of(self):
         """ This gets called when a poll has finished.
@@ -364,6 +785,8 @@ class SchulzeSTVPollPlugin(SchulzeBase):
             Like: {'<uid>':'approved', '<uid>', 'denied'}
         """
         result = {}
+        if is_calculating(self.context):
+            return result
         winners = self.context.poll_result.get("winners", ())
         losers = self.context.poll_result["candidates"] - set(winners)
         if winners:
@@ -374,24 +797,30 @@ class SchulzeSTVPollPlugin(SchulzeBase):
         return result
 
     def render_result(self, view):
-        winner_uids = self.context.poll_result.get("winners", set())
-        winners = []
-        for uid in winner_uids:
-            winners.append(view.resolve_uid(uid))
-        looser_uids = set(self.context.poll_result["candidates"]) - winner_uids
-        loosers = []
-        for uid in looser_uids:
-            loosers.append(view.resolve_uid(uid))
-        response = {}
-        response["context"] = self.context
-        response["winners"] = winners
-        response["loosers"] = loosers
-        return render("templates/result_stv.pt", response, request=view.request)
+        calculating = self.render_calculating(view)
+        if calculating is not None:
+            return calculating
+        with self.phase("render"):
+            winner_uids = self.context.poll_result.get("winners", set())
+            winners = []
+            for uid in winner_uids:
+                winners.append(view.resolve_uid(uid))
+            looser_uids = set(self.context.poll_result["candidates"]) - winner_uids
+            loosers = []
+            for uid in looser_uids:
+                loosers.append(view.resolve_uid(uid))
+            response = {}
+            response["context"] = self.context
+            response["winners"] = winners
+            response["loosers"] = loosers
+            response["fallback"] = self.context.poll_result.get("fallback")
+            return render("templates/result_stv.pt", response, request=view.request)
 
 
 class SchulzePRPollPlugin(SchulzeBase):
     """ Poll plugin for the Schulze PR ranking polls. It will sort a list
-        of proposals according to the voters preference.
+        of proposals according to the voters preference. With a number of
+        seats, only that many are ranked, for a proportional list like a board.
     """
 
     name = u"schulze_pr"
@@ -399,13 +828,44 @@ class SchulzePRPollPlugin(SchulzeBase):
     description = _(
         "moderator_description_schulze_pr",
         default="This poll sorts all the proposals according "
-        "to the preference of all voters. "
+        "to the preference of all voters, or as many as the number of seats. "
         "The result will be proportional. "
-        "Note: Computational complexity grows expontentially "
-        "with each added proposal. Over 5 proposals may be tricky. "
-        "Use with caution!",
+        "Note: Calculation time grows quickly with the number of proposals, "
+        "seats and voters. Up to 16 proposals, or 8 seats from 20 proposals, "
+        "are calculated within seconds, "
+        "more need the result to be calculated in the background.",
     )
-    selectable = False  # Legacy plugin
+    multiple_winners = True
+    recommended_for = _("Board elections with a proportional list of candidates.")
+    priority = 4
+    deferrable = True
+    isolated = True
+    interactive_proposals = 16
+    # Most seats ranked within seconds from up to interactive_seat_proposals
+    interactive_seats = 8
+    interactive_seat_proposals = 20
+    criteria = (poll_plugin.Proportional(True),)
+
+    def needs_deferred(self):
+        seats = self.context.poll_settings.get("winners", 0)
+        if (
+            seats
+            and seats <= self.interactive_seats
+            and len(self.context.proposals) <= self.interactive_seat_proposals
+        ):
+            return False
+        return super(SchulzePRPollPlugin, self).needs_deferred()
+
+    def estimate_cost(self, voters, settings=None):
+        if settings is None:
+            settings = self.context.poll_settings
+        seconds = pr_cost(
+            len(self.context.proposals),
+            voters,
+            self.vote_stars(settings),
+            settings.get("winners", 0),
+        )
+        return seconds / max(get_int("processes"), 1)
 
     def get_settings_schema(self):
         """ Get an instance of the schema used to render a form for editing settings.
@@ -414,30 +874,84 @@ class SchulzePRPollPlugin(SchulzeBase):
         schema.title = _(u"Poll settings")
         schema.description = _(u"Settings for Schulze PR")
         del schema["winners"]
+        schema.add(
+            colander.SchemaNode(
+                colander.Int(),
+                name="winners",
+                title=_("Number of seats"),
+                description=_("Use 0 to rank all"),
+                default=0,
+                missing=0,
+                validator=colander.Range(min=0),
+            )
+        )
+        schema.validator = self.validate_cost
         return schema
 
-    def handle_close(self):
-        # IMPORTANT! Use deepcopy, we don't want the SchulzePR to modify our ballots, just calculate a result
-        ballots = deepcopy(self.context.ballots)
-        if ballots:
-            schulze_ballots = self.schulze_format_ballots(ballots)
-            self.context.poll_result = SchulzePR(
-                schulze_ballots, ballot_notation="ranking"
-            ).as_dict()
-        else:
-            raise HTTPForbidden(_("No votes, cancel the poll instead."))
+    def calculation(self, ballots):
+        """ The positions already ranked for the same ballots are kept in
+            memory, so ranking more seats, or trying again, doesn't start over.
+        """
+        seats = self.context.poll_settings.get("winners", 0)
+        processes = get_int("processes")
+        ties = self.tie_breaker(ballots.candidates, ballots)
+        key = result_key(ballots, self.name)
+        memo = get_ranking_memo(key)
+        if memo is None:
+            memo = RankingMemo()
+            set_ranking_memo(key, memo)
+
+        def calculate(budget=None, progress=None):
+            result = schulze_pr(
+                ballots,
+                seats,
+                memo=memo,
+                processes=processes,
+                budget=budget,
+                progress=progress,
+                ties=ties,
+            )
+            return ties.record(result)
+
+        return calculate
+
+    def fallback_calculation(self, ballots):
+        seats = self.context.poll_settings.get("winners", 0)
+
+        def format_result(round_data):
+            return {
+                "candidates": set(ballots.candidates),
+                "order": [x["winner"] for x in round_data],
+                "rounds": round_data,
+            }
+
+        return self.repeated_fallback(ballots, seats, format_result)
 
     def render_result(self, view):
-        response = {}
-        proposals = []
-        for uid in self.context.poll_result.get("order", ()):
-            proposals.append(view.resolve_uid(uid))
-        response["proposals"] = proposals
-        response["context"] = self.context
-        return render("templates/result_pr.pt", response, request=view.request)
+        calculating = self.render_calculating(view)
+        if calculating is not None:
+            return calculating
+        with self.phase("render"):
+            order = self.context.poll_result.get("order", ())
+            response = {}
+            proposals = []
+            for uid in order:
+                proposals.append(view.resolve_uid(uid))
+            response["proposals"] = proposals
+            response["unranked"] = [
+                x for x in self.context.get_proposal_objects() if x.uid not in order
+            ]
+            response["context"] = self.context
+            response["fallback"] = self.context.poll_result.get("fallback")
+            return render("templates/result_pr.pt", response, request=view.request)
 
 
 def includeme(config):
+    if isolation_enabled(config.registry) and deferred_enabled(config.registry):
+        raise ConfigurationError(
+            "voteit.schulze.isolated_close can't be combined with deferred_close: "
+            "calculations forked from a worker thread may hang."
+        )
     config.registry.registerAdapter(SchulzePollPlugin, name=SchulzePollPlugin.name)
     config.registry.registerAdapter(
         SortedSchulzePollPlugin, name=SortedSchulzePollPlugin.name
@@ -0,0 +1,239 @@
+""" Schulze proportional ranking for CompactBallots.
+
+    Follows pyvotecore's SchulzePR and returns the same result dict. Like its
+    winner_threshold, seats stops the order after that many positions, which
+    is all a proportional list of a board needs. The order is built one
+    position at a time. At each position every remaining candidate is compared
+    to every other, given the candidates already placed, using the same vote
+    management strengths as Schulze STV.
+
+    - How each ballot ranks every remaining candidate against the placed
+      ones is kept from position to position and extended by the new one only.
+    - Strengths are memoized by voter profile within each position. Profiles
+      of earlier positions have fewer candidates and never come up again,
+      so they're dropped.
+    - The winning set of each position is kept in a RankingMemo by the
+      candidates placed before it. A memo can be shared by every calculation
+      of the same ballots, so ranking more seats, or trying again after
+      running out of time, continues where the last calculation stopped.
+    - The comparisons of each position can be spread over a process pool.
+"""
+from multiprocessing import Pool
+import random
+import time
+
+from voteit.schulze.calculation import CalculationTimeout
+from voteit.schulze.stv import StrengthCache
+from voteit.schulze.stv import schwartz_set_heuristic
+
+
+class RankingMemo(object):
+    """ Winning sets of the positions of a Schulze PR order, by the candidates
+        placed before each position, for one set of ballots.
+    """
+
+    def __init__(self):
+        self.steps = {}
+        self.hits = 0
+
+    def get(self, order):
+        winning = self.steps.get(tuple(order))
+        if winning is not None:
+            self.hits += 1
+        return winning
+
+    def set(self, order, winning):
+        self.steps[tuple(order)] = winning
+
+
+def prefix_masks(ballots, candidate, order):
+    """ For each (rank vector, count) in ballots, the (less, same) bit masks
+        of how the candidates in order rank compared to candidate.
+    """
+    masks = []
+    for (ranks, count) in ballots:
+        rc = ranks[candidate]
+        less = same = 0
+        bit = 1
+        for x in order:
+            rx = ranks[x]
+            if rc > rx:
+                less |= bit
+            elif rc == rx:
+                same |= bit
+            bit <<= 1
+        masks.append((less, same))
+    return masks
+
+
+def extend_masks(ballots, masks, winner, placed):
+    """ Add the winner as bit placed to the (less, same) masks of each
+        remaining candidate in masks, for each ballot.
+    """
+    bit = 1 << placed
+    for (candidate, candidate_masks) in masks.items():
+        extended = []
+        for ((ranks, count), (less, same)) in zip(ballots, candidate_masks):
+            rc = ranks[candidate]
+            rw = ranks[winner]
+            if rc > rw:
+                less |= bit
+            elif rc == rw:
+                same |= bit
+            extended.append((less, same))
+        masks[candidate] = extended
+
+
+def candidate_strengths(cache, candidate, order, targets):
+    """ Strength of the vote management of order + [target] against candidate,
+        for each of targets.
+    """
+    masks = prefix_masks(cache.ballots, candidate, order)
+    return target_strengths(cache, candidate, masks, len(order), targets)
+
+
+def target_strengths(cache, candidate, masks, placed, targets):
+    """ Same as candidate_strengths, with the masks of the placed candidates
+        already worked out.
+    """
+    ballots = cache.ballots
+    bit = 1 << placed
+    size = placed + 1
+    strengths = []
+    for target in targets:
+        profile = {}
+        for ((ranks, count), (less, same)) in zip(ballots, masks):
+            rc = ranks[candidate]
+            rt = ranks[target]
+            if rc > rt:
+                less |= bit
+            elif rc == rt:
+                same |= bit
+            pattern = (less, same)
+            profile[pattern] = profile.get(pattern, 0) + count
+        strengths.append(cache.profile_strength(profile, size))
+    return strengths
+
+
+_worker_cache = None
+
+
+def _init_worker(ballots):
+    global _worker_cache
+    _worker_cache = StrengthCache(ballots)
+
+
+def _worker_candidate_strengths(args):
+    return candidate_strengths(_worker_cache, *args)
+
+
+def position_edges(order, remaining, pool):
+    """ Edges between the remaining candidates for the next position,
+        as a dict (a, b) -> weight, where a beats b, calculated in pool.
+    """
+    tasks = [(c, order, [x for x in remaining if x != c]) for c in remaining]
+    results = pool.map(_worker_candidate_strengths, tasks)
+    edges = {}
+    for ((c, order, targets), strengths) in zip(tasks, results):
+        for (target, weight) in zip(targets, strengths):
+            if weight > 0:
+                edges[(target, c)] = weight
+    return edges
+
+
+def step_edges(cache, masks, placed, remaining, deadline=None):
+    """ Same as position_edges, in this process, with the masks of each
+        remaining candidate against the placed ones.
+    """
+    edges = {}
+    for c in remaining:
+        targets = [x for x in remaining if x != c]
+        strengths = target_strengths(cache, c, masks[c], placed, targets)
+        for (target, weight) in zip(targets, strengths):
+            if weight > 0:
+                edges[(target, c)] = weight
+        if deadline is not None and time.time() > deadline:
+            raise CalculationTimeout()
+    return edges
+
+
+def schulze_pr(
+    ballots, seats=0, memo=None, processes=0, budget=None, progress=None, ties=None
+):
+    """ Schulze PR result for CompactBallots, with the order stopped after
+        seats candidates, 0 orders all of them.
+
+        memo is a RankingMemo of the same ballots to use and add to, if any.
+        processes is the number of worker processes to use, 0 means none.
+        budget is the number of seconds the calculation may take before
+        CalculationTimeout is raised.
+        progress is called with the number of positions decided and the total.
+        ties is the TieBreaker to use, if any.
+    """
+    deadline = budget and time.time() + budget or None
+    candidates = ballots.candidates
+    size = len(candidates)
+    if not seats or seats > size:
+        seats = size
+    if memo is None:
+        memo = RankingMemo()
+    remaining = list(range(size))
+    order = []
+    rounds = []
+    result = {"candidates": set(candidates)}
+    ballots = list(ballots)
+    masks = dict((c, [(0, 0)] * len(ballots)) for c in remaining)
+    ordering = None
+    pool = None
+    try:
+        while len(order) < seats and len(remaining) > 1:
+            winning = memo.get(order)
+            if winning is None:
+                if processes and size > 2 and pool is None:
+                    pool = Pool(processes, initializer=_init_worker, initargs=(ballots,))
+                if pool is not None:
+                    edges = position_edges(order, remaining, pool)
+                else:
+                    edges = step_edges(
+                        StrengthCache(ballots), masks, len(order), remaining, deadline
+                    )
+                if deadline is not None and time.time() > deadline:
+                    raise CalculationTimeout(len(order), seats)
+                winning, actions = schwartz_set_heuristic(
+                    remaining, edges, deadline=deadline
+                )
+                winning = tuple(sorted(winning))
+                memo.set(order, winning)
+            round_data = {}
+            if len(winning) == 1:
+                winner = winning[0]
+            else:
+                # pyvotecore uses the same random ordering for all ties
+                if ordering is None and ties is not None:
+                    index = dict((c, i) for (i, c) in enumerate(candidates))
+                    ordering = [index[x] for x in ties.ordering()]
+                    result["tie_breaker"] = ties.ordering()
+                elif ordering is None:
+                    ordering = list(range(size))
+                    random.shuffle(ordering)
+                    result["tie_breaker"] = [candidates[x] for x in ordering]
+                winner = [x for x in ordering if x in winning][0]
+                round_data["tied_winners"] = set(candidates[x] for x in winning)
+            round_data["winner"] = candidates[winner]
+            rounds.append(round_data)
+            remaining.remove(winner)
+            del masks[winner]
+            if len(order) + 1 < seats and pool is None:
+                extend_masks(ballots, masks, winner, len(order))
+            order.append(winner)
+            if progress is not None:
+                progress(len(order), seats)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    if len(order) < seats:
+        order.extend(remaining)
+        rounds.append({"winner": candidates[remaining[0]]})
+    result["order"] = [candidates[x] for x in order]
+    result["rounds"] = rounds
+    return result
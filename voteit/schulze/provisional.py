@@ -0,0 +1,122 @@
+""" Provisional results of open Schulze polls.
+
+    Moderators can follow how an open poll is going without closing it:
+    the current winner, the Schulze ranking and the pairwise margins. They're
+    worked out from the running tally when there is one (see
+    voteit.schulze.tally), otherwise from the votes cast so far.
+
+    Each poll's provisional result is kept in memory and served as it is for
+    a number of seconds. After that, it's only calculated again if the
+    pairwise counts have changed, and only one request per poll at a time
+    does that. Other requests get the previous result meanwhile.
+
+    voteit.schulze.provisional_ttl = 10
+"""
+from weakref import WeakValueDictionary
+import threading
+import time
+
+from voteit.core.models.interfaces import IVote
+
+from voteit.schulze.cache import MemoryLRU
+from voteit.schulze.calculation import schulze_ranking
+from voteit.schulze.calculation import widest_paths
+from voteit.schulze.metrics import phase
+from voteit.schulze.settings import get_int
+from voteit.schulze.tally import PairwiseTally
+from voteit.schulze.tally import get_tally
+
+
+# Number of polls with a provisional result kept in memory
+CACHE_SIZE = 100
+
+
+def current_pairwise(poll):
+    """ Candidates, pairwise matrix and number of votes of an open poll. """
+    tally = get_tally(poll)
+    if tally is None:
+        # Not stored, it's thrown away once the counts are read
+        tally = PairwiseTally(poll.proposals)
+        for vote in poll.values():
+            if IVote.providedBy(vote):
+                tally.add(vote.__name__, vote.get_vote_data())
+    return tally.candidates, [list(row) for row in tally.matrix], tally.total
+
+
+def standing(candidates, d):
+    """ Winner, ranking and margins from the pairwise matrix d. Margins are
+        a dict of dicts, where margins[a][b] is how many more voters prefer
+        a over b than the other way around.
+    """
+    indices = range(len(candidates))
+    ranking = schulze_ranking(candidates, widest_paths(d))
+    winners = ranking[0] if ranking else []
+    return {
+        "winner": len(winners) == 1 and winners[0] or None,
+        "tied_winners": len(winners) > 1 and winners or [],
+        "ranking": ranking,
+        "margins": dict(
+            (
+                candidates[i],
+                dict((candidates[j], d[i][j] - d[j][i]) for j in indices if j != i),
+            )
+            for i in indices
+        ),
+    }
+
+
+class ProvisionalResults(object):
+    """ Provisional results by poll UID, with when they were last checked. """
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self._entries = MemoryLRU()
+        # A poll's lock is kept as long as anyone holds or waits for it
+        self._locks = WeakValueDictionary()
+        self._lock = threading.Lock()
+
+    def _poll_lock(self, uid):
+        with self._lock:
+            lock = self._locks.get(uid)
+            if lock is None:
+                lock = self._locks[uid] = threading.Lock()
+            return lock
+
+    def get(self, poll, ttl, now=None):
+        if now is None:
+            now = time.time()
+        entry = self._entries.get(poll.uid)
+        if entry is not None and now - entry["checked"] < ttl:
+            return entry["data"]
+        lock = self._poll_lock(poll.uid)
+        # Someone else is calculating it, use what there is
+        if not lock.acquire(entry is None):
+            return entry["data"]
+        try:
+            entry = self._entries.get(poll.uid)
+            if entry is not None and now - entry["checked"] < ttl:
+                return entry["data"]
+            with phase("provisional", poll=poll.uid) as timing:
+                candidates, d, votes = current_pairwise(poll)
+                state = (candidates, d)
+                if entry is None or entry["state"] != state:
+                    data = standing(candidates, d)
+                    data["votes"] = votes
+                    data["calculated"] = now
+                    entry = {"state": state, "data": data}
+                timing.update(votes=votes, candidates=len(candidates))
+            entry["checked"] = now
+            self._entries.set(poll.uid, entry, self.size)
+            return entry["data"]
+        finally:
+            lock.release()
+
+
+_results = ProvisionalResults()
+
+
+def provisional_result(poll):
+    """ The provisional result of poll, at most provisional_ttl seconds old
+        unless it's being calculated.
+    """
+    return _results.get(poll, get_int("provisional_ttl", default=10))
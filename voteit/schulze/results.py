@@ -0,0 +1,301 @@
+""" Compact storage of Schulze results.
+
+    pyvotecore's result dict keeps 'pairs' and 'strong_pairs' as dicts keyed
+    by tuples of proposal UIDs, which is a lot of objects to store and load for
+    every closed poll. PairwiseResult keeps the candidates once, and the
+    pairwise counts as a string of packed integers. It reads like the dict it
+    replaces, and rebuilds 'pairs' and 'strong_pairs' when they're asked for.
+    The strongest path matrix is packed the same way, and read as
+    'strongest_paths', keyed like 'pairs'.
+
+    What the result view needs is stored when the poll is closed, as a
+    DisplayModel next to the result, with the counts and percentages packed
+    the same way.
+
+    Polls closed before this are converted with:
+
+    bin/voteit_schulze_compact_results etc/production.ini
+"""
+from array import array
+from collections import Mapping
+import sys
+
+from persistent import Persistent
+from pyramid.paster import bootstrap
+from pyramid.traversal import find_resource
+import transaction
+
+
+# 32 bit integers, stored little-endian
+TYPECODE = "i"
+# Keys that are rebuilt from the candidates and counts
+DERIVED_KEYS = ("candidates", "pairs", "strong_pairs")
+# Display model stored next to the result
+DISPLAY_ATTR = "_schulze_display"
+# Keys of a display model that are packed
+DISPLAY_MATRIX_KEYS = ("pairs", "perc")
+# Converted polls between each commit
+COMMIT_INTERVAL = 100
+# Polls read between each time the database cache is trimmed
+GC_INTERVAL = 100
+
+
+def pack_matrix(d):
+    """ Pack a square matrix of integers into a string. """
+    counts = array(TYPECODE)
+    for row in d:
+        counts.extend(row)
+    if sys.byteorder != "little":
+        counts.byteswap()
+    return counts.tostring()
+
+
+def unpack_matrix(data, size):
+    counts = array(TYPECODE)
+    counts.fromstring(data)
+    if sys.byteorder != "little":
+        counts.byteswap()
+    return [counts[i * size : (i + 1) * size].tolist() for i in range(size)]
+
+
+def pack_actions(actions, candidates):
+    """ Actions as a list of (key, indices), with edges flattened. """
+    index = dict((c, i) for (i, c) in enumerate(candidates))
+    packed = []
+    for action in actions:
+        for (key, items) in action.items():
+            indices = []
+            for item in sorted(items):
+                if isinstance(item, tuple):
+                    indices.extend(index[x] for x in item)
+                else:
+                    indices.append(index[item])
+            packed.append((key, tuple(indices)))
+    return packed
+
+
+def unpack_actions(packed, candidates):
+    actions = []
+    for (key, indices) in packed:
+        if key == "edges":
+            items = set(
+                (candidates[indices[i]], candidates[indices[i + 1]])
+                for i in range(0, len(indices), 2)
+            )
+        else:
+            items = set(candidates[i] for i in indices)
+        actions.append({key: items})
+    return actions
+
+
+class PairwiseResult(Mapping):
+    """ Read-only Schulze result with the pairwise counts packed.
+        candidate_list is the order of the matrix, data holds every other key
+        of the result, like 'winner' and 'tied_winners'. The 'actions' of
+        the Schwartz set heuristic are kept as candidate indices.
+    """
+
+    # Packed strongest path matrix, if it was stored
+    paths = None
+
+    def __init__(self, candidates, counts, data, actions=None, paths=None):
+        self.candidate_list = tuple(candidates)
+        self.counts = counts
+        self.data = data
+        self.actions = actions
+        self.paths = paths
+
+    @classmethod
+    def from_matrix(cls, result, candidates, d, paths=None):
+        """ From a result dict and the pairwise matrix it was calculated from.
+            paths is the strongest path matrix to store, if any.
+        """
+        data = dict(
+            (k, v)
+            for (k, v) in result.items()
+            if k not in DERIVED_KEYS and k != "actions"
+        )
+        actions = None
+        if "actions" in result:
+            actions = pack_actions(result["actions"], candidates)
+        if paths is not None:
+            paths = pack_matrix(paths)
+        return cls(candidates, pack_matrix(d), data, actions, paths)
+
+    @classmethod
+    def from_result(cls, result):
+        """ From a stored result dict with 'pairs'. """
+        candidates = tuple(sorted(result["candidates"]))
+        index = dict((c, i) for (i, c) in enumerate(candidates))
+        d = [[0] * len(candidates) for c in candidates]
+        for ((a, b), count) in result["pairs"].items():
+            d[index[a]][index[b]] = count
+        return cls.from_matrix(result, candidates, d)
+
+    def matrix(self):
+        return unpack_matrix(self.counts, len(self.candidate_list))
+
+    def path_matrix(self):
+        """ The strongest path matrix, or None if it wasn't stored. """
+        if self.paths is None:
+            return None
+        return unpack_matrix(self.paths, len(self.candidate_list))
+
+    def pairs(self, strong=False, d=None):
+        """ Counts as a dict keyed by (uid, uid). With strong, only the pairs
+            where more voters prefer the first proposal. d is the matrix to
+            read, the pairwise counts by default.
+        """
+        candidates = self.candidate_list
+        if d is None:
+            d = self.matrix()
+        indices = range(len(candidates))
+        return dict(
+            ((candidates[i], candidates[j]), d[i][j])
+            for i in indices
+            for j in indices
+            if i != j and (not strong or d[i][j] > d[j][i])
+        )
+
+    def __getitem__(self, key):
+        if key == "candidates":
+            return set(self.candidate_list)
+        if key == "pairs":
+            return self.pairs()
+        if key == "strong_pairs":
+            return self.pairs(strong=True)
+        if key == "actions" and self.actions is not None:
+            return unpack_actions(self.actions, self.candidate_list)
+        if key == "strongest_paths" and self.paths is not None:
+            return self.pairs(d=self.path_matrix())
+        return self.data[key]
+
+    def __iter__(self):
+        for key in DERIVED_KEYS:
+            yield key
+        if self.actions is not None:
+            yield "actions"
+        if self.paths is not None:
+            yield "strongest_paths"
+        for key in self.data:
+            yield key
+
+    def __len__(self):
+        return (
+            len(DERIVED_KEYS)
+            + len(self.data)
+            + int(self.actions is not None)
+            + int(self.paths is not None)
+        )
+
+    def __repr__(self):
+        return "<PairwiseResult %r>" % dict(self)
+
+
+class DisplayModel(Persistent):
+    """ What the Schulze result view needs, see models.display_model.
+        It's an object of its own, so it's only loaded when the result is
+        shown. The pairwise counts, and the percentage of voters preferring
+        one proposal to another, are packed in the order of candidate_list.
+        data holds every other key of the model, like 'winner' and 'losers'.
+    """
+
+    def __init__(self, candidates, counts, percentages, data):
+        self.candidate_list = tuple(candidates)
+        self.counts = counts
+        self.percentages = percentages
+        self.data = data
+
+    @classmethod
+    def from_model(cls, model):
+        """ From a display model dict. """
+        candidates = tuple(sorted(model["pairs"]))
+        pairs = model["pairs"]
+        perc = model["perc"]
+        counts = [[pairs[a].get(b, 0) for b in candidates] for a in candidates]
+        percentages = [
+            [perc[a][b][a] if a != b else 0 for b in candidates] for a in candidates
+        ]
+        data = dict(
+            (k, v) for (k, v) in model.items() if k not in DISPLAY_MATRIX_KEYS
+        )
+        return cls(candidates, pack_matrix(counts), pack_matrix(percentages), data)
+
+    def model(self):
+        """ The display model dict it was stored from. """
+        candidates = self.candidate_list
+        counts = unpack_matrix(self.counts, len(candidates))
+        percentages = unpack_matrix(self.percentages, len(candidates))
+        pairs = {}
+        perc = {}
+        for (i, a) in enumerate(candidates):
+            pairs[a] = {}
+            perc[a] = {}
+            for (j, b) in enumerate(candidates):
+                if i == j:
+                    continue
+                pairs[a][b] = counts[i][j]
+                perc[a][b] = {
+                    a: percentages[i][j],
+                    b: percentages[j][i],
+                    "equal": 100 - percentages[i][j] - percentages[j][i],
+                }
+        model = dict(self.data)
+        model["pairs"] = pairs
+        model["perc"] = perc
+        return model
+
+
+def compact_result(poll):
+    """ Convert the stored result of a Schulze poll, and drop a display
+        model stored as a dict by earlier versions. Returns True if anything
+        changed.
+    """
+    result = getattr(poll, "poll_result", None)
+    if getattr(poll, "poll_plugin", None) != "schulze":
+        return False
+    changed = False
+    if isinstance(poll.__dict__.get(DISPLAY_ATTR), dict):
+        delattr(poll, DISPLAY_ATTR)
+        changed = True
+    if isinstance(result, dict) and "pairs" in result:
+        poll.poll_result = PairwiseResult.from_result(result)
+        changed = True
+    return changed
+
+
+def closed_polls(root, plugins):
+    """ Closed polls with a result using any of the plugins, one at a time.
+        They're looked up in the catalog, so nothing else is loaded, and the
+        database cache is trimmed as they're read.
+    """
+    query = "type_name == 'Poll' and workflow_state == 'closed'"
+    (count, docids) = root.catalog.query(query)
+    for (i, docid) in enumerate(docids, 1):
+        path = root.document_map.address_for_docid(docid)
+        if path is not None:
+            poll = find_resource(root, path)
+            if getattr(poll, "poll_plugin", None) in plugins and getattr(
+                poll, "poll_result", None
+            ):
+                yield poll
+        if i % GC_INTERVAL == 0 and root._p_jar is not None:
+            root._p_jar.cacheGC()
+
+
+def main(argv=sys.argv):
+    if len(argv) != 2:
+        sys.exit("Usage: %s <config_uri>" % argv[0])
+    env = bootstrap(argv[1])
+    root = env["root"]
+    try:
+        count = 0
+        for poll in closed_polls(root, ("schulze",)):
+            if compact_result(poll):
+                count += 1
+                if count % COMMIT_INTERVAL == 0:
+                    transaction.commit()
+        transaction.commit()
+        print("Converted the results of %s polls" % count)
+    finally:
+        env["closer"]()
@@ -4,6 +4,13 @@ import deform
 from voteit.schulze import _
 
 
+UNKNOWN_PROPOSAL_MSG = _(
+    "vote_unknown_proposal_error", default="Not a proposal in this poll."
+)
+INVALID_STARS_MSG = _(
+    "vote_invalid_stars_error", default="Must be one of ${choices}."
+)
+
 class SettingsSchema(colander.Schema):
     """ Settings for a Schulze poll
     """
@@ -44,3 +51,101 @@ class SchulzePollSchema(colander.Schema):
     widget = deform.widget.FormWidget(
         template="form_modal", readonly_template="readonly/form_modal"
     )
+
+
+class VoteSchemaParts(object):
+    """ Everything in a vote schema that only depends on the poll's proposals
+        and star settings. The validator and widget are shared by every node
+        and every schema built from the same parts. Proposals are remembered
+        by name in the agenda item, so they can be looked up again cheaply
+        in any request.
+    """
+
+    def __init__(self, proposals, max_stars=5, min_stars=5):
+        # Schulze works with ranking, so we add as many numbers as there are alternatives
+        stars = len(proposals)
+        if max_stars < stars:
+            stars = max_stars
+        if min_stars > stars:
+            stars = min_stars
+        self.stars = stars
+        # SelectWidget expects a list where each item has a value and a readable title  (value, title)
+        # the title should be the value reversed so 5 stars doesn't say "1" although it really is that value.
+        schulze_choice = [(str(x), str(stars - x + 1)) for x in range(1, stars + 1)]
+        # Ie 5 stars = 1 point, 1 star 5 points
+        schulze_choice.reverse()
+        self.choices = tuple(schulze_choice)
+        # To include the missing value
+        self.valid_entries = tuple(str(x) for x in range(1, stars + 2))
+        self.validator = colander.OneOf(self.valid_entries)
+        self.widget = deform.widget.RadioChoiceWidget(
+            values=self.choices,
+            template="star_choice",
+            readonly_template="readonly/star_choice",
+        )
+        self.proposals = tuple(
+            (x.__name__, x.uid, "#%s" % x.aid) for x in proposals
+        )
+        self._uids = frozenset(uid for (name, uid, title) in self.proposals)
+        self._valid = frozenset(self.valid_entries)
+
+    def find_proposals(self, agenda_item):
+        """ The proposals in agenda_item, or None if any of them is gone. """
+        proposals = []
+        for (name, uid, title) in self.proposals:
+            proposal = agenda_item.get(name)
+            if getattr(proposal, "uid", None) != uid:
+                return None
+            proposals.append(proposal)
+        return proposals
+
+    def validate(self, data):
+        """ Vote data from a dict of proposal UIDs to stars, without a form.
+            The rules are the schema's: values must be valid_entries, as
+            numbers or strings, and proposals that aren't in data get stars + 1.
+            Returns the same appstruct as the form would, and a dict of
+            error messages by UID, if any.
+        """
+        errors = {}
+        for uid in data:
+            if uid not in self._uids:
+                errors[uid] = UNKNOWN_PROPOSAL_MSG
+        appstruct = {}
+        for (name, uid, title) in self.proposals:
+            if uid not in data:
+                appstruct[uid] = self.stars + 1
+                continue
+            value = data[uid]
+            if isinstance(value, (int, long)) and not isinstance(value, bool):
+                value = unicode(value)
+            if not isinstance(value, basestring) or value not in self._valid:
+                errors[uid] = _(
+                    INVALID_STARS_MSG,
+                    mapping={"choices": ", ".join(self.valid_entries)},
+                )
+                continue
+            appstruct[uid] = unicode(value)
+        return appstruct, errors
+
+    def schema(self, proposals):
+        """ A new vote schema for proposals, as returned by find_proposals. """
+        # This schema creation method is due to legacy code.
+        schema = SchulzePollSchema()
+        for (proposal, (name, uid, title)) in zip(proposals, self.proposals):
+            schema.add(
+                colander.SchemaNode(
+                    colander.String(),
+                    name=uid,
+                    # To make missing even less desired than the regular stars
+                    # Schulze can't handle null value or empty dicts.
+                    # This does however produce the same result
+                    missing=self.stars + 1,
+                    title=title,
+                    # FIXME: This is an ugly hack so we can render proposals properly within the widget
+                    # description-fields won't render html.
+                    proposal=proposal,
+                    validator=self.validator,
+                    widget=self.widget,
+                )
+            )
+        return schema
@@ -0,0 +1,35 @@
+""" Deployment settings for voteit.schulze.
+
+    All settings are read from the Pyramid settings (the ini-file) and
+    are prefixed with 'voteit.schulze.', for instance:
+
+    voteit.schulze.incremental_tally = true
+"""
+from pyramid.settings import asbool
+from pyramid.threadlocal import get_current_registry
+
+
+PREFIX = "voteit.schulze."
+
+
+def get_setting(name, default=None, convert=None, registry=None):
+    """ Return the setting name, or default if it isn't set.
+        If convert is specified, it will be applied to any value found.
+    """
+    if registry is None:
+        registry = get_current_registry()
+    settings = getattr(registry, "settings", None) or {}
+    value = settings.get(PREFIX + name, None)
+    if value is None:
+        return default
+    if convert is not None:
+        return convert(value)
+    return value
+
+
+def get_bool(name, default=False, registry=None):
+    return get_setting(name, default=default, convert=asbool, registry=registry)
+
+
+def get_int(name, default=0, registry=None):
+    return get_setting(name, default=default, convert=int, registry=registry)
@@ -0,0 +1,431 @@
+""" Schulze STV for CompactBallots.
+
+    Follows pyvotecore's SchulzeSTV, and returns the same result dict,
+    but works on candidate indices and unique ballots and:
+
+    - calculates the strength of a vote management directly as the minimum
+      cut of its flow network, instead of iterating towards it with repeated
+      max flow calculations,
+    - memoizes strengths by voter profile, since different candidate sets
+      often produce the same profile,
+    - prunes winner sets outside the Schwartz set in one pass per step,
+    - can spread the strength calculations over a process pool,
+    - checks a wall clock budget and reports progress as it goes.
+
+    pyvotecore completes patterns with the same number of indifferences in
+    dict order, which isn't stable. Here they're completed in sorted order.
+"""
+from itertools import combinations
+from multiprocessing import Pool
+import random
+import time
+
+from voteit.schulze.calculation import CalculationTimeout
+from voteit.schulze.calculation import chunks
+
+
+STRENGTH_THRESHOLD = 0.1
+# Positions per block of the partial sums in proportional_completion
+BLOCK_BITS = 4
+# Number of candidate sets handed to a worker at a time
+CHUNK_SIZE = 500
+
+
+def pattern_profile(ballots, candidate, others):
+    """ Count how each (rank vector, count) in ballots ranks the others
+        compared to candidate. A pattern is a pair of bit masks over the
+        positions in others: the ones the voter prefers to candidate,
+        and the ones the voter ranks the same as candidate.
+    """
+    profile = {}
+    for (ranks, count) in ballots:
+        rc = ranks[candidate]
+        less = same = 0
+        bit = 1
+        for x in others:
+            rx = ranks[x]
+            if rc > rx:
+                less |= bit
+            elif rc == rx:
+                same |= bit
+            bit <<= 1
+        pattern = (less, same)
+        profile[pattern] = profile.get(pattern, 0) + count
+    return profile
+
+
+def proportional_completion(profile, size):
+    """ Spread the weight of patterns with indifference over the patterns
+        without, in proportion to the patterns that resolve the indifference.
+        Returns a new profile with only less mask -> weight items.
+
+        Patterns with the same indifference mask are handled together, with
+        the weights of all other patterns summed up by how they look within
+        that mask. Adding weight to a pattern only changes one of those sums,
+        so they're built once per mask instead of once per pattern. The
+        patterns without indifference are also summed up by how they look
+        within pairs of blocks of positions, see marginal_windows, and a mask
+        within one of those pairs is summed from that instead of from all of
+        them.
+
+        Only patterns with weight are stored. Every pattern without
+        indifference is a possible target though, which only matters
+        when there's no weight to go by at all.
+    """
+    strict = {}
+    indifferent = {}
+    for ((less, same), weight) in profile.items():
+        if same:
+            indifferent[(less, same)] = weight
+        else:
+            strict[less] = weight
+    marginals = []
+    for window in marginal_windows(size):
+        marginal = {}
+        for (other_less, other_weight) in strict.iteritems():
+            key = other_less & window
+            marginal[key] = marginal.get(key, 0) + other_weight
+        marginals.append((window, marginal))
+    current_mask = None
+    for pattern in sorted(
+        indifferent, key=lambda x: (-bin(x[1]).count("1"), x[1], x[0])
+    ):
+        weight = indifferent.pop(pattern)
+        (less, same) = pattern
+        if same != current_mask:
+            current_mask = same
+            # Weights by how they look within same. Patterns that are
+            # strict within same go in projected, the rest in partial.
+            projected = {}
+            partial = {}
+            source = strict
+            for (window, marginal) in marginals:
+                if not same & ~window:
+                    source = marginal
+                    break
+            for (other_less, other_weight) in source.iteritems():
+                key = other_less & same
+                projected[key] = projected.get(key, 0) + other_weight
+            for ((other_less, other_same), other_weight) in indifferent.iteritems():
+                common = other_same & same
+                if not common:
+                    key = other_less & same
+                    projected[key] = projected.get(key, 0) + other_weight
+                elif common != same:
+                    key = (other_less & same, common)
+                    partial[key] = partial.get(key, 0) + other_weight
+        # Targets that are still indifferent within part of same
+        halfway = []
+        for ((other_less, other_same), projected_weight) in partial.iteritems():
+            target = (less | other_less, other_same)
+            if target in indifferent:
+                halfway.append((target, (other_less, other_same), projected_weight))
+        denominator = sum(projected.itervalues()) + sum(x[2] for x in halfway)
+        if denominator == 0:
+            additions = [(other_less, 1.0) for other_less in submasks(same)]
+            factor = float(weight) / (len(additions) + len(halfway))
+            halfway = [(target, key, 1.0) for (target, key, w) in halfway]
+        else:
+            additions = projected.items()
+            factor = float(weight) / denominator
+        for (other_less, projected_weight) in additions:
+            added = projected_weight * factor
+            if not added:
+                continue
+            target_less = less | other_less
+            strict[target_less] = strict.get(target_less, 0) + added
+            projected[other_less] = projected.get(other_less, 0) + added
+            for (window, marginal) in marginals:
+                key = target_less & window
+                marginal[key] = marginal.get(key, 0) + added
+        for (target, key, projected_weight) in halfway:
+            added = projected_weight * factor
+            if added:
+                indifferent[target] += added
+                partial[key] += added
+    return strict
+
+
+def marginal_windows(size):
+    """ Bit masks of every pair of blocks of BLOCK_BITS positions, or none
+        when there are less than three blocks.
+    """
+    blocks = [((1 << BLOCK_BITS) - 1) << i for i in range(0, size, BLOCK_BITS)]
+    if len(blocks) < 3:
+        return []
+    return [a | b for (a, b) in combinations(blocks, 2)]
+
+
+def submasks(mask):
+    """ All bit masks that are subsets of mask, including 0 and mask itself. """
+    sub = mask
+    while True:
+        yield sub
+        if not sub:
+            break
+        sub = (sub - 1) & mask
+
+
+def vote_management_strength(profile, size):
+    """ The strength of the vote management for a completed profile.
+
+        Voters can only support the candidates they prefer. The strength is the
+        largest r so that every one of the size candidates can get r support,
+        which by max flow / min cut is the smallest sum of weights of voters
+        that prefer any candidate in T, divided by len(T), for all subsets T.
+    """
+    full = 2 ** size - 1
+    # within[s] = weight of voters that only prefer candidates in s
+    within = [0.0] * (full + 1)
+    for (less, weight) in profile.items():
+        within[less] += weight
+    for i in range(size):
+        bit = 1 << i
+        for s in range(full + 1):
+            if s & bit:
+                within[s] += within[s ^ bit]
+    total = within[full]
+    strength = min(
+        (total - within[full ^ t]) / bin(t).count("1") for t in range(1, full + 1)
+    )
+    if strength * size < STRENGTH_THRESHOLD:
+        return 0
+    return round(strength, 9)
+
+
+class StrengthCache(object):
+    """ Memoized strengths of vote managements, keyed by the voter profile.
+        Can be shared between calculations over the same ballots.
+    """
+
+    def __init__(self, ballots):
+        self.ballots = list(ballots)
+        self.profiles = {}
+        self.hits = 0
+
+    def strength(self, candidate, others):
+        profile = pattern_profile(self.ballots, candidate, others)
+        return self.profile_strength(profile, len(others))
+
+    def profile_strength(self, profile, size):
+        key = (size, tuple(sorted(profile.items())))
+        try:
+            value = self.profiles[key]
+            self.hits += 1
+        except KeyError:
+            value = self.profiles[key] = vote_management_strength(
+                proportional_completion(profile, size), size
+            )
+        return value
+
+
+_worker_cache = None
+
+
+def _init_worker(ballots):
+    global _worker_cache
+    _worker_cache = StrengthCache(ballots)
+
+
+def _chunk_strengths(cache, chunk):
+    """ Strength of each candidate against the rest, for each candidate set in chunk. """
+    return (
+        chunk,
+        [[cache.strength(c, [x for x in s if x != c]) for c in s] for s in chunk],
+    )
+
+
+def _worker_chunk_strengths(chunk):
+    return _chunk_strengths(_worker_cache, chunk)
+
+
+def ncr(n, r):
+    result = 1
+    for i in range(r):
+        result = result * (n - i) // (i + 1)
+    return result
+
+
+def set_graph_edges(
+    ballots, size, required_winners, processes=0, deadline=None, progress=None
+):
+    """ Edges between winner sets, as a dict (A, B) -> weight.
+        A -> B means that B is A with one candidate c swapped in,
+        and that the voters can back A against c with that strength.
+    """
+    total = ncr(size, required_winners + 1)
+    candidate_sets = chunks(combinations(range(size), required_winners + 1), CHUNK_SIZE)
+    pool = None
+    if processes:
+        pool = Pool(processes, initializer=_init_worker, initargs=(list(ballots),))
+        results = pool.imap(_worker_chunk_strengths, candidate_sets)
+    else:
+        cache = StrengthCache(ballots)
+        results = (_chunk_strengths(cache, chunk) for chunk in candidate_sets)
+    edges = {}
+    done = 0
+    try:
+        for (chunk, strengths) in results:
+            for (s, weights) in zip(chunk, strengths):
+                for (c, weight) in zip(s, weights):
+                    if weight > 0:
+                        others = tuple(x for x in s if x != c)
+                        for x in others:
+                            target = tuple(sorted([y for y in others if y != x] + [c]))
+                            edges[(others, target)] = weight
+            done += len(chunk)
+            if progress is not None:
+                progress(done, total)
+            if deadline is not None and time.time() > deadline:
+                raise CalculationTimeout(done, total)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    return edges
+
+
+def source_components(nodes, edges):
+    """ Nodes within strongly connected components that no other component
+        has an edge to. That's the Schwartz set of the graph.
+    """
+    successors = dict((x, []) for x in nodes)
+    for (a, b) in edges:
+        successors[a].append(b)
+    # Iterative version of Tarjan's algorithm
+    index = {}
+    low = {}
+    component = {}
+    stack = []
+    on_stack = set()
+    counter = 0
+    for root in nodes:
+        if root in index:
+            continue
+        work = [(root, iter(successors[root]))]
+        index[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack.add(root)
+        while work:
+            node, children = work[-1]
+            for child in children:
+                if child not in index:
+                    index[child] = low[child] = counter
+                    counter += 1
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(successors[child])))
+                    break
+                elif child in on_stack:
+                    low[node] = min(low[node], index[child])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                if low[node] == index[node]:
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component[member] = node
+                        if member == node:
+                            break
+    beaten = set(component[b] for (a, b) in edges if component[a] != component[b])
+    return set(x for x in nodes if component[x] not in beaten)
+
+
+def schwartz_set_heuristic(nodes, edges, deadline=None):
+    """ Same as pyvotecore's heuristic: remove everything outside the Schwartz set,
+        or when there's nothing to remove, the weakest edges. Repeat until
+        no edges are left. Returns the remaining nodes and the actions taken.
+        Modifies edges.
+    """
+    nodes = set(nodes)
+    actions = []
+    while edges:
+        if deadline is not None and time.time() > deadline:
+            raise CalculationTimeout()
+        keep = source_components(nodes, edges)
+        if len(keep) < len(nodes):
+            actions.append({"nodes": nodes - keep})
+            nodes = keep
+            for edge in list(edges):
+                if edge[0] not in nodes or edge[1] not in nodes:
+                    del edges[edge]
+        else:
+            weakest = min(edges.values())
+            removed = set(edge for (edge, weight) in edges.items() if weight == weakest)
+            actions.append({"edges": removed})
+            for edge in removed:
+                del edges[edge]
+    return nodes, actions
+
+
+def break_complex_ties(tied, candidates, ties=None):
+    """ Pick one of the tied candidate sets the way pyvotecore's TieBreaker does.
+        Returns the winner and the ordering used, which is random unless
+        ties is a voteit.schulze.ties.TieBreaker.
+    """
+    if ties is None:
+        ordering = list(candidates)
+        random.shuffle(ordering)
+    else:
+        ordering = ties.ordering()
+    tied = set(tied)
+    column = 0
+    columns = len(list(tied)[0])
+    while len(tied) > 1 and column < columns:
+        first = min(ordering.index(x[column]) for x in tied)
+        tied = set(x for x in tied if x[column] == ordering[first])
+        column += 1
+    return list(tied)[0], ordering
+
+
+def schulze_stv(
+    ballots, required_winners, processes=0, budget=None, progress=None, ties=None
+):
+    """ Schulze STV result for CompactBallots with required_winners winners.
+
+        processes is the number of worker processes to use, 0 means none.
+        budget is the number of seconds the calculation may take before
+        CalculationTimeout is raised.
+        progress is called with the number of candidate sets processed and the total.
+        ties is the TieBreaker to use, if any.
+    """
+    deadline = budget and time.time() + budget or None
+    candidates = ballots.candidates
+    result = {"candidates": set(candidates)}
+    if required_winners >= len(candidates):
+        result["winners"] = set(candidates)
+        return result
+    edges = set_graph_edges(
+        ballots,
+        len(candidates),
+        required_winners,
+        processes=processes,
+        deadline=deadline,
+        progress=progress,
+    )
+
+    def _uids(node):
+        return tuple(candidates[x] for x in node)
+
+    nodes = list(combinations(range(len(candidates)), required_winners))
+    beaten = set(b for (a, b) in edges)
+    winning = [x for x in nodes if x not in beaten]
+    if not winning:
+        winning, actions = schwartz_set_heuristic(nodes, edges, deadline=deadline)
+        result["actions"] = [
+            {"nodes": set(_uids(x) for x in action["nodes"])}
+            if "nodes" in action
+            else {"edges": set((_uids(a), _uids(b)) for (a, b) in action["edges"])}
+            for action in actions
+        ]
+    winning = set(_uids(x) for x in winning)
+    if len(winning) == 1:
+        winner = list(winning)[0]
+    else:
+        result["tied_winners"] = winning
+        winner, result["tie_breaker"] = break_complex_ties(winning, candidates, ties)
+    result["winners"] = set(winner)
+    return result
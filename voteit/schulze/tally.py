@@ -0,0 +1,203 @@
+""" Running pairwise tally for Schulze polls.
+
+    When enabled, a PairwiseTally is attached to the poll when it starts.
+    Every vote that is added, changed or removed is folded into the pairwise
+    matrix right away, so closing the poll only needs the strongest path step.
+
+    Enable it with:
+
+    voteit.schulze.incremental_tally = true
+
+    On close, the tally is only used if a digest of the votes it has folded
+    in matches the ballots, so a vote it missed can't change the result.
+    To also rebuild the matrix from the ballots and compare it with the
+    running tally, set:
+
+    voteit.schulze.verify_tally = true
+
+    Without a tally, the matrix is built from the ballots on close. Large
+    ballot sets can be split over worker processes:
+
+    voteit.schulze.pairwise_processes = 4
+    voteit.schulze.pairwise_threshold = 10000
+
+    The threshold is the number of ballots below which no workers are used.
+"""
+import logging
+
+from arche.interfaces import IObjectAddedEvent
+from arche.interfaces import IObjectUpdatedEvent
+from arche.interfaces import IObjectWillBeRemovedEvent
+from BTrees.OOBTree import OOBTree
+from persistent import Persistent
+from ZODB.POSException import ConflictError
+from voteit.core.models.interfaces import IVote
+
+from voteit.schulze.cache import DIGEST_MODULUS
+from voteit.schulze.cache import ballot_digest
+from voteit.schulze.cache import format_digest
+from voteit.schulze.cache import rank_hash
+from voteit.schulze.calculation import canonical_ranks
+from voteit.schulze.calculation import fold_ballot
+from voteit.schulze.calculation import rank_vector
+from voteit.schulze.metrics import phase
+from voteit.schulze.settings import get_bool
+from voteit.schulze.settings import get_int
+
+
+logger = logging.getLogger(__name__)
+
+TALLY_ATTR = "_schulze_tally"
+# Default number of ballots from which pairwise_processes are used
+PAIRWISE_THRESHOLD = 10000
+
+
+class PairwiseTally(Persistent):
+    """ Pairwise counts for a poll, indexed as candidates.
+        matrix[i][j] is the number of votes that prefer candidate i over j.
+
+        The rank vector of each vote is kept so changed or removed votes
+        can be subtracted again. digest is the sum of their rank_hash, like
+        a ballot_digest of the votes.
+    """
+
+    # Tallies attached before digests never match
+    digest = None
+
+    def __init__(self, candidates):
+        self.candidates = tuple(sorted(candidates))
+        size = len(self.candidates)
+        self.matrix = [[0] * size for i in range(size)]
+        self.total = 0
+        self.digest = 0
+        self.votes = OOBTree()
+
+    def add(self, name, ballot):
+        if name in self.votes:
+            self.remove(name)
+        ranks = canonical_ranks(rank_vector(ballot, self.candidates))
+        fold_ballot(self.matrix, ranks, 1)
+        self.votes[name] = ranks
+        self.total += 1
+        if self.digest is not None:
+            self.digest = (self.digest + rank_hash(ranks)) % DIGEST_MODULUS
+        self._p_changed = True
+
+    def remove(self, name):
+        ranks = self.votes.pop(name, None)
+        if ranks is None:
+            return
+        fold_ballot(self.matrix, ranks, -1)
+        self.total -= 1
+        if self.digest is not None:
+            self.digest = (self.digest - rank_hash(ranks)) % DIGEST_MODULUS
+        self._p_changed = True
+
+    def matches(self, ballots):
+        """ Does this tally represent the CompactBallots or StreamedBallots?
+            Checks the candidates, vote count and the digest of the votes,
+            which takes one pass over the ballots but no matrix.
+        """
+        return (
+            self.digest is not None
+            and self.candidates == ballots.candidates
+            and self.total == ballots.total
+            and format_digest(self.digest) == ballot_digest(ballots)
+        )
+
+    def verify(self, ballots, **kw):
+        """ Rebuild the matrix from CompactBallots and compare it with the tally.
+            Keyword arguments are passed on to ballots.pairwise.
+        """
+        return self.matches(ballots) and ballots.pairwise(**kw) == self.matrix
+
+    def _p_resolveConflict(self, old_state, saved_state, new_state):
+        """ Votes are cast concurrently, and all of them write to the matrix.
+            Since the counts are additive, both changes can simply be applied.
+            The per-vote rank vectors live in their own BTree.
+        """
+        if not (
+            old_state["candidates"]
+            == saved_state["candidates"]
+            == new_state["candidates"]
+        ):
+            raise ConflictError()
+        resolved = dict(new_state)
+        resolved["total"] = (
+            saved_state["total"] + new_state["total"] - old_state["total"]
+        )
+        digests = [x.get("digest") for x in (old_state, saved_state, new_state)]
+        if None in digests:
+            resolved["digest"] = None
+        else:
+            resolved["digest"] = (digests[1] + digests[2] - digests[0]) % DIGEST_MODULUS
+        resolved["matrix"] = [
+            [s + n - o for (o, s, n) in zip(old_row, saved_row, new_row)]
+            for (old_row, saved_row, new_row) in zip(
+                old_state["matrix"], saved_state["matrix"], new_state["matrix"]
+            )
+        ]
+        return resolved
+
+
+def get_tally(poll):
+    return getattr(poll, TALLY_ATTR, None)
+
+
+def attach_tally(poll, votes=()):
+    """ Attach a fresh tally to the poll, including any votes already cast.
+    """
+    tally = PairwiseTally(poll.proposals)
+    for vote in votes:
+        tally.add(vote.__name__, vote.get_vote_data())
+    setattr(poll, TALLY_ATTR, tally)
+    return tally
+
+
+def tally_enabled(registry=None):
+    return get_bool("incremental_tally", registry=registry)
+
+
+def get_pairwise(poll, ballots):
+    """ Return candidates and pairwise matrix for CompactBallots.
+        The running tally is used when it represents the ballots,
+        otherwise the matrix is built from the ballots.
+    """
+    options = {
+        "processes": get_int("pairwise_processes"),
+        "threshold": get_int("pairwise_threshold", default=PAIRWISE_THRESHOLD),
+    }
+    with phase("pairwise", poll=poll.uid, tally=False) as timing:
+        tally = get_tally(poll)
+        if tally is not None and tally.matches(ballots):
+            if not get_bool("verify_tally") or tally.verify(ballots, **options):
+                timing.update(tally=True)
+                return tally.candidates, [list(row) for row in tally.matrix]
+            logger.error(
+                "Pairwise tally of poll %s doesn't match its ballots. "
+                "Using the ballots instead.",
+                poll.uid,
+            )
+        return ballots.candidates, ballots.pairwise(**options)
+
+
+def vote_added(vote, event):
+    tally = get_tally(vote.__parent__)
+    if tally is not None:
+        ballot = vote.get_vote_data()
+        if ballot:
+            tally.add(vote.__name__, ballot)
+        else:
+            tally.remove(vote.__name__)
+
+
+def vote_removed(vote, event):
+    tally = get_tally(vote.__parent__)
+    if tally is not None:
+        tally.remove(vote.__name__)
+
+
+def includeme(config):
+    config.add_subscriber(vote_added, [IVote, IObjectAddedEvent])
+    config.add_subscriber(vote_added, [IVote, IObjectUpdatedEvent])
+    config.add_subscriber(vote_removed, [IVote, IObjectWillBeRemovedEvent])
@@ -1,8 +1,11 @@
+import os
+import random
 import unittest
 
 from arche.views.base import BaseView
 from pyramid import testing
 from pyramid.httpexceptions import HTTPForbidden
+from pyramid.httpexceptions import HTTPNotFound
 from pyramid.request import apply_request_extensions
 from pyramid.traversal import find_root
 from voteit.core.models.agenda_item import AgendaItem
@@ -15,6 +18,7 @@ from voteit.core.security import unrestricted_wf_transition_to
 from voteit.core.testing_helpers import bootstrap_and_fixture
 from zope.interface.verify import verifyClass
 from zope.interface.verify import verifyObject
+from persistent import Persistent
 import colander
 
 
@@ -42,6 +46,63 @@ class SchulzeBaseTests(unittest.TestCase):
         obj = self._dummy_plugin(poll)
         self.assertIsInstance(obj.get_vote_schema(), colander.Schema)
 
+    def test_get_vote_schema_reuses_parts(self):
+        poll = _setup_poll_fixture(self.config)
+        obj = self._dummy_plugin(poll)
+        first = obj.get_vote_schema()
+        second = obj.get_vote_schema()
+        self.failIf(first is second)
+        self.assertEqual([x.name for x in first.children], [x.name for x in second.children])
+        self.failUnless(first['p1uid'].widget is second['p2uid'].widget)
+        self.failUnless(second['p1uid'].proposal is poll.__parent__['p1'])
+        self.assertEqual(first['p1uid'].missing, 6)
+        poll.poll_settings['max_stars'] = 2
+        poll.poll_settings['min_stars'] = 2
+        third = obj.get_vote_schema()
+        self.failIf(third['p1uid'].widget is first['p1uid'].widget)
+        self.assertEqual(third['p1uid'].missing, 3)
+
+    def test_get_vote_schema_removed_proposal(self):
+        poll = _setup_poll_fixture(self.config)
+        obj = self._dummy_plugin(poll)
+        self.assertEqual(len(obj.get_vote_schema().children), 3)
+        del poll.__parent__['p3']
+        self.assertEqual(len(obj.get_vote_schema().children), 2)
+
+    def test_vote_schema_parts(self):
+        from voteit.schulze.schemas import VoteSchemaParts
+        class DummyProposal(object):
+            def __init__(self, name, uid, aid):
+                self.__name__ = name
+                self.uid = uid
+                self.aid = aid
+        proposals = [DummyProposal('p%s' % i, 'p%suid' % i, 'a-%s' % i) for i in range(8)]
+        parts = VoteSchemaParts(proposals, max_stars=7, min_stars=3)
+        self.assertEqual(parts.stars, 7)
+        self.assertEqual(parts.choices[0], ('7', '1'))
+        self.assertEqual(parts.valid_entries, tuple('12345678'))
+        agenda_item = dict((x.__name__, x) for x in proposals)
+        self.assertEqual(parts.find_proposals(agenda_item), proposals)
+        agenda_item['p3'] = DummyProposal('p3', 'other', 'a-3')
+        self.assertEqual(parts.find_proposals(agenda_item), None)
+        schema = parts.schema(proposals)
+        self.assertEqual(schema['p2uid'].title, '#a-2')
+        self.assertRaises(colander.Invalid, schema.deserialize, {'p0uid': '9'})
+
+    def test_vote_schema_parts_validate(self):
+        from voteit.schulze.schemas import VoteSchemaParts
+        class DummyProposal(object):
+            def __init__(self, uid):
+                self.__name__ = self.uid = uid
+                self.aid = uid
+        parts = VoteSchemaParts([DummyProposal(x) for x in 'abc'])
+        self.assertEqual(parts.validate({'a': 1, 'b': u'2'}), ({'a': u'1', 'b': u'2', 'c': 6}, {}))
+        self.assertEqual(parts.validate({'a': 6}), ({'a': u'6', 'b': 6, 'c': 6}, {}))
+        appstruct, errors = parts.validate({'a': 7, 'b': True, 'c': None, 'd': 1})
+        self.assertEqual(sorted(errors), ['a', 'b', 'c', 'd'])
+        schema = parts.schema([DummyProposal(x) for x in 'abc'])
+        self.assertEqual(parts.validate({'a': '1'})[0], schema.deserialize({'a': '1'}))
+
     def test_render_raw_data(self):
         poll = _setup_poll_fixture(self.config)
         #We need a proper poll plugin for this test
@@ -63,7 +124,7 @@ class SchulzeBaseTests(unittest.TestCase):
                          [{'count': 3, 'ballot': {u'p1uid': 1, u'p2uid': 2, u'p3uid': 3}}])
 
 
-class SortedSchulzePollPluginTests(unittest.TestCase):
+class SchulzePollPluginTests(unittest.TestCase):
     def setUp(self):
         request = testing.DummyRequest()
         self.config = testing.setUp(request=request)
@@ -73,8 +134,8 @@ class SortedSchulzePollPluginTests(unittest.TestCase):
 
     @property
     def _cut(self):
-        from voteit.schulze.models import SortedSchulzePollPlugin
-        return SortedSchulzePollPlugin
+        from voteit.schulze.models import SchulzePollPlugin
+        return SchulzePollPlugin
 
     def _fixture(self):
         poll = _setup_poll_fixture(self.config)
@@ -85,15 +146,163 @@ class SortedSchulzePollPluginTests(unittest.TestCase):
         poll = self._fixture()
         self.assertRaises(HTTPForbidden, poll.close_poll)
 
-    def test_eliminate_candidate(self):
+    def test_poll_result(self):
+        from voteit.schulze.ties import poll_seed
+        poll = self._fixture()
+        _add_votes(poll)
+        poll.close_poll()
+        self.assertEqual(poll.poll_result, {
+            'tie_seed': poll_seed(poll.uid),
+            'tie_rule': 'seed',
+            'winner': u'p1uid',
+            'candidates': set([u'p1uid', u'p2uid', u'p3uid']),
+            'pairs': {(u'p1uid', u'p2uid'): 3, (u'p1uid', u'p3uid'): 3,
+                      (u'p2uid', u'p1uid'): 0, (u'p2uid', u'p3uid'): 3,
+                      (u'p3uid', u'p1uid'): 0, (u'p3uid', u'p2uid'): 0},
+            'strong_pairs': {(u'p1uid', u'p2uid'): 3, (u'p1uid', u'p3uid'): 3,
+                             (u'p2uid', u'p3uid'): 3},
+            'strongest_paths': {(u'p1uid', u'p2uid'): 3, (u'p1uid', u'p3uid'): 3,
+                                (u'p2uid', u'p1uid'): 0, (u'p2uid', u'p3uid'): 3,
+                                (u'p3uid', u'p1uid'): 0, (u'p3uid', u'p2uid'): 0},
+            'ranking': [[u'p1uid'], [u'p2uid'], [u'p3uid']],
+            'order': [u'p1uid', u'p2uid', u'p3uid'],
+            'smith_set': set([u'p1uid']),
+            'condorcet_winner': u'p1uid',
+        })
+
+    def test_poll_result_tie_reproducible(self):
+        poll = self._fixture()
+        plugin = poll.get_poll_plugin()
+        for (i, ballot) in enumerate(({u'p1uid': 1, u'p2uid': 2}, {u'p1uid': 2, u'p2uid': 1})):
+            vote = plugin.get_vote_class()(creators=['voter%s' % i])
+            vote.set_vote_data(ballot, notify=False)
+            poll['v%s' % i] = vote
+        poll.close_poll()
+        result = dict(poll.poll_result)
+        self.assertEqual(result['tied_winners'], set([u'p1uid', u'p2uid']))
+        again = plugin.calculation(plugin.get_ballots())()
+        self.assertEqual(again['winner'], result['winner'])
+        self.assertEqual(again['tie_breaker'], result['tie_breaker'])
+
+    def test_poll_result_compact(self):
+        from voteit.schulze.results import PairwiseResult
+        poll = self._fixture()
+        _add_votes(poll)
+        poll.close_poll()
+        self.failUnless(isinstance(poll.poll_result, PairwiseResult))
+
+    def test_close_doesnt_modify_ballots(self):
+        poll = self._fixture()
+        _add_votes(poll)
+        poll.close_poll()
+        self.assertEqual(poll.ballots, (({u'p1uid': 1, u'p2uid': 2, u'p3uid': 3}, 3),))
+
+    def test_poll_result_from_tally(self):
+        from voteit.schulze.tally import attach_tally
+        poll = self._fixture()
+        tally = attach_tally(poll)
+        _add_votes(poll)
+        self.assertEqual(tally.total, 3)
+        poll.close_poll()
+        self.assertEqual(poll.poll_result['winner'], u'p1uid')
+        self.assertEqual(poll.poll_result['pairs'][(u'p2uid', u'p3uid')], 3)
+
+    def test_handle_start_attaches_tally(self):
+        from voteit.schulze.tally import get_tally
+        self.config.registry.settings['voteit.schulze.incremental_tally'] = 'true'
+        poll = self._fixture()
+        plugin = poll.get_poll_plugin()
+        plugin.handle_start(testing.DummyRequest())
+        self.assertEqual(get_tally(poll).candidates, (u'p1uid', u'p2uid', u'p3uid'))
+
+    def test_render_result(self):
+        poll = self._fixture()
+        _add_votes(poll)
+        poll.close_poll()
+        plugin = poll.get_poll_plugin()
+        request = testing.DummyRequest()
+        request.root = find_root(poll)
+        request.meeting = request.root['m']
+        apply_request_extensions(request)
+        view = BaseView(poll, request)
+        result = plugin.render_result(view)
+        self.assertTrue('first proposal' in result)
+        self.assertTrue('third proposal' in result)
+
+    def test_metrics(self):
+        from voteit.schulze.metrics import MemorySink
         poll = self._fixture()
+        sink = MemorySink()
+        self.config.set_schulze_metrics_sink(sink)
         _add_votes(poll)
-        ballots = poll.calculate_ballots()
-        obj = self._cut(poll)
-        ballots = obj.schulze_format_ballots(ballots)
-        self.assertEqual(ballots, [{'count': 3, 'ballot': {u'p1uid': 1, u'p2uid': 2, u'p3uid': 3}}])
-        ballots = obj.eliminate_candidate('p1uid', ballots)
-        self.assertEqual(ballots, [{'count': 3, 'ballot': {u'p2uid': 2, u'p3uid': 3}}])
+        poll.close_poll()
+        self.assertEqual(sink.phases(), ['ballots', 'pairwise', 'calculate'])
+        self.assertEqual(sink.events[0]['voters'], 3)
+        self.assertEqual(sink.events[2]['winners'], 1)
+
+    def test_display_model_stored_on_close(self):
+        from voteit.schulze.results import DISPLAY_ATTR
+        from voteit.schulze.results import DisplayModel
+        poll = self._fixture()
+        _add_votes(poll)
+        poll.close_poll()
+        self.failUnless(isinstance(getattr(poll, DISPLAY_ATTR), DisplayModel))
+        model = poll.get_poll_plugin().get_display_model()
+        self.assertEqual(model['winner'], u'p1uid')
+        self.assertEqual(model['losers'], [u'p2uid', u'p3uid'])
+        self.assertEqual(model['total_votes'], 3)
+        self.assertEqual(model['perc'][u'p1uid'][u'p2uid'],
+                         {u'p1uid': 100, u'p2uid': 0, 'equal': 0})
+
+    def test_display_model_rank_order(self):
+        from voteit.schulze.models import display_model
+        result = {'winner': 'c', 'candidates': set('abc'), 'order': ['c', 'b', 'a'],
+                  'pairs': {('a', 'b'): 0, ('b', 'a'): 1, ('a', 'c'): 0,
+                            ('c', 'a'): 1, ('b', 'c'): 0, ('c', 'b'): 1}}
+        self.assertEqual(display_model(result, ['a', 'b', 'c'], 1)['losers'], ['b', 'a'])
+        del result['order']
+        self.assertEqual(display_model(result, ['a', 'b', 'c'], 1)['losers'], ['a', 'b'])
+
+    def test_display_model_smith_set(self):
+        from voteit.schulze.models import display_model
+        result = {'winner': 'a', 'candidates': set('abc'), 'smith_set': set('ab'),
+                  'pairs': {('a', 'b'): 1, ('b', 'a'): 1, ('a', 'c'): 1,
+                            ('c', 'a'): 0, ('b', 'c'): 1, ('c', 'b'): 0}}
+        model = display_model(result, ['c', 'b', 'a'], 1)
+        self.assertEqual(model['smith_set'], ['b', 'a'])
+        self.assertEqual(model['condorcet_winner'], None)
+
+    def test_pair_percentages(self):
+        from voteit.schulze.models import pair_percentages
+        pairs = {'a': {'b': 2}, 'b': {'a': 1}}
+        self.assertEqual(pair_percentages(pairs, 4), {
+            'a': {'b': {'a': 50, 'b': 25, 'equal': 25}},
+            'b': {'a': {'a': 50, 'b': 25, 'equal': 25}},
+        })
+        self.assertEqual(pair_percentages(pairs, 0)['a']['b'], {'a': 0, 'b': 0, 'equal': 100})
+
+
+class SortedSchulzePollPluginTests(unittest.TestCase):
+    def setUp(self):
+        request = testing.DummyRequest()
+        self.config = testing.setUp(request=request)
+
+    def tearDown(self):
+        testing.tearDown()
+
+    @property
+    def _cut(self):
+        from voteit.schulze.models import SortedSchulzePollPlugin
+        return SortedSchulzePollPlugin
+
+    def _fixture(self):
+        poll = _setup_poll_fixture(self.config)
+        poll.poll_plugin = self._cut.name
+        return poll
+
+    def test_close_with_no_votes(self):
+        poll = self._fixture()
+        self.assertRaises(HTTPForbidden, poll.close_poll)
 
     def test_poll_result_2_winners(self):
         poll = self._fixture()
@@ -105,6 +314,13 @@ class SortedSchulzePollPluginTests(unittest.TestCase):
             poll.poll_result['winners']
         )
 
+    def test_poll_result_condorcet_winner(self):
+        poll = self._fixture()
+        _add_votes(poll)
+        poll.close_poll()
+        self.assertEqual(poll.poll_result['condorcet_winner'], 'p1uid')
+        self.assertEqual(poll.poll_result['smith_set'], set(['p1uid']))
+
     def test_poll_result_no_winner_restriciton(self):
         poll = self._fixture()
         _add_votes(poll)
@@ -128,6 +344,9 @@ class SortedSchulzePollPluginTests(unittest.TestCase):
         result = plugin.render_result(view)
         self.assertTrue('first proposal' in result)
         self.assertTrue('second proposal' in result)
+        # p1 beats everyone, p2 only what's left after p1
+        self.assertEqual(result.count('Condorcet winner'), 1)
+        self.assertEqual(result.count('Beats all remaining proposals'), 1)
 
 
 class SchulzeSTVTests(unittest.TestCase):
@@ -169,11 +388,92 @@ class SchulzeSTVTests(unittest.TestCase):
         self.assertRaises(HTTPForbidden, poll.close_poll)
 
     def test_poll_result(self):
+        from voteit.schulze.ties import poll_seed
         poll = _setup_poll_fixture(self.config)
         poll.set_field_value('poll_plugin', 'schulze_stv')
         _add_votes(poll)
         poll.close_poll()
-        self.assertEqual({'winners': set([u'p1uid']), 'candidates': set([u'p1uid', u'p2uid', u'p3uid'])}, poll.poll_result)
+        self.assertEqual({'winners': set([u'p1uid']), 'candidates': set([u'p1uid', u'p2uid', u'p3uid']),
+                          'tie_seed': poll_seed(poll.uid), 'tie_rule': 'seed'}, poll.poll_result)
+
+    def test_fallback_calculation(self):
+        poll = _setup_poll_fixture(self.config)
+        poll.set_field_value('poll_plugin', 'schulze_stv')
+        poll.poll_settings['winners'] = 2
+        _add_votes(poll)
+        poll.ballots = poll.calculate_ballots()
+        plugin = poll.get_poll_plugin()
+        result = plugin.fallback_calculation(plugin.get_ballots())()
+        self.assertEqual(result['winners'], set([u'p1uid', u'p2uid']))
+
+    def test_close_over_memory_limit(self):
+        self.config.registry.settings['voteit.schulze.isolated_close'] = 'true'
+        self.config.registry.settings['voteit.schulze.memory_limit'] = '1'
+        self.config.registry.settings['voteit.schulze.result_cache_size'] = '0'
+        poll = _setup_poll_fixture(self.config)
+        poll.set_field_value('poll_plugin', 'schulze_stv')
+        _add_votes(poll)
+        poll.ballots = poll.calculate_ballots()
+        plugin = poll.get_poll_plugin()
+        plugin.calculation = lambda ballots: _use_memory
+        self.assertRaises(HTTPForbidden, plugin.handle_close)
+        self.config.registry.settings['voteit.schulze.fallback'] = 'true'
+        plugin.handle_close()
+        self.assertEqual(poll.poll_result['fallback']['limit'], 'memory')
+        self.assertEqual(poll.poll_result['winners'], set([u'p1uid']))
+
+    def test_close_crashed(self):
+        self.config.registry.settings['voteit.schulze.isolated_close'] = 'true'
+        self.config.registry.settings['voteit.schulze.fallback'] = 'true'
+        self.config.registry.settings['voteit.schulze.result_cache_size'] = '0'
+        poll = _setup_poll_fixture(self.config)
+        poll.set_field_value('poll_plugin', 'schulze_stv')
+        _add_votes(poll)
+        poll.ballots = poll.calculate_ballots()
+        plugin = poll.get_poll_plugin()
+        plugin.calculation = lambda ballots: lambda budget=None, progress=None: os._exit(1)
+        self.assertRaises(HTTPForbidden, plugin.handle_close)
+
+    def test_handle_start_over_cost_limit(self):
+        poll = _setup_poll_fixture(self.config)
+        poll.set_field_value('poll_plugin', 'schulze_stv')
+        poll.poll_settings['winners'] = 2
+        plugin = poll.get_poll_plugin()
+        request = testing.DummyRequest()
+        plugin.handle_start(request)
+        self.config.registry.settings['voteit.schulze.cost_limit'] = '60'
+        self.config.registry.settings['voteit.schulze.expected_voters'] = '100000000'
+        self.assertRaises(HTTPForbidden, plugin.handle_start, request)
+
+    def test_handle_start_warns(self):
+        poll = _setup_poll_fixture(self.config)
+        poll.set_field_value('poll_plugin', 'schulze_stv')
+        poll.poll_settings['winners'] = 2
+        self.config.registry.settings['voteit.schulze.expected_voters'] = '100000000'
+        request = testing.DummyRequest()
+        poll.get_poll_plugin().handle_start(request)
+        self.assertEqual(len(request.session.peek_flash()), 1)
+
+    def test_settings_over_cost_limit(self):
+        poll = _setup_poll_fixture(self.config)
+        poll.set_field_value('poll_plugin', 'schulze_stv')
+        self.config.registry.settings['voteit.schulze.cost_limit'] = '60'
+        self.config.registry.settings['voteit.schulze.expected_voters'] = '100000000'
+        schema = poll.get_poll_plugin().get_settings_schema()
+        self.assertRaises(colander.Invalid, schema.deserialize,
+                          {'winners': '2', 'max_stars': '5', 'min_stars': '5'})
+
+    def test_result_cache(self):
+        from voteit.schulze.cache import get_result_cache
+        poll = _setup_poll_fixture(self.config)
+        poll.set_field_value('poll_plugin', 'schulze_stv')
+        _add_votes(poll)
+        poll.close_poll()
+        cache = get_result_cache()
+        hits = cache.hits
+        poll.get_poll_plugin().handle_close()
+        self.assertEqual(cache.hits, hits + 1)
+        self.assertEqual(poll.poll_result['winners'], set([u'p1uid']))
 
     def test_render_result(self):
         poll = _setup_poll_fixture(self.config)
@@ -216,7 +516,7 @@ class SchulzePRTests(unittest.TestCase):
         obj = self._cut(Poll())
         schema = obj.get_settings_schema()
         self.assertIsInstance(schema, colander.SchemaNode)
-        self.assertNotIn('winners', schema)
+        self.assertEqual(schema['winners'].default, 0)
 
     def test_ballots(self):
         poll = _setup_poll_fixture(self.config)
@@ -242,6 +542,27 @@ class SchulzePRTests(unittest.TestCase):
         self.assertEqual(poll.poll_result['rounds'],
                          [{'winner': u'p1uid'}, {'winner': u'p2uid'}, {'winner': u'p3uid'}])
 
+    def test_handle_start_too_many_proposals(self):
+        poll = _setup_poll_fixture(self.config)
+        poll.set_field_value('poll_plugin', 'schulze_pr')
+        plugin = poll.get_poll_plugin()
+        request = testing.DummyRequest()
+        plugin.handle_start(request)
+        plugin.interactive_proposals = 2
+        self.assertRaises(HTTPForbidden, plugin.handle_start, request)
+        self.config.registry.settings['voteit.schulze.deferred_close'] = 'true'
+        plugin.handle_start(request)
+
+    def test_fallback_calculation(self):
+        poll = _setup_poll_fixture(self.config)
+        poll.set_field_value('poll_plugin', 'schulze_pr')
+        _add_votes(poll)
+        poll.ballots = poll.calculate_ballots()
+        plugin = poll.get_poll_plugin()
+        result = plugin.fallback_calculation(plugin.get_ballots())()
+        self.assertEqual(result['order'], [u'p1uid', u'p2uid', u'p3uid'])
+        self.assertEqual(result['rounds'][0], {'winner': u'p1uid'})
+
     def test_render_result(self):
         poll = _setup_poll_fixture(self.config)
         poll.set_field_value('poll_plugin', 'schulze_pr')
@@ -256,6 +577,52 @@ class SchulzePRTests(unittest.TestCase):
         result = plugin.render_result(view)
         self.assertTrue('first proposal' in result)
         self.assertTrue('third proposal' in result)
+        self.assertFalse('Not ranked' in result)
+
+    def test_poll_result_seats(self):
+        poll = _setup_poll_fixture(self.config)
+        poll.set_field_value('poll_plugin', 'schulze_pr')
+        poll.poll_settings['winners'] = 2
+        _add_votes(poll)
+        poll.close_poll()
+        self.assertEqual(poll.poll_result['order'], [u'p1uid', u'p2uid'])
+        self.assertEqual(poll.poll_result['candidates'],
+                         set([u'p1uid', u'p2uid', u'p3uid']))
+
+    def test_estimate_cost_seats(self):
+        poll = _setup_poll_fixture(self.config)
+        poll.set_field_value('poll_plugin', 'schulze_pr')
+        plugin = poll.get_poll_plugin()
+        self.failUnless(plugin.estimate_cost(100, {'winners': 1}) <
+                        plugin.estimate_cost(100, {'winners': 0}))
+
+    def test_handle_start_seats(self):
+        poll = _setup_poll_fixture(self.config)
+        poll.set_field_value('poll_plugin', 'schulze_pr')
+        plugin = poll.get_poll_plugin()
+        plugin.interactive_proposals = 2
+        plugin.interactive_seats = 1
+        request = testing.DummyRequest()
+        poll.poll_settings['winners'] = 1
+        plugin.handle_start(request)
+        poll.poll_settings['winners'] = 2
+        self.assertRaises(HTTPForbidden, plugin.handle_start, request)
+
+    def test_render_result_seats(self):
+        poll = _setup_poll_fixture(self.config)
+        poll.set_field_value('poll_plugin', 'schulze_pr')
+        poll.poll_settings['winners'] = 2
+        _add_votes(poll)
+        poll.close_poll()
+        plugin = poll.get_poll_plugin()
+        request = testing.DummyRequest()
+        request.root = find_root(poll)
+        request.meeting = request.root['m']
+        apply_request_extensions(request)
+        view = BaseView(poll, request)
+        result = plugin.render_result(view)
+        self.assertTrue('first proposal' in result)
+        self.assertTrue('Not ranked' in result)
 
 
 class IntegrationTests(unittest.TestCase):
@@ -275,6 +642,1526 @@ class IntegrationTests(unittest.TestCase):
         poll = Poll()
         self.failUnless(self.config.registry.queryAdapter(poll, IPollPlugin, name = 'schulze_pr'))
 
+    def test_isolation_with_deferred_close(self):
+        from pyramid.exceptions import ConfigurationError
+        self.config.registry.settings['voteit.schulze.isolated_close'] = 'true'
+        self.config.registry.settings['voteit.schulze.deferred_close'] = 'true'
+        self.assertRaises(ConfigurationError, self.config.include, 'voteit.schulze')
+
+
+class PairwiseTallyTests(unittest.TestCase):
+
+    @property
+    def _cut(self):
+        from voteit.schulze.tally import PairwiseTally
+        return PairwiseTally
+
+    def test_add(self):
+        obj = self._cut(['b', 'a', 'c'])
+        obj.add('one', {'a': 1, 'b': 2, 'c': 2})
+        obj.add('two', {'a': 3, 'b': 1, 'c': 2})
+        self.assertEqual(obj.matrix, [[0, 1, 1], [1, 0, 1], [1, 0, 0]])
+        self.assertEqual(obj.total, 2)
+
+    def test_change_and_remove(self):
+        obj = self._cut(['a', 'b'])
+        obj.add('one', {'a': 1, 'b': 2})
+        obj.add('one', {'a': 2, 'b': 1})
+        self.assertEqual(obj.matrix, [[0, 0], [1, 0]])
+        obj.remove('one')
+        self.assertEqual(obj.matrix, [[0, 0], [0, 0]])
+        self.assertEqual(obj.total, 0)
+        obj.remove('404')
+
+    def test_verify(self):
+        from voteit.schulze.calculation import CompactBallots
+        obj = self._cut(['a', 'b'])
+        obj.add('one', {'a': 1, 'b': 2})
+        obj.add('two', {'a': 1, 'b': 2})
+        self.assertTrue(obj.verify(CompactBallots.from_ballots((({'a': 1, 'b': 2}, 2),))))
+        self.assertFalse(obj.verify(CompactBallots.from_ballots((({'a': 2, 'b': 1}, 2),))))
+        self.assertFalse(obj.verify(CompactBallots.from_ballots((({'a': 1, 'b': 2}, 1),))))
+
+    def test_matches_digest(self):
+        from voteit.schulze.calculation import CompactBallots
+        from voteit.schulze.calculation import StreamedBallots
+        obj = self._cut(['a', 'b', 'c'])
+        obj.add('one', {'a': 1, 'b': 2, 'c': 3})
+        obj.add('two', {'a': 3, 'b': 1, 'c': 2})
+        obj.add('three', {'a': 1, 'b': 2, 'c': 3})
+        ballots = (({'a': 1, 'b': 2, 'c': 3}, 2), ({'a': 3, 'b': 1, 'c': 2}, 1))
+        self.assertTrue(obj.matches(CompactBallots.from_ballots(ballots)))
+        self.assertTrue(obj.matches(StreamedBallots(ballots, chunk_size=1)))
+        # A vote changed behind the tally's back, same candidates and total
+        changed = (({'a': 1, 'b': 2, 'c': 3}, 2), ({'a': 1, 'b': 3, 'c': 2}, 1))
+        self.assertFalse(obj.matches(CompactBallots.from_ballots(changed)))
+        obj.remove('two')
+        obj.add('two', {'a': 1, 'b': 3, 'c': 2})
+        self.assertTrue(obj.matches(CompactBallots.from_ballots(changed)))
+        # Tallies without a digest are never used
+        obj.digest = None
+        self.assertFalse(obj.matches(CompactBallots.from_ballots(changed)))
+
+    def test_resolve_conflict(self):
+        obj = self._cut(['a', 'b'])
+        old = obj.__getstate__()
+        saved = dict(old, matrix=[[0, 1], [0, 0]], total=1, digest=5)
+        new = dict(old, matrix=[[0, 0], [1, 0]], total=1, digest=7)
+        resolved = obj._p_resolveConflict(old, saved, new)
+        self.assertEqual(resolved['matrix'], [[0, 1], [1, 0]])
+        self.assertEqual(resolved['total'], 2)
+        self.assertEqual(resolved['digest'], 12)
+
+
+class CompactBallotsTests(unittest.TestCase):
+
+    @property
+    def _cut(self):
+        from voteit.schulze.calculation import CompactBallots
+        return CompactBallots
+
+    def test_from_ballots(self):
+        ballots = (({'a': 1, 'b': '2'}, 3), ({'b': 1}, 2))
+        obj = self._cut.from_ballots(ballots)
+        self.assertEqual(obj.candidates, ('a', 'b'))
+        self.assertEqual(list(obj), [((1, 2), 3), ((2, 1), 2)])
+        self.assertEqual(len(obj), 2)
+        self.assertEqual(obj.total, 5)
+
+    def test_input_not_modified(self):
+        ballots = (({'a': 1, 'b': 2}, 3),)
+        obj = self._cut.from_ballots(ballots)
+        obj.pairwise()
+        obj.as_dicts()[0]['ballot'].pop('a')
+        self.assertEqual(ballots, (({'a': 1, 'b': 2}, 3),))
+        self.assertEqual(obj.as_dicts(), [{'count': 3, 'ballot': {'a': 1, 'b': 2}}])
+
+    def test_identical_ballots_merged(self):
+        ballots = (({'a': 1, 'b': 2}, 3), ({'a': '2', 'b': 5}, 2), ({'a': 3}, 1), ({'a': 5, 'b': 5}, 1))
+        obj = self._cut.from_ballots(ballots)
+        self.assertEqual(list(obj), [((1, 2), 6), ((1, 1), 1)])
+        self.assertEqual(obj.source_count, 4)
+        self.assertEqual(obj.total, 7)
+        self.assertAlmostEqual(obj.compression_ratio, 2.0 / 7)
+
+    def test_canonical_ranks(self):
+        from voteit.schulze.calculation import canonical_ranks
+        self.assertEqual(canonical_ranks((2.0, 5.0, 5.0, 6.0)), (1, 2, 2, 3))
+
+    def test_pairwise(self):
+        obj = self._cut.from_ballots((({'a': 1, 'b': 2}, 3), ({'b': 1}, 2)))
+        self.assertEqual(obj.pairwise(), [[0, 3], [2, 0]])
+
+    def test_parallel_pairwise(self):
+        from voteit.schulze.calculation import pairwise_matrix
+        from voteit.schulze.calculation import parallel_pairwise_matrix
+        obj = self._cut.from_ballots(_random_ballots(random.Random(5), 300))
+        expected = obj.pairwise()
+        self.assertEqual(obj.pairwise(processes=2), expected)
+        self.assertEqual(parallel_pairwise_matrix(obj, len(obj.candidates), 2, shard_size=7), expected)
+        self.assertEqual(pairwise_matrix(obj, len(obj.candidates)), expected)
+
+
+class StreamedBallotsTests(unittest.TestCase):
+
+    @property
+    def _cut(self):
+        from voteit.schulze.calculation import StreamedBallots
+        return StreamedBallots
+
+    def test_candidates_and_total(self):
+        obj = self._cut((({'a': 1, 'b': '2'}, 3), ({'c': 1}, 2)))
+        self.assertEqual(obj.candidates, ('a', 'b', 'c'))
+        self.assertEqual(obj.total, 5)
+        self.assertEqual(obj.source_count, 2)
+
+    def test_merged_within_chunks(self):
+        ballots = (({'a': 1, 'b': 2}, 3), ({'a': 2, 'b': 5}, 2), ({'a': 1, 'b': 2}, 1))
+        self.assertEqual(sorted(self._cut(ballots, chunk_size=2)), [((1, 2), 1), ((1, 2), 5)])
+        self.assertEqual(sorted(self._cut(ballots, chunk_size=3)), [((1, 2), 6)])
+
+    def test_pairwise_same_as_compact(self):
+        from voteit.schulze.calculation import CompactBallots
+        ballots = _random_ballots(random.Random(11), 200)
+        expected = CompactBallots.from_ballots(ballots).pairwise()
+        for chunk_size in (1, 7, 1000):
+            self.assertEqual(self._cut(ballots, chunk_size=chunk_size).pairwise(), expected)
+
+    def test_parallel_pairwise(self):
+        ballots = _random_ballots(random.Random(12), 300)
+        expected = self._cut(ballots).pairwise()
+        obj = self._cut(ballots, chunk_size=10)
+        self.assertEqual(obj.pairwise(processes=2), expected)
+        self.assertEqual(obj.pairwise(processes=2, threshold=1000), expected)
+
+    def test_chunks(self):
+        from voteit.schulze.calculation import chunks
+        self.assertEqual(list(chunks(iter(range(5)), 2)), [[0, 1], [2, 3], [4]])
+
+
+class CalculationTests(unittest.TestCase):
+
+    def test_index_candidates(self):
+        from voteit.schulze.calculation import index_candidates
+        ballots = (({'b': 1, 'a': 2}, 1), ({'c': 1}, 2))
+        self.assertEqual(index_candidates(ballots), ('a', 'b', 'c'))
+
+    def test_rank_vector_missing_is_worst(self):
+        from voteit.schulze.calculation import rank_vector
+        self.assertEqual(rank_vector({'a': '2', 'c': 1}, ('a', 'b', 'c')), (2.0, 3.0, 1.0))
+
+    def test_pairwise_matrix(self):
+        from voteit.schulze.calculation import pairwise_matrix
+        ranked = [((1, 2, 2), 3), ((3, 1, 2), 2)]
+        self.assertEqual(pairwise_matrix(ranked, 3), [[0, 3, 3], [2, 0, 2], [2, 0, 0]])
+
+    def test_widest_paths(self):
+        from voteit.schulze.calculation import widest_paths
+        # Wikipedia example, candidates A-E
+        d = [[0, 20, 26, 30, 22],
+             [25, 0, 16, 33, 18],
+             [19, 29, 0, 17, 24],
+             [15, 12, 28, 0, 14],
+             [23, 27, 21, 31, 0]]
+        self.assertEqual(widest_paths(d), [[0, 28, 28, 30, 24],
+                                           [25, 0, 28, 33, 24],
+                                           [25, 29, 0, 29, 24],
+                                           [25, 28, 28, 0, 24],
+                                           [25, 28, 28, 31, 0]])
+
+    def test_schulze_method_cycle(self):
+        from voteit.schulze.calculation import schulze_method
+        # Wikipedia example with 45 voters
+        ballots = (
+            ({'a': 1, 'c': 2, 'b': 3, 'e': 4, 'd': 5}, 5),
+            ({'a': 1, 'd': 2, 'e': 3, 'c': 4, 'b': 5}, 5),
+            ({'b': 1, 'e': 2, 'd': 3, 'a': 4, 'c': 5}, 8),
+            ({'c': 1, 'a': 2, 'b': 3, 'e': 4, 'd': 5}, 3),
+            ({'c': 1, 'a': 2, 'e': 3, 'b': 4, 'd': 5}, 7),
+            ({'c': 1, 'b': 2, 'a': 3, 'd': 4, 'e': 5}, 2),
+            ({'d': 1, 'c': 2, 'e': 3, 'b': 4, 'a': 5}, 7),
+            ({'e': 1, 'b': 2, 'a': 3, 'd': 4, 'c': 5}, 8),
+        )
+        result = schulze_method(ballots)
+        self.assertEqual(result['winner'], 'e')
+        self.assertEqual(result['pairs'][('a', 'b')], 20)
+        self.assertEqual(result['strong_pairs'][('e', 'd')], 31)
+        self.assertNotIn(('a', 'b'), result['strong_pairs'])
+        self.assertIn('actions', result)
+        self.assertNotIn('tied_winners', result)
+
+    def test_schulze_method_tie(self):
+        from voteit.schulze.calculation import schulze_method
+        ballots = (({'a': 1, 'b': 2}, 1), ({'a': 2, 'b': 1}, 1))
+        result = schulze_method(ballots)
+        self.assertEqual(result['tied_winners'], set(['a', 'b']))
+        self.assertIn(result['winner'], ['a', 'b'])
+        self.assertEqual(set(result['tie_breaker']), set(['a', 'b']))
+        self.assertEqual(result['strong_pairs'], {})
+
+    def test_repeated_schulze(self):
+        from voteit.schulze.calculation import repeated_schulze
+        d = [[0, 2, 3], [1, 0, 3], [0, 0, 0]]
+        rounds = repeated_schulze(('a', 'b', 'c'), d, 3)
+        self.assertEqual([x['winner'] for x in rounds], ['a', 'b', 'c'])
+        self.assertEqual(rounds[1]['candidates'], set(['b', 'c']))
+        self.assertEqual(rounds[1]['pairs'], {('b', 'c'): 3, ('c', 'b'): 0})
+        self.assertEqual(rounds[2], {'winner': 'c'})
+
+    def test_repeated_schulze_restricted(self):
+        from voteit.schulze.calculation import repeated_schulze
+        d = [[0, 2, 3], [1, 0, 3], [0, 0, 0]]
+        rounds = repeated_schulze(('a', 'b', 'c'), d, 1)
+        self.assertEqual([x['winner'] for x in rounds], ['a'])
+
+    def test_schulze_ranking(self):
+        from voteit.schulze.calculation import schulze_ranking
+        from voteit.schulze.calculation import widest_paths
+        d = [[0, 2, 3], [1, 0, 3], [0, 0, 0]]
+        self.assertEqual(schulze_ranking('abc', widest_paths(d)), [['a'], ['b'], ['c']])
+        d = [[0, 1, 2], [1, 0, 2], [0, 0, 0]]
+        self.assertEqual(schulze_ranking('abc', widest_paths(d)), [['a', 'b'], ['c']])
+
+    def test_schulze_result_ranking(self):
+        from voteit.schulze.calculation import schulze_result
+        # c beats a and b, a and b are equal
+        d = [[0, 2, 1], [2, 0, 1], [3, 3, 0]]
+        result = schulze_result(('a', 'b', 'c'), d, ranking=True)
+        self.assertEqual(result['winner'], 'c')
+        self.assertEqual(result['ranking'], [['c'], ['a', 'b']])
+        self.assertEqual(result['order'][0], 'c')
+        self.assertEqual(sorted(result['order']), ['a', 'b', 'c'])
+        self.assertNotIn('ranking', schulze_result(('a', 'b', 'c'), d))
+
+    def test_smith_set(self):
+        from voteit.schulze.calculation import smith_set
+        # a beats b and c, b beats c
+        self.assertEqual(smith_set([[0, 2, 3], [1, 0, 3], [0, 0, 0]]), [0])
+        # a, b and c form a cycle, all beat d
+        d = [[0, 2, 1, 2], [1, 0, 2, 2], [2, 1, 0, 2], [1, 1, 1, 0]]
+        self.assertEqual(sorted(smith_set(d)), [0, 1, 2])
+        # a and b are equal, both beat c
+        self.assertEqual(sorted(smith_set([[0, 1, 2], [1, 0, 2], [0, 0, 0]])), [0, 1])
+        self.assertEqual(smith_set([]), [])
+
+    def test_schulze_result_smith_set(self):
+        from voteit.schulze.calculation import schulze_result
+        d = [[0, 2, 3], [1, 0, 3], [0, 0, 0]]
+        result = schulze_result(('a', 'b', 'c'), d)
+        self.assertEqual(result['condorcet_winner'], 'a')
+        self.assertEqual(result['smith_set'], set(['a']))
+        # The cycle decides, d is never compared
+        d = [[0, 3, 1, 2], [1, 0, 3, 2], [2, 1, 0, 2], [1, 1, 1, 0]]
+        result = schulze_result(('a', 'b', 'c', 'd'), d)
+        self.assertNotIn('condorcet_winner', result)
+        self.assertEqual(result['smith_set'], set('abc'))
+        self.assertEqual(result['winner'], 'a')
+
+    def test_rank_order(self):
+        from voteit.schulze.calculation import rank_order
+        class DummyTies(object):
+            def ordering(self):
+                return ['d', 'c', 'b', 'a']
+        ranking = [['a', 'b'], ['c', 'd']]
+        self.assertEqual(rank_order(ranking, 'a'), ['a', 'b', 'c', 'd'])
+        self.assertEqual(rank_order(ranking, 'b', DummyTies()), ['b', 'a', 'd', 'c'])
+
+    def test_drop_candidate_paths(self):
+        from voteit.schulze.calculation import drop_candidate_paths
+        from voteit.schulze.calculation import widest_paths
+        # b beats a and c on its own, no path depends on c
+        p = widest_paths([[0, 1, 2], [3, 0, 3], [1, 0, 0]])
+        self.assertEqual(drop_candidate_paths(p, 2), [[0, 0], [3, 0]])
+        # a -> b -> c is the only path from a to c
+        p = widest_paths([[0, 3, 1], [0, 0, 3], [1, 0, 0]])
+        self.assertEqual(drop_candidate_paths(p, 1), None)
+
+
+class TieBreakerTests(unittest.TestCase):
+
+    def _ballots(self, ballots):
+        from voteit.schulze.calculation import CompactBallots
+        return CompactBallots.from_ballots(ballots)
+
+    def _cut(self, rule, ballots, **kw):
+        from voteit.schulze.ties import TieBreaker
+        ballots = self._ballots(ballots)
+        return TieBreaker('00ff00ff00ff00ff', rule, ballots.candidates, ballots, **kw)
+
+    def test_poll_seed(self):
+        from voteit.schulze.ties import poll_seed
+        self.assertEqual(poll_seed(u'abc'), poll_seed('abc'))
+        self.assertEqual(len(poll_seed(u'abc')), 16)
+        self.assertNotEqual(poll_seed(u'abc'), poll_seed(u'abd'))
+
+    def test_seeded_ordering(self):
+        from voteit.schulze.ties import seeded_ordering
+        ordering = seeded_ordering('edcba', 'ff')
+        self.assertEqual(sorted(ordering), list('abcde'))
+        self.assertEqual(seeded_ordering('abcde', 'ff'), ordering)
+        self.assertNotEqual([seeded_ordering('abcde', '%x' % i) for i in range(5)], [ordering] * 5)
+
+    def test_ranked_pairs_ordering(self):
+        from voteit.schulze.ties import ranked_pairs_ordering
+        # a > b 6-4, b > c 7-3, c > a 5-5 is a tie, d is beaten by everyone
+        d = [[0, 6, 5, 9], [4, 0, 7, 9], [5, 3, 0, 9], [1, 1, 1, 0]]
+        self.assertEqual(ranked_pairs_ordering('abcd', d, 'dcba'), list('abcd'))
+        # The cycle a > b > c > a, where a > b is the weakest and isn't locked
+        d = [[0, 6, 3], [4, 0, 7], [7, 3, 0]]
+        self.assertEqual(ranked_pairs_ordering('abc', d, 'abc'), list('bca'))
+        # Nothing locked, so the given ordering decides
+        self.assertEqual(ranked_pairs_ordering('ab', [[0, 1], [1, 0]], 'ba'), list('ba'))
+
+    def test_random_ballot_ordering(self):
+        ties = self._cut('random_ballot', (({'a': 1, 'b': 1, 'c': 2}, 3),))
+        ordering = ties.ordering()
+        self.assertEqual(ordering[2], 'c')
+        self.assertEqual(ordering, self._cut('random_ballot', (({'a': 1, 'b': 1, 'c': 2}, 3),)).ordering())
+
+    def test_random_ballot_ordering_reproducible(self):
+        from voteit.schulze.calculation import StreamedBallots
+        from voteit.schulze.ties import TieBreaker
+        ballots = _random_ballots(random.Random(8), 300)
+        ordering = self._cut('random_ballot', ballots).ordering()
+        shuffled = list(ballots)
+        random.Random(9).shuffle(shuffled)
+        for source in (ballots, shuffled, list(reversed(ballots))):
+            self.assertEqual(self._cut('random_ballot', source).ordering(), ordering)
+            for chunk_size in (1, 7, 1000):
+                streamed = StreamedBallots(source, chunk_size=chunk_size)
+                ties = TieBreaker('00ff00ff00ff00ff', 'random_ballot', streamed.candidates, streamed)
+                self.assertEqual(ties.ordering(), ordering)
+
+    def test_ranked_pairs_from_ballots(self):
+        ties = self._cut('ranked_pairs', (({'a': 2, 'b': 1, 'c': 3}, 2), ({'a': 1, 'b': 2, 'c': 3}, 1)))
+        self.assertEqual(ties.ordering(), ['b', 'a', 'c'])
+
+    def test_schulze_result(self):
+        from voteit.schulze.calculation import schulze_result
+        ties = self._cut('seed', (({'a': 1, 'b': 2}, 1), ({'a': 2, 'b': 1}, 1)))
+        d = [[0, 1], [1, 0]]
+        results = [ties.record(schulze_result(('a', 'b'), d, ties=ties)) for i in range(5)]
+        self.assertEqual(results[0]['winner'], ties.ordering()[0])
+        self.assertEqual(results[0]['tie_seed'], '00ff00ff00ff00ff')
+        self.assertEqual(results[0]['tie_rule'], 'seed')
+        self.failUnless(all(x == results[0] for x in results))
+
+    def test_stv_and_pr(self):
+        from voteit.schulze.pr import schulze_pr
+        from voteit.schulze.stv import schulze_stv
+        ballots = (({'a': 1, 'b': 2, 'c': 3}, 1), ({'b': 1, 'c': 2, 'a': 3}, 1),
+                   ({'c': 1, 'a': 2, 'b': 3}, 1))
+        ties = self._cut('seed', ballots)
+        compact = self._ballots(ballots)
+        first = schulze_stv(compact, 1, ties=ties)
+        self.assertEqual(first['tie_breaker'], ties.ordering())
+        self.assertEqual(schulze_stv(compact, 1, ties=ties), first)
+        self.assertEqual(schulze_pr(compact, ties=ties)['order'], ties.ordering())
+
+
+class SchulzeSTVEngineTests(unittest.TestCase):
+
+    def _ballots(self, ballots):
+        from voteit.schulze.calculation import CompactBallots
+        return CompactBallots.from_ballots(ballots)
+
+    def test_fixture(self):
+        from voteit.schulze.stv import schulze_stv
+        ballots = self._ballots((({u'p1uid': 1, u'p2uid': 2, u'p3uid': 3}, 3),))
+        self.assertEqual(schulze_stv(ballots, 1),
+                         {'winners': set([u'p1uid']), 'candidates': set([u'p1uid', u'p2uid', u'p3uid'])})
+
+    def test_proportional(self):
+        from voteit.schulze.stv import schulze_stv
+        # A majority prefers a and b, but a third of the voters should get c
+        ballots = self._ballots((({'a': 1, 'b': 2, 'c': 3}, 4),
+                                 ({'b': 1, 'a': 2, 'c': 3}, 3),
+                                 ({'c': 1, 'a': 2, 'b': 3}, 4)))
+        self.assertEqual(schulze_stv(ballots, 2)['winners'], set(['a', 'c']))
+
+    def test_everyone_wins(self):
+        from voteit.schulze.stv import schulze_stv
+        ballots = self._ballots((({'a': 1, 'b': 2}, 1),))
+        self.assertEqual(schulze_stv(ballots, 2), {'winners': set(['a', 'b']), 'candidates': set(['a', 'b'])})
+
+    def test_progress(self):
+        from voteit.schulze.stv import schulze_stv
+        ballots = self._ballots((({'a': 1, 'b': 2, 'c': 3, 'd': 1}, 1),))
+        calls = []
+        schulze_stv(ballots, 2, progress=lambda done, total: calls.append((done, total)))
+        self.assertEqual(calls, [(4, 4)])
+
+    def test_timeout(self):
+        from voteit.schulze.calculation import CalculationTimeout
+        from voteit.schulze.stv import schulze_stv
+        ballots = self._ballots((({'a': 1, 'b': 2, 'c': 3, 'd': 1}, 1),))
+        self.assertRaises(CalculationTimeout, schulze_stv, ballots, 2, budget=-1)
+
+    def test_processes(self):
+        from voteit.schulze.stv import schulze_stv
+        ballots = self._ballots((({'a': 1, 'b': 2, 'c': 3, 'd': 4}, 5),
+                                 ({'d': 1, 'c': 2, 'b': 3, 'a': 4}, 3),
+                                 ({'b': 1, 'c': 2, 'a': 3, 'd': 4}, 2)))
+        self.assertEqual(schulze_stv(ballots, 2, processes=2), schulze_stv(ballots, 2))
+
+    def test_vote_management_strength(self):
+        from voteit.schulze.stv import vote_management_strength
+        # 3 voters prefer both others, 2 prefer only the first, 1 prefers none
+        profile = {3: 3, 1: 2, 0: 1}
+        self.assertEqual(vote_management_strength(profile, 2), 2.5)
+
+    def test_proportional_completion(self):
+        from voteit.schulze.stv import proportional_completion
+        # 2 voters are indifferent about the second candidate
+        profile = {(1, 2): 2, (3, 0): 1, (1, 0): 3}
+        self.assertEqual(proportional_completion(profile, 2), {1: 4.5, 3: 1.5})
+
+    def test_proportional_completion_without_weight(self):
+        from voteit.schulze.stv import proportional_completion
+        # Nothing to go by, so the voter is spread over all strict patterns
+        self.assertEqual(proportional_completion({(0, 3): 4}, 2), {0: 1, 1: 1, 2: 1, 3: 1})
+
+    def test_strength_cache_size(self):
+        from voteit.schulze.stv import StrengthCache
+        cache = StrengthCache(())
+        # Same profile, but the voter doesn't prefer the second candidate
+        self.assertEqual(cache.profile_strength({(1, 0): 1}, 1), 1)
+        self.assertEqual(cache.profile_strength({(1, 0): 1}, 2), 0)
+
+
+class SchulzePREngineTests(unittest.TestCase):
+
+    def _ballots(self, ballots):
+        from voteit.schulze.calculation import CompactBallots
+        return CompactBallots.from_ballots(ballots)
+
+    def test_fixture(self):
+        from voteit.schulze.pr import schulze_pr
+        ballots = self._ballots((({u'p1uid': 1, u'p2uid': 2, u'p3uid': 3}, 3),))
+        self.assertEqual(schulze_pr(ballots),
+                         {'candidates': set([u'p1uid', u'p2uid', u'p3uid']),
+                          'order': [u'p1uid', u'p2uid', u'p3uid'],
+                          'rounds': [{'winner': u'p1uid'}, {'winner': u'p2uid'}, {'winner': u'p3uid'}]})
+
+    def test_proportional(self):
+        from voteit.schulze.pr import schulze_pr
+        # b is the majority's second choice, but c is first for a third of the voters
+        ballots = self._ballots((({'a': 1, 'b': 2, 'c': 3}, 4),
+                                 ({'b': 1, 'a': 2, 'c': 3}, 3),
+                                 ({'c': 1, 'a': 2, 'b': 3}, 4)))
+        self.assertEqual(schulze_pr(ballots)['order'], ['a', 'c', 'b'])
+
+    def test_tie(self):
+        from voteit.schulze.pr import schulze_pr
+        ballots = self._ballots((({'a': 1, 'b': 2}, 1), ({'a': 2, 'b': 1}, 1)))
+        result = schulze_pr(ballots)
+        self.assertEqual(result['rounds'][0]['tied_winners'], set(['a', 'b']))
+        self.assertEqual(set(result['order']), set(['a', 'b']))
+        self.assertEqual(result['order'][0], [x for x in result['tie_breaker'] if x in 'ab'][0])
+
+    def test_tied_ballots_order(self):
+        from voteit.schulze.pr import schulze_pr
+        from voteit.schulze.stv import schulze_stv
+        # Equal stars are completed in sorted pattern order, not in pyvotecore's
+        # dict order, which ranks p3 before p0 for these ballots.
+        ballots = self._ballots(
+            (({'p0': 3, 'p1': 2, 'p2': 1, 'p3': 3}, 2),
+             ({'p0': 2, 'p1': 1, 'p2': 3, 'p3': 2}, 1),
+             ({'p0': 3, 'p1': 3, 'p2': 3, 'p3': 3}, 2),
+             ({'p0': 1, 'p1': 3, 'p2': 3, 'p3': 3}, 1),
+             ({'p0': 3, 'p1': 3, 'p2': 3, 'p3': 3}, 1),
+             ({'p0': 3, 'p1': 3, 'p2': 3, 'p3': 2}, 1),
+             ({'p0': 1, 'p1': 1, 'p2': 1, 'p3': 2}, 2),
+             ({'p0': 3, 'p1': 1, 'p2': 3, 'p3': 2}, 2),
+             ({'p0': 3, 'p1': 2, 'p2': 3, 'p3': 3}, 1),
+             ({'p0': 3, 'p1': 3, 'p2': 1, 'p3': 3}, 1),
+             ({'p0': 3, 'p1': 1, 'p2': 3, 'p3': 2}, 1)))
+        result = schulze_pr(ballots)
+        self.assertEqual(result['order'], ['p1', 'p2', 'p0', 'p3'])
+        self.assertNotIn('tie_breaker', result)
+        self.assertEqual(schulze_stv(ballots, 3)['winners'], set(['p1', 'p2', 'p3']))
+
+    def test_progress(self):
+        from voteit.schulze.pr import schulze_pr
+        ballots = self._ballots((({'a': 1, 'b': 2, 'c': 3}, 1),))
+        calls = []
+        schulze_pr(ballots, progress=lambda done, total: calls.append((done, total)))
+        self.assertEqual(calls, [(1, 3), (2, 3)])
+
+    def test_timeout(self):
+        from voteit.schulze.calculation import CalculationTimeout
+        from voteit.schulze.pr import schulze_pr
+        ballots = self._ballots((({'a': 1, 'b': 2, 'c': 3}, 1),))
+        self.assertRaises(CalculationTimeout, schulze_pr, ballots, budget=-1)
+
+    def test_processes(self):
+        from voteit.schulze.pr import schulze_pr
+        ballots = self._ballots((({'a': 1, 'b': 2, 'c': 3, 'd': 4}, 5),
+                                 ({'d': 1, 'c': 2, 'b': 3, 'a': 4}, 4),
+                                 ({'b': 1, 'c': 2, 'a': 3, 'd': 4}, 2)))
+        self.assertEqual(schulze_pr(ballots, processes=2), schulze_pr(ballots))
+        self.assertEqual(schulze_pr(ballots, 3, processes=2), schulze_pr(ballots, 3))
+
+    def test_seats(self):
+        from voteit.schulze.pr import schulze_pr
+        from voteit.schulze.ties import TieBreaker
+        rnd = random.Random(3)
+        for i in range(20):
+            ballots = self._ballots(_random_ballots(rnd, rnd.randint(1, 15), 'abcde'))
+            ties = TieBreaker('%016x' % i, 'seed', ballots.candidates, ballots)
+            result = schulze_pr(ballots, ties=ties)
+            self.assertEqual(schulze_pr(ballots, 5, ties=ties), result)
+            seats = schulze_pr(ballots, 2, ties=ties)
+            self.assertEqual(seats['order'], result['order'][:2])
+            self.assertEqual(seats['rounds'], result['rounds'][:2])
+
+    def test_seats_proportional(self):
+        from voteit.schulze.pr import schulze_pr
+        ballots = self._ballots((({'a': 1, 'b': 2, 'c': 3}, 4),
+                                 ({'b': 1, 'a': 2, 'c': 3}, 3),
+                                 ({'c': 1, 'a': 2, 'b': 3}, 4)))
+        self.assertEqual(schulze_pr(ballots, 2)['order'], ['a', 'c'])
+
+    def test_memo(self):
+        from voteit.schulze.pr import RankingMemo
+        from voteit.schulze.pr import schulze_pr
+        ballots = self._ballots(_random_ballots(random.Random(1), 10))
+        memo = RankingMemo()
+        first = schulze_pr(ballots, 2, memo=memo)
+        self.assertEqual(memo.hits, 0)
+        self.assertEqual(len(memo.steps), 2)
+        result = schulze_pr(ballots, 4, memo=memo)
+        self.assertEqual(memo.hits, 2)
+        self.assertEqual(result['order'][:2], first['order'])
+        self.assertEqual(result, schulze_pr(ballots, 4))
+
+    def test_seats_progress(self):
+        from voteit.schulze.pr import schulze_pr
+        ballots = self._ballots((({'a': 1, 'b': 2, 'c': 3, 'd': 4}, 1),))
+        calls = []
+        schulze_pr(ballots, 2, progress=lambda done, total: calls.append((done, total)))
+        self.assertEqual(calls, [(1, 2), (2, 2)])
+
+
+def _use_memory(budget=None, progress=None):
+    data = []
+    while True:
+        data.append(' ' * 1000000)
+
+
+def _use_cpu(budget=None, progress=None):
+    while True:
+        pass
+
+
+class IsolatedCalculationTests(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def test_run_isolated(self):
+        from voteit.schulze.isolated import run_isolated
+        def calculate(budget=None, progress=None):
+            progress(1, 2)
+            return {'winners': set(['a']), 'budget': budget, 'pid': os.getpid()}
+        calls = []
+        result = run_isolated(calculate, budget=5,
+                              progress=lambda done, total: calls.append((done, total)))
+        self.assertEqual(result['winners'], set(['a']))
+        self.assertEqual(result['budget'], 5)
+        self.assertNotEqual(result['pid'], os.getpid())
+        self.assertEqual(calls, [(1, 2)])
+
+    def test_memory_limit(self):
+        from voteit.schulze.isolated import CalculationLimitExceeded
+        from voteit.schulze.isolated import run_isolated
+        try:
+            run_isolated(_use_memory, memory=50)
+        except CalculationLimitExceeded as exc:
+            self.assertEqual(exc.limit, 'memory')
+        else:
+            self.fail("No limit hit")
+
+    def test_silent_exit(self):
+        from voteit.schulze.isolated import CalculationCrashed
+        from voteit.schulze.isolated import run_isolated
+        def calculate(budget=None, progress=None):
+            os._exit(0)
+        try:
+            run_isolated(calculate, memory=50)
+        except CalculationCrashed as exc:
+            self.assertEqual(exc.exitcode, 0)
+        else:
+            self.fail("No crash")
+
+    def test_killed(self):
+        import signal
+        from voteit.schulze.isolated import CalculationCrashed
+        from voteit.schulze.isolated import CalculationLimitExceeded
+        from voteit.schulze.isolated import run_isolated
+        def calculate(budget=None, progress=None):
+            # Like the OOM killer
+            os.kill(os.getpid(), signal.SIGKILL)
+        try:
+            run_isolated(calculate, memory=50)
+        except CalculationLimitExceeded as exc:
+            self.assertEqual(exc.limit, 'memory')
+        else:
+            self.fail("No limit hit")
+        try:
+            run_isolated(calculate)
+        except CalculationCrashed as exc:
+            self.assertEqual(exc.exitcode, -signal.SIGKILL)
+        else:
+            self.fail("No crash")
+
+    def test_memory_error_while_reporting(self):
+        from voteit.schulze.isolated import MEMORY_EXIT
+        from voteit.schulze.isolated import _exit_error
+        self.assertEqual(_exit_error(MEMORY_EXIT, 50, 0).limit, 'memory')
+        self.assertEqual(_exit_error(MEMORY_EXIT, 0, 0).exitcode, MEMORY_EXIT)
+
+    def test_cpu_limit(self):
+        from voteit.schulze.isolated import CalculationLimitExceeded
+        from voteit.schulze.isolated import run_isolated
+        try:
+            run_isolated(_use_cpu, cpu=1)
+        except CalculationLimitExceeded as exc:
+            self.assertEqual(exc.limit, 'cpu')
+        else:
+            self.fail("No limit hit")
+
+    def test_time_limit(self):
+        from voteit.schulze.isolated import CalculationLimitExceeded
+        from voteit.schulze.isolated import run_isolated
+        try:
+            run_isolated(_use_cpu, timeout=1)
+        except CalculationLimitExceeded as exc:
+            self.assertEqual(exc.limit, 'time')
+        else:
+            self.fail("No limit hit")
+
+    def test_errors(self):
+        from voteit.schulze.calculation import CalculationTimeout
+        from voteit.schulze.isolated import run_isolated
+        def timeout(budget=None, progress=None):
+            raise CalculationTimeout(1, 2)
+        def error(budget=None, progress=None):
+            raise ValueError('bad')
+        self.assertRaises(CalculationTimeout, run_isolated, timeout)
+        self.assertRaises(RuntimeError, run_isolated, error)
+
+    def test_cancelled(self):
+        from voteit.schulze.calculation import CalculationCancelled
+        from voteit.schulze.isolated import run_isolated
+        def calculate(budget=None, progress=None):
+            progress(1, 2)
+            _use_cpu()
+        def progress(done, total):
+            raise CalculationCancelled()
+        self.assertRaises(CalculationCancelled, run_isolated, calculate, progress=progress)
+
+    def test_guarded_calculation(self):
+        from voteit.schulze.isolated import CalculationLimitExceeded
+        from voteit.schulze.isolated import guarded_calculation
+        def fallback(budget=None, progress=None):
+            return {'winners': set(['a'])}
+        self.config.registry.settings['voteit.schulze.memory_limit'] = '50'
+        calculate = guarded_calculation(_use_memory, fallback=fallback)
+        self.assertRaises(CalculationLimitExceeded, calculate)
+        self.config.registry.settings['voteit.schulze.fallback'] = 'true'
+        calculate = guarded_calculation(_use_memory, fallback=fallback)
+        self.assertEqual(calculate(), {'winners': set(['a']),
+                                       'fallback': {'method': 'sorted_schulze', 'limit': 'memory'}})
+
+
+class _StoredPoll(Persistent):
+    """ Just enough of a poll to store a deferred result on. """
+    __parent__ = None
+    uid = 'poll'
+    poll_result = None
+
+    def get_poll_plugin(self):
+        return self
+
+    def set_result(self, result):
+        self.poll_result = result
+
+    def change_states_of(self):
+        return {}
+
+    def get_proposal_objects(self):
+        return []
+
+
+class DeferredCalculationTests(unittest.TestCase):
+    def setUp(self):
+        self.config = testing.setUp(request = testing.DummyRequest())
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def _job(self, calculate, **kw):
+        from voteit.schulze.deferred import CalculationJob
+        from voteit.schulze.deferred import submit
+        job = submit(CalculationJob(calculate, **kw))
+        job.finished.wait(5)
+        return job
+
+    def _poll(self, job):
+        from voteit.schulze.deferred import CALCULATION_ATTR
+        from voteit.schulze.deferred import CalculationStatus
+        poll = testing.DummyResource()
+        setattr(poll, CALCULATION_ATTR, CalculationStatus(job.id))
+        return poll
+
+    def test_job_done(self):
+        from voteit.schulze.deferred import DONE
+        def calculate(budget=None, progress=None):
+            progress(1, 2)
+            return {'winner': 'a'}
+        job = self._job(calculate)
+        self.assertEqual(job.state, DONE)
+        self.assertEqual(job.result, {'winner': 'a'})
+        self.assertEqual((job.done, job.total), (1, 2))
+
+    def test_job_timeout(self):
+        from voteit.schulze.calculation import CalculationTimeout
+        from voteit.schulze.deferred import FAILED
+        from voteit.schulze.deferred import TIMEOUT_MSG
+        def calculate(budget=None, progress=None):
+            raise CalculationTimeout()
+        job = self._job(calculate, budget=1)
+        self.assertEqual((job.state, job.message), (FAILED, TIMEOUT_MSG))
+
+    def test_job_memory_limit(self):
+        from voteit.schulze.deferred import FAILED
+        from voteit.schulze.isolated import MEMORY_LIMIT_MSG
+        from voteit.schulze.isolated import CalculationLimitExceeded
+        def calculate(budget=None, progress=None):
+            raise CalculationLimitExceeded('memory')
+        job = self._job(calculate)
+        self.assertEqual((job.state, job.message), (FAILED, MEMORY_LIMIT_MSG))
+
+    def test_job_error(self):
+        from voteit.schulze.deferred import FAILED
+        def calculate(budget=None, progress=None):
+            raise ValueError()
+        self.assertEqual(self._job(calculate).state, FAILED)
+
+    def test_job_cancelled(self):
+        from voteit.schulze.deferred import CANCELLED
+        from voteit.schulze.deferred import CalculationJob
+        job = CalculationJob(lambda budget=None, progress=None: progress(1, 1))
+        job.cancel()
+        job.run()
+        self.assertEqual(job.state, CANCELLED)
+        self.assertEqual(job.result, None)
+
+    def test_update_calculation_lost_job(self):
+        from voteit.schulze.deferred import CalculationJob
+        from voteit.schulze.deferred import FAILED
+        from voteit.schulze.deferred import INTERRUPTED_MSG
+        from voteit.schulze.deferred import update_calculation
+        poll = self._poll(CalculationJob(None))
+        status = update_calculation(poll, testing.DummyRequest())
+        self.assertEqual((status.state, status.message), (FAILED, INTERRUPTED_MSG))
+        self.assertFalse(hasattr(poll, 'poll_result'))
+
+    def test_cancel_calculation(self):
+        from voteit.schulze.deferred import CANCELLED
+        from voteit.schulze.deferred import CalculationJob
+        from voteit.schulze.deferred import cancel_calculation
+        from voteit.schulze.deferred import get_job
+        from voteit.schulze.deferred import is_calculating
+        from voteit.schulze.deferred import submit
+        job = CalculationJob(lambda budget=None, progress=None: {})
+        job.cancel()  # Keep the worker from finishing before the poll is cancelled
+        submit(job)
+        poll = self._poll(job)
+        self.assertTrue(is_calculating(poll))
+        self.assertEqual(cancel_calculation(poll).state, CANCELLED)
+        self.assertFalse(is_calculating(poll))
+        self.assertEqual(get_job(job.id), None)
+
+    def test_deferred_close(self):
+        from voteit.schulze.deferred import DONE
+        from voteit.schulze.deferred import get_job
+        from voteit.schulze.deferred import get_status
+        from voteit.schulze.deferred import is_calculating
+        from voteit.schulze.deferred import update_calculation
+        self.config.registry.settings['voteit.schulze.deferred_close'] = 'true'
+        poll = _setup_poll_fixture(self.config)
+        poll.set_field_value('poll_plugin', 'schulze_stv')
+        _add_votes(poll)
+        poll.close_poll()
+        self.assertTrue(is_calculating(poll))
+        self.assertEqual(poll.get_poll_plugin().change_states_of(), {})
+        get_job(get_status(poll).job_id).finished.wait(5)
+        self.assertEqual(update_calculation(poll, testing.DummyRequest()).state, DONE)
+        self.assertEqual(poll.poll_result['winners'], set([u'p1uid']))
+
+    def test_stored_by_worker(self):
+        import time
+        import transaction
+        from ZODB import DB
+        from voteit.schulze.deferred import DONE
+        from voteit.schulze.deferred import get_job
+        from voteit.schulze.deferred import get_status
+        from voteit.schulze.deferred import start_calculation
+        db = DB(None)
+        conn = db.open()
+        try:
+            poll = conn.root()['poll'] = _StoredPoll()
+            transaction.commit()
+            calculate = lambda budget=None, progress=None: {'winner': 'a'}
+            start_calculation(poll, calculate)
+            transaction.abort()
+            status = start_calculation(poll, calculate)
+            # Only started once the poll is committed
+            self.assertEqual(get_job(status.job_id), None)
+            transaction.commit()
+            for i in range(50):
+                if get_job(status.job_id) is None:
+                    break
+                time.sleep(0.1)
+            transaction.begin()
+            self.assertEqual(get_status(poll).state, DONE)
+            self.assertEqual(poll.poll_result, {'winner': 'a'})
+        finally:
+            transaction.abort()
+            conn.close()
+            db.close()
+
+    def test_render_while_calculating(self):
+        from voteit.schulze.deferred import cancel_calculation
+        self.config.registry.settings['voteit.schulze.deferred_close'] = 'true'
+        poll = _setup_poll_fixture(self.config)
+        poll.set_field_value('poll_plugin', 'schulze_pr')
+        _add_votes(poll)
+        poll.close_poll()
+        cancel_calculation(poll)
+        request = testing.DummyRequest()
+        request.root = find_root(poll)
+        request.meeting = request.root['m']
+        apply_request_extensions(request)
+        result = poll.get_poll_plugin().render_result(BaseView(poll, request))
+        self.assertIn('schulze-calculation', result)
+        self.assertNotIn('first proposal', result)
+
+
+class ResultCacheTests(unittest.TestCase):
+
+    def _ballots(self, ballots):
+        from voteit.schulze.calculation import CompactBallots
+        return CompactBallots.from_ballots(ballots)
+
+    @property
+    def _cut(self):
+        from voteit.schulze.cache import ResultCache
+        return ResultCache
+
+    def test_result_key(self):
+        from voteit.schulze.cache import result_key
+        first = self._ballots((({'a': 1, 'b': 2}, 2), ({'a': 2, 'b': 1}, 1)))
+        second = self._ballots((({'a': 5, 'b': 1}, 1), ({'a': 1, 'b': 3}, 2)))
+        self.assertEqual(result_key(first, 'schulze'), result_key(second, 'schulze'))
+        self.assertNotEqual(result_key(first, 'schulze'), result_key(first, 'schulze_stv'))
+        self.assertNotEqual(result_key(first, 'schulze_stv', winners=1),
+                            result_key(first, 'schulze_stv', winners=2))
+
+    def test_keys_versioned(self):
+        from voteit.schulze import cache
+        ballots = self._ballots((({'a': 1, 'b': 2}, 2),))
+        d = ballots.pairwise()
+        keys = (cache.result_key(ballots, 'schulze'), cache.matrix_key('ab', d, 'schulze'))
+        version = cache.CACHE_VERSION
+        cache.CACHE_VERSION = version + 1
+        try:
+            self.assertNotEqual(cache.result_key(ballots, 'schulze'), keys[0])
+            self.assertNotEqual(cache.matrix_key('ab', d, 'schulze'), keys[1])
+        finally:
+            cache.CACHE_VERSION = version
+
+    def test_ballot_digest(self):
+        from voteit.schulze.cache import ballot_digest
+        from voteit.schulze.calculation import StreamedBallots
+        first = (({'a': 1, 'b': 2, 'c': 3}, 1), ({'c': 1, 'b': 2, 'a': 3}, 1), ({'a': 1, 'b': 2, 'c': 3}, 2))
+        # Same pairwise matrix
+        second = (({'a': 1, 'c': 2, 'b': 3}, 1), ({'b': 1, 'c': 2, 'a': 3}, 1), ({'a': 1, 'b': 2, 'c': 3}, 2))
+        self.assertEqual(self._ballots(first).pairwise(), self._ballots(second).pairwise())
+        self.assertNotEqual(ballot_digest(self._ballots(first)), ballot_digest(self._ballots(second)))
+        self.assertEqual(ballot_digest(self._ballots(first)),
+                         ballot_digest(StreamedBallots(first[::-1], chunk_size=1)))
+
+    def test_lru(self):
+        obj = self._cut(size=2)
+        obj.set('a', 1)
+        obj.set('b', 2)
+        obj.get('a')
+        obj.set('c', 3)
+        self.assertEqual(obj.get('b'), None)
+        self.assertEqual(obj.get('a'), 1)
+        self.assertEqual(obj.get('c'), 3)
+        self.assertEqual((obj.hits, obj.misses), (3, 1))
+
+    def test_get_returns_copy(self):
+        obj = self._cut()
+        obj.set('a', {'winners': set(['x'])})
+        obj.get('a')['winners'].add('y')
+        self.assertEqual(obj.get('a'), {'winners': set(['x'])})
+
+    def test_directory(self):
+        import shutil
+        import tempfile
+        directory = tempfile.mkdtemp()
+        try:
+            self._cut(directory=directory).set('a', {'winner': u'x'})
+            self.assertEqual(self._cut(directory=directory).get('a'), {'winner': u'x'})
+        finally:
+            shutil.rmtree(directory)
+
+    def test_cached_calculation(self):
+        from voteit.schulze.cache import cached_calculation
+        calls = []
+        def calculate(budget=None, progress=None):
+            calls.append(budget)
+            return {'winner': 'a'}
+        cached = cached_calculation(calculate, 'key', self._cut())
+        self.assertEqual(cached(budget=1), {'winner': 'a'})
+        self.assertEqual(cached(budget=1), {'winner': 'a'})
+        self.assertEqual(calls, [1])
+
+    def test_cached_calculation_fallback(self):
+        from voteit.schulze.cache import cached_calculation
+        calls = []
+        def calculate(budget=None, progress=None):
+            calls.append(budget)
+            return {'winner': 'a', 'fallback': {'limit': 'memory'}}
+        cached = cached_calculation(calculate, 'key', self._cut())
+        cached()
+        cached()
+        self.assertEqual(len(calls), 2)
+
+    def test_ranking_memo(self):
+        from voteit.schulze.cache import get_ranking_memo
+        from voteit.schulze.cache import set_ranking_memo
+        from voteit.schulze.pr import RankingMemo
+        memo = RankingMemo()
+        set_ranking_memo('memo-key', memo)
+        self.assertIs(get_ranking_memo('memo-key'), memo)
+        testing.setUp(settings={'voteit.schulze.ranking_memo_size': '0'})
+        try:
+            self.assertEqual(get_ranking_memo('memo-key'), None)
+        finally:
+            testing.tearDown()
+
+    def test_cached_html(self):
+        from voteit.schulze.cache import cached_html
+        calls = []
+        def render(value):
+            calls.append(value)
+            return u'<p>%s</p>' % value
+        self.assertEqual(cached_html('html-key', render, 1), u'<p>1</p>')
+        self.assertEqual(cached_html('html-key', render, 2), u'<p>1</p>')
+        self.assertEqual(cached_html(None, render, 3), u'<p>3</p>')
+        self.assertEqual(calls, [1, 3])
+
+    def test_html_key(self):
+        from persistent import Persistent
+        from voteit.schulze.cache import html_key
+        obj = Persistent()
+        self.assertEqual(html_key([obj], 'sv'), None)
+        obj._p_jar = object()
+        obj._p_oid = '\x00' * 8
+        obj._p_serial = '\x00' * 7 + '\x01'
+        self.assertNotEqual(html_key([obj], 'sv'), html_key([obj], 'en'))
+        key = html_key([obj], 'sv')
+        obj._p_serial = '\x00' * 7 + '\x02'
+        self.assertNotEqual(html_key([obj], 'sv'), key)
+
+    def test_cache_turned_off(self):
+        from voteit.schulze.cache import get_result_cache
+        config = testing.setUp(settings={'voteit.schulze.result_cache_size': '0'})
+        try:
+            self.assertEqual(get_result_cache(config.registry), None)
+        finally:
+            testing.tearDown()
+
+
+class PairwiseResultTests(unittest.TestCase):
+
+    @property
+    def _cut(self):
+        from voteit.schulze.results import PairwiseResult
+        return PairwiseResult
+
+    def _result(self, d):
+        from voteit.schulze.calculation import schulze_result
+        candidates = ('a', 'b', 'c')
+        return candidates, schulze_result(candidates, d)
+
+    def test_pack_matrix(self):
+        from voteit.schulze.results import pack_matrix
+        from voteit.schulze.results import unpack_matrix
+        d = [[0, 3, 2 ** 30], [1, 0, 5], [7, 0, 0]]
+        self.assertEqual(unpack_matrix(pack_matrix(d), 3), d)
+        self.assertEqual(len(pack_matrix(d)), 36)
+
+    def test_same_as_dict(self):
+        d = [[0, 3, 2], [0, 0, 3], [1, 0, 0]]
+        candidates, result = self._result(d)
+        obj = self._cut.from_matrix(result, candidates, d)
+        self.assertEqual(obj, result)
+        self.assertEqual(obj['strong_pairs'], result['strong_pairs'])
+        self.assertEqual(obj.get('tied_winners'), None)
+        self.assertEqual(obj.matrix(), d)
+
+    def test_actions(self):
+        d = [[0, 3, 1], [1, 0, 3], [3, 1, 0]]
+        candidates, result = self._result(d)
+        self.failUnless('actions' in result)
+        obj = self._cut.from_matrix(result, candidates, d)
+        self.assertEqual(obj['actions'], result['actions'])
+        self.assertEqual(sorted(obj), sorted(result))
+
+    def test_strongest_paths(self):
+        from voteit.schulze.calculation import schulze_result
+        from voteit.schulze.calculation import widest_paths
+        d = [[0, 2, 3], [1, 0, 3], [0, 0, 0]]
+        paths = widest_paths(d)
+        result = schulze_result(('a', 'b', 'c'), d, paths=paths, ranking=True)
+        obj = self._cut.from_matrix(result, ('a', 'b', 'c'), d, paths=paths)
+        self.assertEqual(obj.path_matrix(), paths)
+        self.assertEqual(obj['strongest_paths'][('a', 'c')], 3)
+        self.assertEqual(obj['order'], ['a', 'b', 'c'])
+        self.failUnless('strongest_paths' in dict(obj))
+        self.assertEqual(self._cut.from_matrix(result, ('a', 'b', 'c'), d).path_matrix(), None)
+
+    def test_from_result_and_pickle(self):
+        import cPickle
+        d = [[0, 3, 1], [1, 0, 3], [3, 1, 0]]
+        candidates, result = self._result(d)
+        obj = cPickle.loads(cPickle.dumps(self._cut.from_result(result), 1))
+        self.assertEqual(obj, result)
+
+    def test_compact_result(self):
+        from voteit.schulze.results import compact_result
+        d = [[0, 3, 2], [0, 0, 3], [1, 0, 0]]
+        candidates, result = self._result(d)
+        poll = testing.DummyResource()
+        poll.poll_plugin = 'schulze'
+        poll.poll_result = result
+        self.failUnless(compact_result(poll))
+        self.failUnless(isinstance(poll.poll_result, self._cut))
+        self.assertEqual(poll.poll_result, result)
+        self.failIf(compact_result(poll))
+        # Display models stored as dicts by earlier versions are dropped
+        poll._schulze_display = {'winner': u'a'}
+        self.failUnless(compact_result(poll))
+        self.failIf(hasattr(poll, '_schulze_display'))
+
+    def test_display_model(self):
+        import cPickle
+        from voteit.schulze.models import display_model
+        from voteit.schulze.results import DisplayModel
+        d = [[0, 3, 2], [0, 0, 3], [1, 0, 0]]
+        candidates, result = self._result(d)
+        model = display_model(result, candidates, 3)
+        obj = cPickle.loads(cPickle.dumps(DisplayModel.from_model(model), 1))
+        self.assertEqual(obj.model(), model)
+
+
+class ProvisionalTests(unittest.TestCase):
+
+    def setUp(self):
+        request = testing.DummyRequest()
+        self.config = testing.setUp(request=request)
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def _poll(self, votes):
+        from voteit.schulze.tally import attach_tally
+        poll = testing.DummyResource()
+        poll.uid = 'poll-%s' % id(poll)
+        poll.proposals = ('a', 'b', 'c')
+        self.tally = attach_tally(poll)
+        for (i, ballot) in enumerate(votes):
+            self.tally.add('v%s' % i, ballot)
+        return poll
+
+    def test_standing(self):
+        from voteit.schulze.provisional import standing
+        data = standing(('a', 'b', 'c'), [[0, 2, 3], [1, 0, 3], [0, 0, 0]])
+        self.assertEqual(data['winner'], 'a')
+        self.assertEqual(data['tied_winners'], [])
+        self.assertEqual(data['ranking'], [['a'], ['b'], ['c']])
+        self.assertEqual(data['margins']['a'], {'b': 1, 'c': 3})
+        self.assertEqual(data['margins']['c'], {'a': -3, 'b': -3})
+        data = standing(('a', 'b'), [[0, 1], [1, 0]])
+        self.assertEqual((data['winner'], data['tied_winners']), (None, ['a', 'b']))
+
+    def test_ttl(self):
+        from voteit.schulze.provisional import ProvisionalResults
+        poll = self._poll([{'a': 1, 'b': 2, 'c': 3}])
+        results = ProvisionalResults()
+        first = results.get(poll, 10, now=100)
+        self.assertEqual(first['winner'], 'a')
+        self.assertEqual(first['votes'], 1)
+        self.tally.add('v1', {'b': 1, 'a': 2, 'c': 3})
+        self.tally.add('v2', {'b': 1, 'a': 2, 'c': 3})
+        self.failUnless(results.get(poll, 10, now=105) is first)
+        second = results.get(poll, 10, now=111)
+        self.assertEqual(second['winner'], 'b')
+        self.assertEqual(second['calculated'], 111)
+        # Nothing changed, so it isn't calculated again
+        self.failUnless(results.get(poll, 10, now=130) is second)
+
+    def test_poll_lock(self):
+        from voteit.schulze.provisional import ProvisionalResults
+        results = ProvisionalResults(size=1)
+        lock = results._poll_lock('a')
+        lock.acquire()
+        # Held locks are never dropped, however many polls there are
+        for uid in 'bcde':
+            results._poll_lock(uid)
+        self.failUnless(results._poll_lock('a') is lock)
+        lock.release()
+        del lock
+        self.assertEqual(len(results._locks), 0)
+
+    def test_without_tally(self):
+        from voteit.schulze.provisional import current_pairwise
+        from zope.interface import alsoProvides
+        from voteit.core.models.interfaces import IVote
+        poll = testing.DummyResource()
+        poll.proposals = ('a', 'b')
+        vote = testing.DummyResource()
+        vote.get_vote_data = lambda: {'a': 1, 'b': 2}
+        alsoProvides(vote, IVote)
+        poll['v'] = vote
+        self.assertEqual(current_pairwise(poll), (('a', 'b'), [[0, 1], [0, 0]], 1))
+
+    def test_view(self):
+        from voteit.schulze.views import provisional_result_view
+        request = testing.DummyRequest()
+        poll = _setup_poll_fixture(self.config)
+        poll.poll_plugin = 'schulze'
+        unrestricted_wf_transition_to(poll, 'ongoing')
+        _add_votes(poll)
+        data = provisional_result_view(poll, request)
+        self.assertEqual(data['winner'], u'p1uid')
+        self.assertEqual(data['votes'], 3)
+        poll.poll_plugin = 'schulze_stv'
+        self.assertRaises(HTTPNotFound, provisional_result_view, poll, request)
+
+
+class VoteJSONTests(unittest.TestCase):
+
+    def setUp(self):
+        request = testing.DummyRequest()
+        self.config = testing.setUp(request=request)
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def _request(self, data, content_type='application/json', csrf=True):
+        request = testing.DummyRequest(method='POST')
+        request.json_body = data
+        request.content_type = content_type
+        if csrf:
+            request.headers['X-CSRF-Token'] = request.session.get_csrf_token()
+        apply_request_extensions(request)
+        return request
+
+    def _fixture(self):
+        poll = _setup_poll_fixture(self.config)
+        poll.poll_plugin = 'schulze'
+        unrestricted_wf_transition_to(poll, 'ongoing')
+        return poll
+
+    def test_vote(self):
+        from voteit.schulze.views import vote_json
+        poll = self._fixture()
+        request = self._request({'p1uid': 1, 'p2uid': '3'})
+        self.assertEqual(vote_json(poll, request), {'vote': {'p1uid': u'1', 'p2uid': u'3', 'p3uid': 6}})
+        self.assertEqual(poll['admin'].get_vote_data(), {'p1uid': u'1', 'p2uid': u'3', 'p3uid': 6})
+        request = self._request({'p3uid': 1})
+        vote_json(poll, request)
+        self.assertEqual(poll['admin'].get_vote_data(), {'p1uid': 6, 'p2uid': 6, 'p3uid': u'1'})
+
+    def test_invalid(self):
+        from voteit.schulze.views import vote_json
+        poll = self._fixture()
+        request = self._request({'p1uid': 9, 'other': 1})
+        response = vote_json(poll, request)
+        self.assertEqual(sorted(response['errors']), ['other', 'p1uid'])
+        self.assertEqual(request.response.status_int, 400)
+        self.failIf('admin' in poll)
+        request = self._request([1, 2])
+        self.assertEqual(list(vote_json(poll, request)['errors']), [''])
+
+    def test_csrf(self):
+        from pyramid.exceptions import BadCSRFToken
+        from voteit.schulze.views import vote_json
+        poll = self._fixture()
+        request = self._request({'p1uid': 1}, csrf=False)
+        self.assertRaises(BadCSRFToken, vote_json, poll, request)
+        request.headers['X-CSRF-Token'] = 'wrong'
+        self.assertRaises(BadCSRFToken, vote_json, poll, request)
+        self.failIf('admin' in poll)
+
+    def test_content_type(self):
+        from pyramid.httpexceptions import HTTPUnsupportedMediaType
+        from voteit.schulze.views import vote_json
+        poll = self._fixture()
+        request = self._request({'p1uid': 1}, content_type='text/plain')
+        self.assertRaises(HTTPUnsupportedMediaType, vote_json, poll, request)
+        self.failIf('admin' in poll)
+
+
+class AuditTests(unittest.TestCase):
+
+    def setUp(self):
+        request = testing.DummyRequest()
+        self.config = testing.setUp(request=request)
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def test_compare(self):
+        from voteit.schulze.audit import DIFFERENT
+        from voteit.schulze.audit import SAME
+        from voteit.schulze.audit import TIE
+        from voteit.schulze.audit import compare
+        self.assertEqual(compare({'winner': 'a'}, {'winner': 'a'}), (SAME, []))
+        self.assertEqual(compare({'winner': 'a'}, {'winner': 'b'}), (DIFFERENT, ['winner']))
+        stored = {'winner': 'a', 'tied_winners': set('ab'), 'tie_breaker': ['a', 'b']}
+        result = {'winner': 'b', 'tied_winners': set('ab'), 'tie_breaker': ['b', 'a']}
+        self.assertEqual(compare(stored, result), (TIE, ['winner']))
+        self.assertEqual(compare({'rounds': [{'winner': 'a', 'tied_winners': set('ab')}]},
+                                 {'rounds': [{'winner': 'b', 'tied_winners': set('ab')}]}),
+                         (TIE, ['rounds']))
+
+    def test_compare_reproducible(self):
+        from voteit.schulze.audit import DIFFERENT
+        from voteit.schulze.audit import SAME
+        from voteit.schulze.audit import TIE
+        from voteit.schulze.audit import compare
+        stored = {'winner': 'a', 'tied_winners': set('ab'), 'tie_breaker': ['a', 'b'],
+                  'tie_seed': 'ff', 'tie_rule': 'seed'}
+        self.assertEqual(compare(stored, dict(stored)), (SAME, []))
+        result = dict(stored, winner='b', tie_breaker=['b', 'a'])
+        self.assertEqual(compare(stored, result), (DIFFERENT, ['tie_breaker', 'winner']))
+        result['tie_rule'] = 'ranked_pairs'
+        self.assertEqual(compare(stored, result)[0], TIE)
+
+    def _recalculate(self, name):
+        from voteit.schulze.audit import PollSnapshot
+        from voteit.schulze.audit import recalculate
+        poll = _setup_poll_fixture(self.config)
+        poll.poll_plugin = name
+        _add_votes(poll)
+        poll.close_poll()
+        return recalculate(PollSnapshot(poll))
+
+    def test_closed_polls(self):
+        from voteit.schulze.results import closed_polls
+        poll = _setup_poll_fixture(self.config)
+        poll.poll_plugin = 'schulze'
+        root = find_root(poll)
+        _add_votes(poll)
+        self.assertEqual(list(closed_polls(root, ('schulze',))), [])
+        poll.close_poll()
+        self.assertEqual(list(closed_polls(root, ('schulze',))), [poll])
+        self.assertEqual(list(closed_polls(root, ('schulze_stv',))), [])
+
+    def test_recalculate(self):
+        from voteit.schulze.audit import SAME
+        entry = self._recalculate('schulze')
+        self.assertEqual(entry['status'], SAME, entry)
+        self.assertEqual(entry['plugin'], 'schulze')
+        self.assertEqual(entry['keys'], [])
+        self.failUnless(entry['seconds'] >= 0)
+
+    def test_recalculate_stv(self):
+        from voteit.schulze.audit import SAME
+        from voteit.schulze.audit import TIE
+        entry = self._recalculate('schulze_stv')
+        self.failUnless(entry['status'] in (SAME, TIE), entry)
+
+    def test_recalculate_different(self):
+        from voteit.schulze.audit import DIFFERENT
+        from voteit.schulze.audit import PollSnapshot
+        from voteit.schulze.audit import recalculate
+        poll = _setup_poll_fixture(self.config)
+        poll.poll_plugin = 'schulze'
+        _add_votes(poll)
+        poll.close_poll()
+        snapshot = PollSnapshot(poll)
+        snapshot.poll_result['winner'] = u'p2uid'
+        self.assertEqual(recalculate(snapshot)['status'], DIFFERENT)
+
+
+class CostTests(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def test_calibration(self):
+        from voteit.schulze.cost import CALIBRATION
+        from voteit.schulze.cost import estimate
+        for (method, proposals, voters, winners, stars, seconds) in CALIBRATION:
+            ratio = estimate(method, proposals, voters, winners, stars) / seconds
+            self.failUnless(0.4 < ratio < 2.5, (method, proposals, winners, ratio))
+
+    def test_stv_grows_with_winners(self):
+        from voteit.schulze.cost import stv_cost
+        costs = [stv_cost(30, 100, x) for x in range(1, 13)]
+        self.assertEqual(costs, sorted(costs))
+        self.failUnless(stv_cost(30, 100, 12) > 86400)
+        self.assertEqual(stv_cost(5, 100, 5), 0)
+
+    def test_repeated_schulze(self):
+        from voteit.schulze.cost import repeated_schulze_cost
+        from voteit.schulze.cost import schulze_cost
+        self.assertEqual(repeated_schulze_cost(10, 100, 1), schulze_cost(10, 100))
+        self.failUnless(repeated_schulze_cost(10, 100) > repeated_schulze_cost(10, 100, 3))
+
+    def test_pr_seats(self):
+        from voteit.schulze.cost import pr_cost
+        self.assertAlmostEqual(pr_cost(14, 100, seats=14), pr_cost(14, 100))
+        self.assertAlmostEqual(pr_cost(14, 100, seats=20), pr_cost(14, 100))
+        costs = [pr_cost(20, 100, seats=x) for x in range(1, 21)]
+        self.assertEqual(costs, sorted(costs))
+
+    def test_vote_stars(self):
+        from voteit.schulze.cost import vote_stars
+        self.assertEqual(vote_stars(3), 5)
+        self.assertEqual(vote_stars(8), 5)
+        self.assertEqual(vote_stars(8, max_stars=10, min_stars=2), 8)
+
+    def test_check_cost(self):
+        from voteit.schulze.cost import REFUSE
+        from voteit.schulze.cost import WARN
+        from voteit.schulze.cost import check_cost
+        self.assertEqual(check_cost(10), None)
+        self.assertEqual(check_cost(61), WARN)
+        self.config.registry.settings['voteit.schulze.cost_limit'] = '600'
+        self.assertEqual(check_cost(601), REFUSE)
+        self.config.registry.settings['voteit.schulze.cost_warning'] = '0'
+        self.assertEqual(check_cost(61), None)
+
+    def test_format_duration(self):
+        from voteit.schulze.cost import format_duration
+        self.assertEqual(format_duration(0.1), '1 s')
+        self.assertEqual(format_duration(150), '2 min')
+        self.assertEqual(format_duration(7200), '2 h')
+        self.assertEqual(format_duration(86400 * 3), '3 days')
+
+
+class MetricsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def _sink(self):
+        from voteit.schulze.metrics import MemorySink
+        self.config.include('voteit.schulze.metrics')
+        sink = MemorySink()
+        self.config.set_schulze_metrics_sink(sink)
+        return sink
+
+    def test_no_sink(self):
+        from voteit.schulze.metrics import NULL_PHASE
+        from voteit.schulze.metrics import phase
+        self.assertIs(phase('calculate', poll='p'), NULL_PHASE)
+        calculate = lambda budget=None, progress=None: {}
+        self.assertIs(NULL_PHASE.wrap(calculate), calculate)
+
+    def test_phase(self):
+        from voteit.schulze.metrics import phase
+        sink = self._sink()
+        with phase('ballots', poll='p') as timing:
+            timing.update(voters=3)
+        self.assertEqual(len(sink.events), 1)
+        event = sink.events[0]
+        self.assertEqual(event['phase'], 'ballots')
+        self.assertEqual(event['voters'], 3)
+        self.failUnless(event['duration'] >= 0)
+
+    def test_error(self):
+        from voteit.schulze.calculation import CalculationTimeout
+        from voteit.schulze.metrics import phase
+        sink = self._sink()
+        def calculate(budget=None, progress=None):
+            raise CalculationTimeout()
+        self.assertRaises(CalculationTimeout, phase('calculate').wrap(calculate))
+        self.assertEqual(sink.events[0]['error'], 'CalculationTimeout')
+
+    def test_wrap(self):
+        from voteit.schulze.cache import ResultCache
+        from voteit.schulze.cache import cached_calculation
+        from voteit.schulze.metrics import phase
+        sink = self._sink()
+        timing = phase('calculate', plugin='schulze_stv')
+        calculate = lambda budget=None, progress=None: {'winners': set(['a', 'b'])}
+        calculate = timing.wrap(cached_calculation(calculate, 'key', ResultCache(), stats=timing.data))
+        calculate()
+        calculate()
+        self.assertEqual([(x['winners'], x['cache_hit']) for x in sink.events],
+                         [(2, False), (2, True)])
+
+    def test_logging_setting(self):
+        from voteit.schulze.metrics import LoggingSink
+        from voteit.schulze.metrics import get_sink
+        self.config.registry.settings['voteit.schulze.metrics'] = 'logging'
+        self.config.include('voteit.schulze.metrics')
+        self.failUnless(isinstance(get_sink(), LoggingSink))
+        get_sink()({'phase': 'render', 'duration': 0.1, 'poll': 'p'})
+
+
+class BenchmarkTests(unittest.TestCase):
+
+    def test_generate_ballots(self):
+        from voteit.schulze.benchmark import STRUCTURES
+        from voteit.schulze.benchmark import generate_ballots
+        for structure in STRUCTURES:
+            ballots = generate_ballots('abcde', 30, 3, structure, random.Random(1))
+            self.assertEqual(len(ballots), 30)
+            for ballot in ballots:
+                self.assertEqual(sorted(ballot), list('abcde'))
+                self.failUnless(all(1 <= x <= 3 for x in ballot.values()))
+            self.assertEqual(ballots, generate_ballots('abcde', 30, 3, structure, random.Random(1)))
+        self.assertRaises(ValueError, generate_ballots, 'abc', 1, 3, 'other')
+
+    def test_cycle_has_no_condorcet_winner(self):
+        from voteit.schulze.benchmark import count_ballots
+        from voteit.schulze.benchmark import generate_ballots
+        from voteit.schulze.calculation import CompactBallots
+        ballots = count_ballots(generate_ballots('abcdef', 30, 6, 'cycle'))
+        self.assertEqual(len(ballots), 3)
+        d = CompactBallots.from_ballots(ballots).pairwise()
+        for i in range(6):
+            self.failUnless(any(d[j][i] > d[i][j] for j in range(6)))
+
+    def test_run_isolated_child_dies(self):
+        from voteit.schulze import benchmark
+        run_in_child = benchmark._run_in_child
+        benchmark._run_in_child = lambda case, queue: os._exit(3)
+        try:
+            result = benchmark.run_isolated({'plugin': 'schulze'})
+        finally:
+            benchmark._run_in_child = run_in_child
+        self.assertEqual(result, {'plugin': 'schulze',
+                                  'error': 'exited with code 3 without a result'})
+
+    def test_run_isolated_result(self):
+        from voteit.schulze import benchmark
+        run_in_child = benchmark._run_in_child
+        benchmark._run_in_child = lambda case, queue: queue.put({'done': True})
+        try:
+            self.assertEqual(benchmark.run_isolated({}), {'done': True})
+        finally:
+            benchmark._run_in_child = run_in_child
+
+    def test_ranking_interactive(self):
+        from voteit.schulze.benchmark import INTERACTIVE_CASE
+        from voteit.schulze.benchmark import INTERACTIVE_SECONDS
+        from voteit.schulze.benchmark import INTERACTIVE_STRUCTURES
+        from voteit.schulze.benchmark import time_ranking
+        for structure in INTERACTIVE_STRUCTURES:
+            seconds = time_ranking(*INTERACTIVE_CASE, structure=structure)
+            self.failUnless(seconds < INTERACTIVE_SECONDS, (structure, seconds))
+
+    def test_run_case(self):
+        from voteit.schulze.benchmark import run_case
+        case = {'plugin': 'schulze', 'structure': 'clustered', 'proposals': 4,
+                'voters': 20, 'stars': 5, 'seed': 0}
+        result = run_case(case)
+        self.assertEqual(result['voters'], 20)
+        self.failUnless(result['close_seconds'] >= 0)
+        self.failUnless(result['render_seconds'] >= 0)
+        self.failUnless(result['render_peak_kb'] >= result['baseline_kb'])
+
+
+def _random_ballots(rnd, count, candidates='abcdef'):
+    ballots = []
+    for i in range(count):
+        ballot = dict((x, rnd.randint(1, 5)) for x in candidates if rnd.random() > 0.2)
+        ballots.append((ballot, rnd.randint(1, 3)))
+    return ballots
+
 
 def _setup_poll_fixture(config):
     config.testing_securitypolicy('admin', permissive = True)
@@ -0,0 +1,185 @@
+""" Reproducible tie breaking.
+
+    Ties used to be broken with an unseeded random ordering of the
+    candidates, like pyvotecore does, so a result could never be calculated
+    again to check it. A TieBreaker makes one ordering of all candidates from
+    a seed derived from the poll UID, and every tie in the result is broken by
+    it, the same way the random ordering was used. The seed and rule are
+    stored in the result as 'tie_seed' and 'tie_rule', so anyone can
+    calculate the same result again.
+
+    Setting:
+
+    voteit.schulze.tie_rule = seed
+
+    seed
+        The ordering is a seeded shuffle of the candidates.
+    ranked_pairs
+        Candidates are ordered by Tideman's ranked pairs on the pairwise
+        counts, with equally strong pairs taken in the seeded order.
+    random_ballot
+        Candidates are ordered by ballots picked in a seeded order, weighted
+        by how many voters cast them, until no candidates are equal.
+        What's still equal after every ballot keeps the seeded order.
+"""
+from hashlib import sha1
+import random
+
+from voteit.schulze.settings import get_setting
+
+
+SEED = "seed"
+RANKED_PAIRS = "ranked_pairs"
+RANDOM_BALLOT = "random_ballot"
+RULES = (SEED, RANKED_PAIRS, RANDOM_BALLOT)
+
+
+def poll_seed(uid):
+    """ Seed of a poll, as a hex string. """
+    if isinstance(uid, unicode):
+        uid = uid.encode("utf-8")
+    return sha1(uid).hexdigest()[:16]
+
+
+def get_tie_rule(registry=None):
+    rule = get_setting("tie_rule", default=SEED, registry=registry)
+    if rule not in RULES:
+        raise ValueError("Unknown voteit.schulze.tie_rule: %r" % rule)
+    return rule
+
+
+def seeded_ordering(candidates, seed):
+    """ The candidates shuffled by seed. """
+    ordering = sorted(candidates)
+    random.Random(int(seed, 16)).shuffle(ordering)
+    return ordering
+
+
+def ranked_pairs_ordering(candidates, d, ordering):
+    """ Candidates ordered by ranked pairs, using winning votes like Schulze.
+        d is the pairwise matrix in the order of candidates. Pairs of the
+        same strength, and candidates the locked pairs don't order,
+        go by their place in ordering.
+    """
+    size = len(candidates)
+    place = dict((c, i) for (i, c) in enumerate(ordering))
+    pos = [place[c] for c in candidates]
+    pairs = [
+        (i, j) for i in range(size) for j in range(size) if d[i][j] > d[j][i]
+    ]
+    pairs.sort(key=lambda x: (-d[x[0]][x[1]], d[x[1]][x[0]], pos[x[0]], pos[x[1]]))
+    beats = [set() for i in range(size)]
+    for (i, j) in pairs:
+        if not _reaches(beats, j, i):
+            beats[i].add(j)
+    beaten = [0] * size
+    for i in range(size):
+        for j in beats[i]:
+            beaten[j] += 1
+    result = []
+    free = set(i for i in range(size) if not beaten[i])
+    while free:
+        i = min(free, key=pos.__getitem__)
+        free.remove(i)
+        result.append(candidates[i])
+        for j in beats[i]:
+            beaten[j] -= 1
+            if not beaten[j]:
+                free.add(j)
+    return result
+
+
+def _reaches(beats, start, goal):
+    seen = set([start])
+    stack = [start]
+    while stack:
+        i = stack.pop()
+        if i == goal:
+            return True
+        for j in beats[i]:
+            if j not in seen:
+                seen.add(j)
+                stack.append(j)
+    return False
+
+
+def random_ballot_ordering(ballots, ordering, seed):
+    """ Candidates ordered by ballots picked in a seeded order. ballots is
+        CompactBallots or StreamedBallots, ordering a seeded ordering.
+        Ballots are picked with a chance that follows their count, like
+        picking voters at random.
+
+        The ballots are merged and sorted before any are picked, so the
+        ordering doesn't depend on the order they're read in, or on how
+        StreamedBallots are chunked.
+    """
+    rnd = random.Random(int(seed, 16) ^ 1)
+    index = dict((c, i) for (i, c) in enumerate(ballots.candidates))
+    merged = {}
+    for (ranks, count) in ballots:
+        merged[ranks] = merged.get(ranks, 0) + count
+    picked = sorted(
+        (
+            (rnd.random() ** (1.0 / count), ranks)
+            for (ranks, count) in sorted(merged.items())
+        ),
+        reverse=True,
+    )
+    worst = len(index) + 1
+    groups = [list(ordering)]
+    for (key, ranks) in picked:
+        if all(len(x) == 1 for x in groups):
+            break
+
+        def rank(c):
+            return ranks[index[c]] if c in index else worst
+
+        refined = []
+        for group in groups:
+            group = sorted(group, key=rank)
+            current = [group[0]]
+            for c in group[1:]:
+                if rank(c) != rank(current[-1]):
+                    refined.append(current)
+                    current = []
+                current.append(c)
+            refined.append(current)
+        groups = refined
+    return [c for group in groups for c in group]
+
+
+class TieBreaker(object):
+    """ One ordering of all candidates that breaks every tie of a result.
+        It's only worked out when there is a tie. ballots are the ones
+        the result is calculated from, and d may be their pairwise matrix
+        in the order of candidates, if it's known.
+    """
+
+    def __init__(self, seed, rule, candidates, ballots, d=None):
+        self.seed = seed
+        self.rule = rule
+        self.candidates = tuple(candidates)
+        self.ballots = ballots
+        self.d = d
+        self._ordering = None
+
+    def ordering(self):
+        if self._ordering is None:
+            ordering = seeded_ordering(self.candidates, self.seed)
+            if self.rule == RANKED_PAIRS:
+                d = self.d
+                candidates = self.candidates
+                if d is None:
+                    d = self.ballots.pairwise()
+                    candidates = self.ballots.candidates
+                ordering = ranked_pairs_ordering(candidates, d, ordering)
+            elif self.rule == RANDOM_BALLOT:
+                ordering = random_ballot_ordering(self.ballots, ordering, self.seed)
+            self._ordering = ordering
+        return list(self._ordering)
+
+    def record(self, result):
+        """ Store the seed and rule in result and return it. """
+        result["tie_seed"] = self.seed
+        result["tie_rule"] = self.rule
+        return result
@@ -0,0 +1,141 @@
+from pyramid.csrf import check_csrf_token
+from pyramid.httpexceptions import HTTPForbidden
+from pyramid.httpexceptions import HTTPNotFound
+from pyramid.httpexceptions import HTTPUnsupportedMediaType
+from voteit.core.models.interfaces import IPoll
+from voteit.core.security import ADD_VOTE
+from voteit.core.security import EDIT
+from voteit.core.security import MODERATE_MEETING
+from voteit.core.security import VIEW
+
+from voteit.schulze import _
+from voteit.schulze.deferred import calculation_progress
+from voteit.schulze.deferred import cancel_calculation
+from voteit.schulze.deferred import restart_calculation
+from voteit.schulze.deferred import update_calculation
+from voteit.schulze.models import SchulzeBase
+from voteit.schulze.provisional import provisional_result
+
+
+INVALID_JSON_MSG = _("vote_invalid_json_error", default="Expected a JSON object.")
+
+
+def _progress(context, request):
+    status = update_calculation(context, request)
+    if status is None:
+        raise HTTPNotFound()
+    data = calculation_progress(context)
+    data["message"] = request.localizer.translate(data["message"])
+    return data
+
+
+def calculation_status(context, request):
+    """ Progress of a poll result calculated in the background.
+        Fetching it also stores the result once it's done.
+    """
+    return _progress(context, request)
+
+
+def cancel_calculation_view(context, request):
+    cancel_calculation(context)
+    return _progress(context, request)
+
+
+def restart_calculation_view(context, request):
+    if update_calculation(context, request) is None:
+        raise HTTPNotFound()
+    restart_calculation(context, request)
+    return _progress(context, request)
+
+
+def provisional_result_view(context, request):
+    """ Provisional result of an open poll, see voteit.schulze.provisional. """
+    plugin = context.get_poll_plugin()
+    if not getattr(plugin, "provisional", False):
+        raise HTTPNotFound()
+    if context.get_workflow_state() != "ongoing":
+        raise HTTPNotFound()
+    return provisional_result(context)
+
+
+def vote_json(context, request):
+    """ Cast or change a vote in a Schulze poll without the vote form.
+        The body is a JSON object of proposal UIDs to stars, where 1 is the
+        best, validated by the same rules as the form. Returns the stored
+        vote data, or 'errors' by UID with status 400.
+
+        The body must be sent as application/json, with the CSRF token of
+        the session in the X-CSRF-Token header.
+    """
+    plugin = context.get_poll_plugin()
+    if not isinstance(plugin, SchulzeBase):
+        raise HTTPNotFound()
+    if request.content_type != "application/json":
+        raise HTTPUnsupportedMediaType()
+    check_csrf_token(request, token=None)
+    try:
+        data = request.json_body
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        errors = {"": INVALID_JSON_MSG}
+    else:
+        parts, proposals = plugin.get_vote_schema_parts()
+        appstruct, errors = parts.validate(data)
+    if errors:
+        request.response.status = 400
+        translate = request.localizer.translate
+        return {"errors": dict((k, translate(v)) for (k, v) in errors.items())}
+    userid = request.authenticated_userid
+    vote = context.get(userid)
+    if vote is None:
+        vote = plugin.get_vote_class()(creators=[userid])
+        # Adding it notifies, like in the vote form
+        vote.set_vote_data(appstruct, notify=False)
+        context[userid] = vote
+    else:
+        if not request.has_permission(EDIT, vote):
+            raise HTTPForbidden()
+        vote.set_vote_data(appstruct)
+    return {"vote": appstruct}
+
+
+def includeme(config):
+    config.add_view(
+        calculation_status,
+        context=IPoll,
+        name="schulze_status.json",
+        permission=VIEW,
+        renderer="json",
+    )
+    config.add_view(
+        cancel_calculation_view,
+        context=IPoll,
+        name="schulze_cancel.json",
+        permission=MODERATE_MEETING,
+        request_method="POST",
+        renderer="json",
+    )
+    config.add_view(
+        restart_calculation_view,
+        context=IPoll,
+        name="schulze_restart.json",
+        permission=MODERATE_MEETING,
+        request_method="POST",
+        renderer="json",
+    )
+    config.add_view(
+        provisional_result_view,
+        context=IPoll,
+        name="schulze_provisional.json",
+        permission=MODERATE_MEETING,
+        renderer="json",
+    )
+    config.add_view(
+        vote_json,
+        context=IPoll,
+        name="schulze_vote.json",
+        permission=ADD_VOTE,
+        request_method="POST",
+        renderer="json",
+    )